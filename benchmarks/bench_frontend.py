@@ -0,0 +1,257 @@
+#!/usr/bin/env python3.7
+"""Benchmark the Python front end (the parser run by pykythe.pl).
+
+For each corpus (test_data, the typeshed stubs, a synthetic large
+file), each stage of pykythe.__main__ is timed separately:
+
+    make_file       ast.make_file (read, decode, compute offsets)
+    parse           ast_raw.parse (lib2to3)
+    cvt_parse_tree  ast_raw.cvt_parse_tree
+    add_fqns        ast_cooked.add_fqns
+    color           ast_color.ColorFile.color
+    serialize       as_prolog_str of the AST and the colors
+
+and reported as files/s, bytes/s (of source) and peak memory. Timing
+and memory are measured in separate runs, because tracemalloc slows
+things down a lot.
+
+Results can be saved as a baseline (JSON); a later run is compared
+with the baseline and fails (exit code 1) if any stage's throughput
+has dropped by more than --threshold. Baselines are only meaningful on
+the machine where they were created, so they aren't checked in.
+
+Usage (from the top-level directory):
+    python3.7 benchmarks/bench_frontend.py --save_baseline
+    python3.7 benchmarks/bench_frontend.py [--threshold=0.1]
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+# TODO: get rid of this hack? (same as in tests/test_pykythe.py)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pykythe import ast, ast_color, ast_cooked, ast_raw  # pylint: disable=wrong-import-position
+
+STAGES = ['make_file', 'parse', 'cvt_parse_tree', 'add_fqns', 'color', 'serialize']
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_DIR = os.path.dirname(BENCHMARKS_DIR)
+PYTHON_VERSION = 3
+
+# Stage name -> seconds
+StageTimes = Dict[str, float]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the pykythe Python front end')
+    parser.add_argument('--baseline',
+                        default=os.path.join(BENCHMARKS_DIR, 'baseline.json'),
+                        help='Baseline file (JSON)')
+    parser.add_argument('--save_baseline',
+                        action='store_true',
+                        help='Save the results as the baseline instead of comparing')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.10,
+                        help='Maximum allowed fractional drop in throughput (bytes/s)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of timing runs (the fastest is used)')
+    parser.add_argument('--synthetic_classes',
+                        type=int,
+                        default=500,
+                        help='Number of classes in the synthetic large file')
+    args = parser.parse_args()
+
+    results = {
+            name: _bench_corpus(paths, args.repeat)
+            for name, paths in _corpora(args.synthetic_classes).items()
+            if paths
+    }
+    _print_results(results)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f'Saved baseline: {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline ({args.baseline}); use --save_baseline to create one')
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = _regressions(baseline, results, args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+    return 1 if regressions else 0
+
+
+def _corpora(synthetic_classes: int) -> Dict[str, List[str]]:
+    """Corpus name -> source paths (a corpus can be empty, e.g. typeshed not checked out)."""
+    return {
+            'test_data':
+            sorted(glob.glob(os.path.join(TOP_DIR, 'test_data', '**', '*.py'), recursive=True)),
+            'typeshed':
+            sorted(
+                    glob.glob(os.path.join(TOP_DIR, 'typeshed', 'stdlib', '**', '*.pyi'),
+                              recursive=True)),
+            'synthetic': [_write_synthetic_file(synthetic_classes)],
+    }
+
+
+def _write_synthetic_file(num_classes: int) -> str:
+    """Write a large file with classes, methods, attributes and calls."""
+    path = os.path.join(tempfile.gettempdir(), f'pykythe_bench_synthetic_{num_classes}.py')
+    lines = ['import os', 'from typing import List, Optional', '']
+    for i in range(num_classes):
+        base = f'C{i - 1}' if i % 10 else 'object'
+        lines.extend([
+                f'class C{i}({base}):',
+                f'    """Class {i}."""',
+                '',
+                f'    def __init__(self, x: int, items: Optional[List[str]] = None) -> None:',
+                f'        self.x{i} = x',
+                '        self.items = items or []',
+                '',
+                f'    def method{i}(self, y: int) -> int:',
+                f'        total = self.x{i} + y',
+                '        for item in self.items:',
+                '            if item.startswith(os.sep):',
+                '                total += len(item)',
+                '        return total',
+                '',
+                '',
+                f'c{i} = C{i}({i})',
+                f'r{i} = c{i}.method{i}({i} * 2) + sum(range({i % 7}))',
+                '',
+        ])
+    contents = '\n'.join(lines)
+    # Don't rewrite if unchanged, to avoid disturbing timestamps.
+    if not os.path.exists(path) or open(path).read() != contents:
+        with open(path, 'w') as synthetic_file:
+            synthetic_file.write(contents)
+    return path
+
+
+def _run_stages(path: str, stage_time: Callable[[str, Callable], object]) -> bool:
+    """Run all the stages on path, calling stage_time(name, thunk) for each.
+
+    Returns False if the file couldn't be processed (e.g., a syntax
+    error), in which case it isn't counted.
+    """
+    try:
+        src_file = stage_time('make_file', lambda: ast.make_file(path))
+        parse_tree = stage_time('parse', lambda: ast_raw.parse(src_file, PYTHON_VERSION))
+        cooked_nodes = stage_time(
+                'cvt_parse_tree',
+                lambda: ast_raw.cvt_parse_tree(parse_tree, PYTHON_VERSION, src_file))
+        with_fqns = stage_time(
+                'add_fqns', lambda: ast_cooked.add_fqns(cooked_nodes, 'bench', PYTHON_VERSION))
+        colored = stage_time(
+                'color', lambda: ast_color.ColorFile(src_file, parse_tree,
+                                                     dict(with_fqns.name_astns())).color())
+        stage_time(
+                'serialize', lambda: (with_fqns.as_prolog_str(),
+                                      ast_color.colored_list_as_prolog_str(colored)))
+    except Exception:  # pylint: disable=broad-except
+        return False
+    return True
+
+
+def _bench_corpus(paths: List[str], repeat: int) -> Dict[str, Dict[str, float]]:
+    """Stage name -> {files_per_sec, bytes_per_sec, peak_bytes}."""
+    ok_paths = [path for path in paths if _run_stages(path, lambda _name, thunk: thunk())]
+    if len(ok_paths) < len(paths):
+        print(f'Skipped {len(paths) - len(ok_paths)} of {len(paths)} files (errors)')
+    src_bytes = sum(os.path.getsize(path) for path in ok_paths)
+    best: Optional[StageTimes] = None
+    for _ in range(repeat):
+        times = _time_stages(ok_paths)
+        best = times if best is None else {
+                stage: min(best[stage], times[stage])
+                for stage in STAGES
+        }
+    assert best is not None
+    peaks = _peak_memory(ok_paths)
+    return {
+            stage: {
+                    'files': len(ok_paths),
+                    'files_per_sec': len(ok_paths) / best[stage] if best[stage] else 0.0,
+                    'bytes_per_sec': src_bytes / best[stage] if best[stage] else 0.0,
+                    'peak_bytes': peaks[stage],
+            }
+            for stage in STAGES
+    }
+
+
+def _time_stages(paths: List[str]) -> StageTimes:
+    times = {stage: 0.0 for stage in STAGES}
+
+    def stage_time(name: str, thunk: Callable) -> object:
+        start = time.perf_counter()
+        result = thunk()
+        times[name] += time.perf_counter() - start
+        return result
+
+    for path in paths:
+        _run_stages(path, stage_time)
+    return times
+
+
+def _peak_memory(paths: List[str]) -> Dict[str, int]:
+    """Stage name -> maximum (over paths) of the peak memory allocated by that stage."""
+    peaks = {stage: 0 for stage in STAGES}
+
+    def stage_peak(name: str, thunk: Callable) -> object:
+        # clear_traces() also resets the peak (tracemalloc.reset_peak()
+        # requires Python 3.9).
+        tracemalloc.clear_traces()
+        result = thunk()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks[name] = max(peaks[name], peak)
+        return result
+
+    tracemalloc.start()
+    try:
+        for path in paths:
+            _run_stages(path, stage_peak)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def _print_results(results: Dict[str, Dict[str, Dict[str, float]]]) -> None:
+    print(f'{"corpus":<10} {"stage":<15} {"files":>6} {"files/s":>10} {"bytes/s":>12} '
+          f'{"peak MB":>8}')
+    for corpus, stages in results.items():
+        for stage in STAGES:
+            result = stages[stage]
+            print(f'{corpus:<10} {stage:<15} {result["files"]:6} {result["files_per_sec"]:10.1f} '
+                  f'{result["bytes_per_sec"]:12.0f} {result["peak_bytes"] / 1e6:8.1f}')
+
+
+def _regressions(baseline: Dict, results: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for corpus, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(corpus, {}).get(stage)
+            if not base or not base['bytes_per_sec']:
+                continue
+            ratio = result['bytes_per_sec'] / base['bytes_per_sec']
+            if ratio < 1.0 - threshold:
+                regressions.append(f'{corpus} {stage}: {result["bytes_per_sec"]:.0f} bytes/s '
+                                   f'is {100.0 * (1.0 - ratio):.1f}% slower than baseline '
+                                   f'{base["bytes_per_sec"]:.0f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+% -*- mode: Prolog -*-
+
+%% Benchmark the Kythe JSON writers in pykythe.pl: the fast
+%% write_kythe_fact_json/2 (which is used for output) and the
+%% reference transform_and_write_kythe_fact/2 (transform_kythe_fact/2
+%% plus json_write_dict/3).
+%%
+%% The facts are read from .kythe.json files (e.g., the ones made by
+%% "make test") and turned back into the writers' input (the inverse
+%% of transform_kythe_fact/2); then each writer writes all of them to
+%% a null stream, --repeat times, clearing the fast writer's caches for
+%% each file (as pykythe.pl does). CPU time is reported for each
+%% writer, with the facts/sec and the speedup.
+%%
+%% Usage (see the bench-kythe-writer target in the Makefile):
+%%   swipl -g "consult('benchmarks/bench_kythe_writer.pl')" \
+%%         -g bench_kythe_writer:bench_kythe_writer_main -t halt \
+%%         -l pykythe/pykythe.pl -- [--repeat=N] KYTHE_JSON_FILE...
+
+:- module(bench_kythe_writer, [bench_kythe_writer_main/0]).
+:- encoding(utf8).
+
+:- use_module(library(apply), [maplist/2, maplist/3]).
+:- use_module(library(lists), [sum_list/2]).
+:- use_module(library(optparse), [opt_arguments/3]).
+:- use_module(library(yall)).
+:- use_module('../pykythe/pykythe_utils').
+
+:- style_check(+singleton).
+:- style_check(+var_branches).
+
+bench_kythe_writer_main :-
+    OptsSpec =
+    [[opt(repeat), type(integer), default(5), longflags([repeat]),
+      help('Number of times each writer writes all the facts')]],
+    opt_arguments(OptsSpec, Opts, KytheJsonPaths),
+    memberchk(repeat(Repeat), Opts),
+    maplist(read_writer_facts, KytheJsonPaths, FilesFacts),
+    maplist([Facts, Len]>>length(Facts, Len), FilesFacts, Lens),
+    sum_list(Lens, NumFacts0),
+    NumFacts is NumFacts0 * Repeat,
+    length(KytheJsonPaths, NumFiles),
+    format('~d files, ~D facts (x ~d)~n', [NumFiles, NumFacts0, Repeat]),
+    format('~w~t~12|~t~w~24|~t~w~38|~n', [writer, 'CPU sec', 'facts/sec']),
+    time_writer(reference, pykythe:transform_and_write_kythe_fact,
+                FilesFacts, Repeat, NumFacts, ReferenceSeconds),
+    time_writer(fast, pykythe:write_kythe_fact_json,
+                FilesFacts, Repeat, NumFacts, FastSeconds),
+    Speedup is ReferenceSeconds / max(FastSeconds, 0.000001),
+    format('speedup: ~2fx~n', [Speedup]).
+
+:- meta_predicate time_writer(+, 2, +, +, +, -).
+
+%! time_writer(+Name, :Writer, +FilesFacts, +Repeat, +NumFacts, -Seconds) is det.
+time_writer(Name, Writer, FilesFacts, Repeat, NumFacts, Seconds) :-
+    garbage_collect,
+    statistics(cputime, T0),
+    setup_call_cleanup(
+        open_null_stream(NullStream),
+        forall(between(1, Repeat, _),
+               maplist(write_file_facts(Writer, NullStream), FilesFacts)),
+        close(NullStream)),
+    statistics(cputime, T1),
+    Seconds is T1 - T0,
+    FactsPerSec is NumFacts / max(Seconds, 0.000001),
+    format('~w~t~12|~t~3f~24|~t~0f~38|~n', [Name, Seconds, FactsPerSec]).
+
+write_file_facts(Writer, Stream, Facts) :-
+    pykythe:clear_kythe_json_cache,
+    maplist(call(Writer, Stream), Facts).
+
+%! read_writer_facts(+KytheJsonPath, -Facts:list(dict)) is det.
+read_writer_facts(KytheJsonPath, Facts) :-
+    setup_call_cleanup(
+        open(KytheJsonPath, read, Stream, [encoding(utf8)]),
+        read_writer_facts_(Stream, Facts),
+        close(Stream)).
+
+read_writer_facts_(Stream, Facts) :-
+    pykythe_json_read_dict(Stream, JsonFact),
+    (   JsonFact == @(end)
+    ->  Facts = []
+    ;   writer_fact(JsonFact, Fact),
+        Facts = [Fact|Facts2],
+        read_writer_facts_(Stream, Facts2)
+    ).
+
+%! writer_fact(+JsonFact:dict, -Fact:dict) is det.
+% The inverse of pykythe:transform_kythe_fact/2.
+writer_fact(json{source:Source0, fact_name:FactName, fact_value:FactValueBase64},
+            json{source:Source, fact_name:FactName, fact_value:FactValue}) :- !,
+    writer_vname(Source0, Source),
+    (   FactName == '/kythe/text'
+    ->  FactValue = FactValueBase64
+    ;   base64_utf8(FactValue, FactValueBase64)
+    ).
+writer_fact(json{source:Source0, fact_name:'/', edge_kind:EdgeKind, target:Target0},
+            json{source:Source, fact_name:'/', edge_kind:EdgeKind, target:Target}) :- !,
+    writer_vname(Source0, Source),
+    writer_vname(Target0, Target).
+writer_fact(JsonFact, _) :-
+    domain_error(kythe_json_fact, JsonFact).
+
+writer_vname(VName0, VName) :-
+    (   get_dict(path, VName0, Path0)
+    ->  atom_concat('/', Path0, Path),
+        put_dict(path, VName0, Path, VName)
+    ;   VName = VName0
+    ).
+
+end_of_file.
@@ -1,13 +1,28 @@
 % -*- mode: Prolog -*-
 
-%% Read in Kythe JSON facts and convert them to Prolog facts for use
+%% Read in Kythe facts and convert them to Prolog facts for use
 %% by src_browser.pl
-%% Input is from stdin.
+%% Input is from stdin: a list of .kythe.entries files (the
+%% varint-delimited protobuf format, see pykythe/kythe_entries.pl) or
+%% .kythe.json files, one per line.
 %% For historical reasons, output is specified as a dir and the
 %% facts are in kythe_facts.pl
+%% With --sharded, the output is instead in the shards subdirectory:
+%% one shard per source file plus global.shard (see write_shards/2),
+%% which src_browser.pl loads lazily.
 %% TODO: change how output is specified.
-
-% TODO: performance
+%%
+%% Each input file is converted by a worker thread (see
+%% convert_kythe_file/4), using thread-local kythe_node/7 and
+%% kythe_edge/11 facts for only that file's facts, and the result is
+%% cached in the converted subdirectory (and, with --sharded, the
+%% file's shards are written). Only the input files that are newer
+%% than their cached result are converted, so rerunning after some of
+%% the inputs have changed only combines the cached results of the
+%% others into kythe_facts.pl or global.shard.
+
+% TODO: performance (for .kythe.json; .kythe.entries don't need
+%       base64 or JSON decoding):
 %  pykythe_utils:base64_utf8/2 (and b64_to_utf8_to_atom/2) take 57% of the CPU.
 %  json:json_read_dict/3 takes 41%
 %  json:json_string_codes/3 takes 15% (most of it in utf8_codes/3).
@@ -15,6 +30,8 @@
 :- use_module(library(http/json), [json_read_dict/3]).
 :- use_module(library(base64), [base64/2]).
 :- use_module(library(pairs)).
+:- use_module(library(fastrw), [fast_read/2, fast_write/2]).
+:- use_module(library(utf8), [utf8_codes//1]).
 
 % debugging: main('/tmp/pykythe_test/KYTHE/tmp/pykythe_test/SUBST/home/peter/src/pykythe/test_data/t10.kythe.json').
 
@@ -29,10 +46,12 @@
 %   (source, "", "", string, _)
 
 :- use_module(library(optparse), [opt_arguments/3]).
-:- use_module('../pykythe/pykythe_utils.pl', [base64_utf8/2, log_if/2, log_if/3, validate_prolog_version/0]).
+:- use_module('../pykythe/pykythe_utils.pl', [base64_utf8/2, hash_hex/2, log_if/2, log_if/3, validate_prolog_version/0]).
+:- use_module('../pykythe/kythe_entries.pl', [read_kythe_entry/2]).
 :- use_module('../pykythe/must_once.pl').
 
-:- dynamic kythe_node/7, kythe_edge/11.
+% The facts of the file that's being converted (see convert_kythe_file/4).
+:- thread_local kythe_node/7, kythe_edge/11.
 
 main :-
     main(user_input).
@@ -43,15 +62,20 @@ main(InStream) :-
     prompt(_, ''),                    % really ensure no prompting
     log_if(true, 'Start'),
     extract_opts(Opts),
-    must_once(retract_kythe_facts),
     must_once(read_lines(InStream, Files)),
     length(Files, NumFiles),
     log_if(true, 'Processing ~d files.', [NumFiles]),
-    concurrent_maplist(get_and_assert_kythe_facts, Files),
-    must_once(
-        do_output_stream(Opts, 'kythe_facts.pl', '', [],
-                         write_kythe_facts,
-                         '', [])),
+    concurrent_maplist(convert_kythe_file_if_changed(Opts), Files, Converted),
+    aggregate_all(count, member(converted(_, _, _, converted), Converted), NumConverted),
+    NumUnchanged is NumFiles - NumConverted,
+    log_if(true, 'Converted ~d files (~d unchanged).', [NumConverted, NumUnchanged]),
+    (  memberchk(sharded(true), Opts)
+    -> must_once(write_shards(Opts, Converted))
+    ;  must_once(
+           do_output_stream(Opts, 'kythe_facts.pl', '', [],
+                            write_kythe_facts(Converted),
+                            '', []))
+    ),
     log_if(true, 'End').
 
 read_lines(InStream, Files) :-
@@ -64,33 +88,310 @@ read_lines(InStream, FilesAcc, Files) :-
     ;  read_lines(InStream, [FileStr|FilesAcc], Files)
     ).
 
-write_kythe_facts(KytheFactsOutStream) :-
+%! write_kythe_facts(+Converted:list, +KytheFactsOutStream) is det.
+% Write kythe_facts.pl from the converted files (see
+% convert_kythe_file/4): each file's facts, then the global facts
+% (without duplicates) and the xref postings.
+write_kythe_facts(Converted, KytheFactsOutStream) :-
     % TODO: use fast_serialize?
     log_if(false, 'Write_kythe_facts: start'),
-    forall(kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue),
-           format(KytheFactsOutStream, '~q.~n',
-                  [kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue)])),
-    log_if(false, 'Write_kythe_facts: kythe_node-done'),
-    forall(kythe_edge(Signature1,Corpus1,Root1,Path1,Language1, EdgeName,
-                      Signature2,Corpus2,Root2,Path2,Language2),
-           format(KytheFactsOutStream, '~q.~n',
-                  [kythe_edge(Signature1,Corpus1,Root1,Path1,Language1, EdgeName,
-                              Signature2,Corpus2,Root2,Path2,Language2)])),
-    log_if(false, 'Write_kythe_facts: kythe_edge-done').
+    forall(member(converted(_File, _GlobalPath, FactsPath, _Status), Converted),
+           ( read_fast_term(FactsPath, kythe_file_facts(Facts)),
+             forall(member(Fact, Facts),
+                    format(KytheFactsOutStream, '~q.~n', [Fact])) )),
+    log_if(false, 'Write_kythe_facts: file facts-done'),
+    converted_global_facts(Converted, GlobalFacts, _ShardFiles, XrefPostings),
+    forall(member(Fact, GlobalFacts),
+           format(KytheFactsOutStream, '~q.~n', [Fact])),
+    log_if(false, 'Write_kythe_facts: global facts-done'),
+    forall(member(XrefPosting, XrefPostings),
+           format(KytheFactsOutStream, '~q.~n', [XrefPosting])),
+    log_if(false, 'Write_kythe_facts: xref_posting-done').
+
+%! convert_kythe_file_if_changed(+Opts, +File:atom, -Converted) is det.
+% Converted is converted(File, GlobalPath, FactsPath, Status), where
+% GlobalPath and FactsPath are the files written by
+% convert_kythe_file/4 and Status is `converted` or `unchanged` (if
+% the files are newer than File, which isn't converted again).
+convert_kythe_file_if_changed(Opts, File, converted(File, GlobalPath, FactsPath, Status)) :-
+    converted_paths(Opts, File, GlobalPath, FactsPath),
+    (  converted_up_to_date(Opts, File, GlobalPath, FactsPath)
+    -> Status = unchanged
+    ;  must_once(convert_kythe_file(Opts, File, GlobalPath, FactsPath)),
+       Status = converted
+    ).
+
+%! converted_paths(+Opts, +File:atom, -GlobalPath:atom, -FactsPath:atom) is det.
+% The files in FilesDir/converted for File's converted facts. The
+% names include shard_format_version/1 and whether the output is
+% sharded, so that a change of either causes File to be converted
+% again.
+converted_paths(Opts, File, GlobalPath, FactsPath) :-
+    memberchk(filesdir(FilesDir), Opts),
+    hash_hex(File, Hex),
+    shard_format_version(Version),
+    (  memberchk(sharded(true), Opts)
+    -> Mode = sharded
+    ;  Mode = facts
+    ),
+    format(atom(GlobalPath), '~w/converted/~w-v~d-~w.global', [FilesDir, Hex, Version, Mode]),
+    format(atom(FactsPath), '~w/converted/~w-v~d-~w.facts', [FilesDir, Hex, Version, Mode]).
+
+converted_up_to_date(Opts, File, GlobalPath, FactsPath) :-
+    exists_file(GlobalPath),
+    (  memberchk(sharded(true), Opts)
+    -> true
+    ;  exists_file(FactsPath)
+    ),
+    time_file(File, FileTime),
+    time_file(GlobalPath, GlobalTime),
+    GlobalTime >= FileTime.
+
+%! convert_kythe_file(+Opts, +File:atom, -GlobalPath:atom, -FactsPath:atom) is det.
+% Read File's facts into the (thread-local) kythe_node/7 and
+% kythe_edge/11 facts and write:
+%   GlobalPath -- kythe_converted(GlobalFacts, ShardFiles, XrefPostings),
+%                 where GlobalFacts are the facts that don't have a
+%                 path (semantic nodes), ShardFiles are the
+%                 shard_file/5 facts (if sharded) and XrefPostings
+%                 are as for kythe_xref_postings/2.
+%   FactsPath  -- kythe_file_facts(Facts) with the other facts (if
+%                 not sharded; if sharded, they're written as shards
+%                 by write_file_shard/4).
+% GlobalPath is written last, so that its modification time shows
+% that the conversion finished (see converted_up_to_date/4).
+% The xref postings are only for this file's facts: an edge to an
+% anchor in a different file isn't recognized as such.
+convert_kythe_file(Opts, File, GlobalPath, FactsPath) :-
+    retract_kythe_facts,
+    get_and_assert_kythe_facts(File),
+    kythe_files(SrcFiles),
+    (  memberchk(sharded(true), Opts)
+    -> memberchk(filesdir(FilesDir), Opts),
+       atomic_list_concat([FilesDir, shards], '/', ShardsDir),
+       make_directory_path(ShardsDir),
+       shard_format_version(Version),
+       maplist(write_file_shard(ShardsDir, Version), SrcFiles, ShardFiles)
+    ;  ShardFiles = [],
+       findall(Fact, file_fact(Fact), FileFacts),
+       file_directory_name(FactsPath, ConvertedDir),
+       make_directory_path(ConvertedDir),
+       write_fast_term(FactsPath, kythe_file_facts(FileFacts))
+    ),
+    findall(Fact, global_fact(Fact), GlobalFacts),
+    kythe_xref_postings(SrcFiles, XrefPostings),
+    file_directory_name(GlobalPath, ConvertedDir2),
+    make_directory_path(ConvertedDir2),
+    write_fast_term(GlobalPath, kythe_converted(GlobalFacts, ShardFiles, XrefPostings)),
+    retract_kythe_facts,
+    log_if(false, 'Converted ~q', [File]).
+
+file_fact(kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue)) :-
+    kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue),
+    Path \== ''.
+file_fact(kythe_edge(Signature1,Corpus1,Root1,Path1,Language1, EdgeName,
+                     Signature2,Corpus2,Root2,Path2,Language2)) :-
+    kythe_edge(Signature1,Corpus1,Root1,Path1,Language1, EdgeName,
+               Signature2,Corpus2,Root2,Path2,Language2),
+    Path1 \== ''.
+
+global_fact(kythe_node(Signature,Corpus,Root,'',Language, FactName, FactValue)) :-
+    kythe_node(Signature,Corpus,Root,'',Language, FactName, FactValue).
+global_fact(kythe_edge(Signature1,Corpus1,Root1,'',Language1, EdgeName,
+                       Signature2,Corpus2,Root2,Path2,Language2)) :-
+    kythe_edge(Signature1,Corpus1,Root1,'',Language1, EdgeName,
+               Signature2,Corpus2,Root2,Path2,Language2).
+
+%! converted_global_facts(+Converted:list, -GlobalFacts:list, -ShardFiles:list, -XrefPostings:list) is det.
+% Combine the global parts of the converted files (see
+% convert_kythe_file/4). The same semantic node can be in many files,
+% so GlobalFacts is sorted to remove duplicates.
+converted_global_facts(Converted, GlobalFacts, ShardFiles, XrefPostings) :-
+    findall(kythe_converted(FileGlobalFacts, FileShardFiles, FileXrefPostings),
+            ( member(converted(_File, GlobalPath, _FactsPath, _Status), Converted),
+              read_fast_term(GlobalPath,
+                             kythe_converted(FileGlobalFacts, FileShardFiles, FileXrefPostings)) ),
+            ConvertedGlobals),
+    findall(FileGlobalFacts, member(kythe_converted(FileGlobalFacts, _, _), ConvertedGlobals),
+            GlobalFactsList),
+    append(GlobalFactsList, GlobalFacts0),
+    sort(GlobalFacts0, GlobalFacts),
+    findall(FileShardFiles, member(kythe_converted(_, FileShardFiles, _), ConvertedGlobals),
+            ShardFilesList),
+    append(ShardFilesList, ShardFiles),
+    findall(FileXrefPostings, member(kythe_converted(_, _, FileXrefPostings), ConvertedGlobals),
+            XrefPostingsList),
+    append(XrefPostingsList, XrefPostings).
+
+%! kythe_files(-Files:list) is det.
+% Files is a sorted list of Corpus-Root-Path for all the source files.
+kythe_files(Files) :-
+    setof_or_empty(Corpus-Root-Path,
+                   Signature^Language^FactName^FactValue^
+                       ( kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue),
+                         Path \== '' ),
+                   Files).
+
+:- meta_predicate setof_or_empty(?, ^, -).
+setof_or_empty(Template, Goal, Set) :-
+    (  setof(Template, Goal, Set)
+    -> true
+    ;  Set = []
+    ).
+
+%! kythe_xref_postings(+Files:list, -XrefPostings:list) is det.
+% The cross-reference postings for the anchors in Files (see
+% file_xref_postings/2), which src_browser.pl uses for anchor_xref
+% requests instead of joining the anchors through their semantic
+% nodes. (This isn't concurrent: the facts are thread-local.)
+kythe_xref_postings(Files, XrefPostings) :-
+    maplist(file_xref_postings, Files, XrefPostingsList),
+    append(XrefPostingsList, XrefPostings).
+
+%! file_xref_postings(+File, -XrefPostings:list) is det.
+% For each edge between an anchor in File and a node that isn't an
+% anchor (usually a semantic node), a posting:
+%   xref_posting(Signature,Corpus,Root,Path,Language,  % the node
+%                Edge,  % from the anchor ('%'-prefixed if it's to the anchor)
+%                AnchorCorpus,AnchorRoot,AnchorPath, LineNo, Start,
+%                AnchorLanguage, AnchorSignature)
+% where LineNo (1-origin) is computed from the anchor's start (a byte
+% offset) and the file's /kythe/text.
+file_xref_postings(Corpus-Root-Path, XrefPostings) :-
+    findall(Start-anchor_edge(AnchorSignature, AnchorLanguage, Edge, Target),
+            file_anchor_edge(Corpus, Root, Path, Start,
+                             AnchorSignature, AnchorLanguage, Edge, Target),
+            AnchorEdges0),
+    keysort(AnchorEdges0, AnchorEdges),
+    pairs_keys(AnchorEdges, Starts),
+    (  kythe_node('',Corpus,Root,Path,_, '/kythe/text', Text)
+    -> atom_codes(Text, TextCodes),
+       phrase(utf8_codes(TextCodes), TextBytes)
+    ;  TextBytes = []
+    ),
+    offsets_linenos(Starts, TextBytes, LineNos),
+    maplist(xref_posting(Corpus, Root, Path), AnchorEdges, LineNos, XrefPostings).
+
+file_anchor_edge(Corpus, Root, Path, Start, AnchorSignature, AnchorLanguage, Edge,
+                 vname(Signature,Corpus2,Root2,Path2,Language2)) :-
+    kythe_node(AnchorSignature,Corpus,Root,Path,AnchorLanguage, '/kythe/node/kind', anchor),
+    kythe_node(AnchorSignature,Corpus,Root,Path,AnchorLanguage, '/kythe/loc/start', Start),
+    (  kythe_edge(AnchorSignature,Corpus,Root,Path,AnchorLanguage, Edge,
+                  Signature,Corpus2,Root2,Path2,Language2)
+    ;  kythe_edge(Signature,Corpus2,Root2,Path2,Language2, Edge0,
+                  AnchorSignature,Corpus,Root,Path,AnchorLanguage),
+       atom_concat('%', Edge0, Edge)
+    ),
+    \+ kythe_node(Signature,Corpus2,Root2,Path2,Language2, '/kythe/node/kind', anchor).
+
+xref_posting(Corpus, Root, Path,
+             Start-anchor_edge(AnchorSignature, AnchorLanguage, Edge,
+                               vname(Signature,Corpus2,Root2,Path2,Language2)),
+             LineNo,
+             xref_posting(Signature,Corpus2,Root2,Path2,Language2, Edge,
+                          Corpus,Root,Path, LineNo, Start, AnchorLanguage, AnchorSignature)).
+
+%! offsets_linenos(+Offsets:list(int), +Bytes:list(int), -LineNos:list(int)) is det.
+% LineNos are the (1-origin) line numbers of the byte Offsets (which
+% must be sorted) in Bytes.
+offsets_linenos(Offsets, Bytes, LineNos) :-
+    offsets_linenos(Offsets, Bytes, 0, 1, LineNos).
+
+offsets_linenos([], _Bytes, _Pos, _LineNo, []).
+offsets_linenos([Offset|Offsets], Bytes, Pos, LineNo, LineNos) :-
+    (  Pos < Offset,
+       Bytes = [Byte|Bytes2]
+    -> Pos2 is Pos + 1,
+       (  Byte == 0'\n
+       -> LineNo2 is LineNo + 1
+       ;  LineNo2 = LineNo
+       ),
+       offsets_linenos([Offset|Offsets], Bytes2, Pos2, LineNo2, LineNos)
+    ;  LineNos = [LineNo|LineNos2],
+       offsets_linenos(Offsets, Bytes, Pos, LineNo, LineNos2)
+    ).
+
+%! shard_format_version(-Version:int) is det.
+% The version of the shard files' contents; src_browser.pl checks it
+% when it reads a shard. It's also in the names of the converted files
+% (see converted_paths/4).
+shard_format_version(2).
+
+%! write_shards(+Opts, +Converted:list) is det.
+% Write the facts as shards in FilesDir/shards, using fast_write/2
+% (which is much faster to read than a .pl or .qlf file and can be
+% loaded into an existing dynamic predicate). The files' shards were
+% written by convert_kythe_file/4; this writes the global shard from
+% the converted files' global facts:
+%   <hash>.shard -- kythe_shard(Version, Facts) for one source file:
+%                   the kythe_node/7 facts with the file's path and
+%                   the kythe_edge/11 facts whose source has the
+%                   file's path (<hash> is from the corpus, root and
+%                   path).
+%   global.shard -- kythe_global_shard(Version, Facts) with the facts
+%                   that don't have a path (semantic nodes), plus:
+%                     shard_file(Corpus,Root,Path,Language, ShardName)
+%                       for each file (Language is '' if there's no
+%                       /kythe/language fact)
+%                     xref_posting/13 facts (see file_xref_postings/2),
+%                       so that an anchor's cross-references can be
+%                       found without loading the files' shards.
+write_shards(Opts, Converted) :-
+    memberchk(filesdir(FilesDir), Opts),
+    atomic_list_concat([FilesDir, shards], '/', ShardsDir),
+    make_directory_path(ShardsDir),
+    shard_format_version(Version),
+    converted_global_facts(Converted, SemanticFacts, ShardFiles, XrefPostings),
+    append([SemanticFacts, ShardFiles, XrefPostings], GlobalFacts),
+    length(ShardFiles, NumShardFiles),
+    length(SemanticFacts, NumSemanticFacts),
+    length(XrefPostings, NumXrefPostings),
+    log_if(true, 'Writing global shard (~d files): ~d semantic facts, ~d xref postings',
+           [NumShardFiles, NumSemanticFacts, NumXrefPostings]),
+    atomic_list_concat([ShardsDir, 'global.shard'], '/', GlobalShardPath),
+    write_shard(GlobalShardPath, kythe_global_shard(Version, GlobalFacts)).
+
+write_file_shard(ShardsDir, Version, Corpus-Root-Path,
+                 shard_file(Corpus,Root,Path,Language, ShardName)) :-
+    format(atom(CombinedPath), '~w/~w/~w', [Corpus, Root, Path]),
+    hash_hex(CombinedPath, Hex),
+    atom_concat(Hex, '.shard', ShardName),
+    (  kythe_node('',Corpus,Root,Path,_, '/kythe/language', Language)
+    -> true
+    ;  Language = ''
+    ),
+    findall(kythe_node(Signature,Corpus,Root,Path,Language1, FactName, FactValue),
+            kythe_node(Signature,Corpus,Root,Path,Language1, FactName, FactValue),
+            Nodes),
+    findall(kythe_edge(Signature1,Corpus,Root,Path,Language1, EdgeName,
+                       Signature2,Corpus2,Root2,Path2,Language2),
+            kythe_edge(Signature1,Corpus,Root,Path,Language1, EdgeName,
+                       Signature2,Corpus2,Root2,Path2,Language2),
+            Edges),
+    append(Nodes, Edges, Facts),
+    atomic_list_concat([ShardsDir, ShardName], '/', ShardPath),
+    write_shard(ShardPath, kythe_shard(Version, Facts)).
+
+write_shard(ShardPath, Shard) :-
+    write_fast_term(ShardPath, Shard).
+
+write_fast_term(Path, Term) :-
+    setup_call_cleanup(
+        open(Path, write, Stream, [type(binary)]),
+        fast_write(Stream, Term),
+        close(Stream)).
+
+read_fast_term(Path, Term) :-
+    setup_call_cleanup(
+        open(Path, read, Stream, [type(binary)]),
+        fast_read(Stream, Term),
+        close(Stream)).
 
 get_and_assert_kythe_facts(File) :-
     must_once(get_and_assert_kythe_facts_(File)).
 
 get_and_assert_kythe_facts_(File) :-
-    % TODO: use setup_call_cleanup/3
-    open(File, read, InStream, [encoding(utf8)]),
-    read_kythe_json_facts(InStream, KytheDicts),
-    close(InStream),
-    log_if(false, 'Read_kythe_json_facts-done ~q', [File]),
-    % TODO: base64/2 takes most of the CPU time (from b64_to_utf8_to_atom/2)
-    % TODO: slightly more efficient if kythe_fact_pred/3 is
-    %       moved into read_kythe_json_facts/2.
-    maplist(kythe_fact_pred(File), KytheDicts, Preds0),
+    read_kythe_preds(File, Preds0),
     log_if(false, 'Kythe_fact_pred-done ~q', [File]),
     sort(Preds0, Preds), % remove dups, although there shouldn't be any
     % log_if(false, 'Sort preds-done ~q', [File]),
@@ -105,6 +406,67 @@ retract_kythe_facts :-
     retractall(KytheNode),
     retractall(KytheEdge).
 
+%! read_kythe_preds(+File:atom, -Preds:list) is det.
+% Read the kythe_node/3 and kythe_edge/3 terms from a .kythe.entries
+% file (see kythe_entry_pred/3) or a .kythe.json file (see
+% kythe_fact_pred/3).
+read_kythe_preds(File, Preds) :-
+    (  file_name_extension(_, entries, File)
+    -> setup_call_cleanup(
+           open(File, read, InStream, [type(binary)]),
+           read_kythe_entries_preds(File, InStream, Preds),
+           close(InStream))
+    ;  setup_call_cleanup(
+           open(File, read, InStream, [encoding(utf8)]),
+           read_kythe_json_facts(InStream, KytheDicts),
+           close(InStream)),
+       log_if(false, 'Read_kythe_json_facts-done ~q', [File]),
+       % TODO: base64/2 takes most of the CPU time (from b64_to_utf8_to_atom/2)
+       % TODO: slightly more efficient if kythe_fact_pred/3 is
+       %       moved into read_kythe_json_facts/2.
+       maplist(kythe_fact_pred(File), KytheDicts, Preds)
+    ).
+
+read_kythe_entries_preds(File, InStream, Preds) :-
+    read_kythe_entry(InStream, Entry),
+    (  Entry == end_of_file
+    -> Preds = []
+    ;  Preds = [Pred|Preds2],
+       kythe_entry_pred(File, Entry, Pred),
+       read_kythe_entries_preds(File, InStream, Preds2)
+    ).
+
+%! kythe_entry_pred(+File:atom, +Entry, -Pred) is det.
+% Like kythe_fact_pred/3, but for an entry from
+% kythe_entries:read_kythe_entry/2, whose fact value is bytes (the
+% UTF-8 encoding of the value, or the file's contents for
+% /kythe/text) rather than base64.
+kythe_entry_pred(File, Entry, Pred) :-
+    must_once(kythe_entry_pred_(File, Entry, Pred)).
+
+kythe_entry_pred_(File, entry(Source0, '', none, FactName, FactValueBytes),
+                  kythe_node(Source1, FactName, FactValue)) :-
+    !,
+    entry_vname(Source0, Source1),
+    (  phrase(utf8_codes(FactValueCodes), FactValueBytes)
+    -> true
+    ;  % See the comment about invalid UTF-8 in kythe_fact_pred_/3.
+       log_if(true, 'Fact not UTF-8: ~q in ~q', [FactName, File]),
+       FactValueCodes = FactValueBytes
+    ),
+    atom_codes(FactValue0, FactValueCodes),
+    post_process_fact(FactName, FactValue0, FactValue).
+kythe_entry_pred_(_File, entry(Source0, EdgeKind, Target0, '/', _FactValue),
+                  kythe_edge(Source1, EdgeKind, Target1)) :-
+    !,
+    entry_vname(Source0, Source1),
+    entry_vname(Target0, Target1).
+kythe_entry_pred_(File, Entry, Entry) :-
+    domain_error(kythe_entry, File:Entry).
+
+entry_vname(json{signature:Signature, corpus:Corpus, root:Root, path:Path, language:Language},
+            vname(Signature, Corpus, Root, Path, Language)).
+
 read_kythe_json_facts(InStream, KytheDicts) :-
     json_read_dict(InStream, KytheDict,
                    [value_string_as(atom), end_of_file(@(end)), default_tag(json)]),
@@ -196,6 +558,9 @@ extract_opts(Opts) :-
     OptsSpec =
     [[opt(filesdir), type(atom), default('filesdir-must-be-specified'), longflags([filesdir]),
       help('Directory for putting the files\'s contents')
+     ],
+     [opt(sharded), type(boolean), default(false), longflags([sharded]),
+      help('Write per-file shards (for lazy loading by src_browser.pl) instead of kythe_facts.pl')
      ]],
     opt_arguments(OptsSpec, Opts, PositionalArgs),
     must_once_msg(PositionalArgs = [], 'Unknown positional arg(s)').
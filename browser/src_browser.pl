@@ -15,18 +15,28 @@
 
 % :- set_prolog_flag(autoload, false).  % TODO: Seems to break plunit, qsave
 
-:- use_module(library(lists), [append/3, member/2]).
+:- use_module(library(lists), [append/3, last/2, member/2, nth0/3, nth1/3]).
+:- use_module(library(utf8), [utf8_codes//1]).
 :- use_module(library(error), [must_be/2, domain_error/2]).
-:- use_module(library(pairs), [group_pairs_by_key/2, pairs_values/2]).
+:- use_module(library(pairs), [group_pairs_by_key/2, pairs_keys/2, pairs_values/2]).
 :- use_module(library(prolog_jiti), [jiti_list/1]).
-:- use_module(library(apply), [maplist/2, maplist/3, maplist/4, maplist/5]).
+:- use_module(library(apply), [exclude/3, foldl/4, include/3, maplist/2, maplist/3, maplist/4,
+                                maplist/5, partition/4]).
+:- use_module(library(ordsets), [ord_intersection/3]).
 :- use_module(library(thread), [concurrent_maplist/2]).
+:- use_module(library(thread_pool), [thread_pool_create/3, thread_pool_property/2]).
+:- use_module(library(time), [call_with_time_limit/2]).
 :- use_module(library(http/http_server), [http_server/1,
                                           http_read_json_dict/3,
                                           reply_json_dict/2, % TODO: Options=[status(201)]
                                           http_redirect/3
                                          ]).
 :- use_module(library(http/http_files), [http_reply_from_files/3]).
+:- use_module(library(http/http_parameters), [http_parameters/2]).
+:- use_module(library(http/json), [json_write_dict/3]).
+:- use_module(library(memfile), [new_memory_file/1, open_memory_file/4,
+                                 memory_file_to_string/3, free_memory_file/1]).
+:- use_module(library(zlib), [zopen/3]).
 % TODO: if using daemon, then: swipl src_browser.pl --port=.... --pidfile=/var/run/src_browser.pid
 %       and kill $(cat /var/run/src_browser.pid)
 % TODO: Support HTTPS: https://www.swi-prolog.org/pldoc/man?section=ssl-https-server
@@ -46,16 +56,151 @@
 :- use_module(library(uri)).
 :- use_module(library(debug)).
 :- use_module(library(optparse), [opt_arguments/3]).
-:- use_module(library(readutil), [read_file_to_string/3]).
+:- use_module(library(readutil), [read_file_to_string/3, read_file_to_terms/3]).
+:- use_module(library(fastrw), [fast_read/2, fast_write/2]).
 :- use_module(library(aggregate)). % TODO: do we use all of these?
 :- use_module(library(solution_sequences), [distinct/1, distinct/2, order_by/2, group_by/4]). % TODO: do we use all of these?
 :- use_module(library(yall)).   % For [S,A]>>atom_string(A,S) etc.
 :- use_module('../pykythe/must_once.pl').
 :- use_module('../pykythe/pykythe_utils.pl').
 
-% The "base" Kythe facts, which are dynamically loaded at start-up.
+% The "base" Kythe facts, which are dynamically loaded at start-up
+% (or, if kythe_json_to_prolog.pl wrote shards, as needed: see
+% ensure_shards_loaded/1).
 :- dynamic kythe_node/7, kythe_edge/11.
 
+% The sharded fact store (see kythe_json_to_prolog.pl write_shards/1):
+%   sharded_store(ShardsDir, MaxResidentShards) if the shards are used.
+%   shard_file/5 is from the global shard.
+%   resident_shard(Path, LastUse, Cells, Pinned) for each file whose
+%     facts are loaded, where LastUse is from the shard_clock flag
+%     (for LRU eviction), Cells is the size of its facts (from
+%     term_size/2) and Pinned is `pinned` for files whose facts came
+%     from reload_kythe_facts/2 (which are never evicted because
+%     their shard is out of date) or `unpinned`.
+%   shard_ref(Path, ThreadId) for each thread whose current request
+%     uses the facts for Path (see ensure_shards_loaded/1), so that
+%     they aren't evicted until the request is finished (see
+%     release_shard_refs/0).
+:- dynamic sharded_store/2, shard_file/5, resident_shard/4, shard_ref/2.
+
+% The cross-reference index (see index_xref_postings/0):
+%   xref_postings(Signature,Corpus,Root,Path,Language, Count, Postings)
+%     for each node that is linked to anchors, where Postings is a
+%     sorted list (by edge, file, line) of
+%       posting(Edge, Corpus,Root,Path, LineNo, Start, Language, Signature)
+%     for the anchors. It's made from the xref_posting/13 facts that
+%     kythe_json_to_prolog.pl outputs (see file_xref_postings/2 there).
+:- dynamic xref_posting/13, xref_postings/7.
+
+% The cache of src_browser_file responses (see file_response/7):
+%   file_response_cache(Corpus, Root, Path, LineStart, LineEnd,
+%                       Generation, ETag, GzipBytes)
+% where LineStart, LineEnd are the requested line range, Generation is the value of the kythe_facts_generation flag
+% when the response was made (reload_kythe_facts/2 increments it) and
+% GzipBytes is the gzip-compressed JSON (a string of octets).
+:- dynamic file_response_cache/8.
+
+% The src_file_tree responses (see index_file_tree/0), made once for
+% each facts generation:
+%   file_tree_response(Generation, Dir, ETag, GzipBytes)
+% where Dir is '' for the top of the tree or a directory's path (see
+% reply_src_file_tree/1) and GzipBytes is the gzip-compressed JSON.
+%   file_tree_lazy_files(NumFiles) from --file_tree_lazy_files.
+:- dynamic file_tree_response/4, file_tree_lazy_files/1.
+
+% The directory for /reload's facts files (see reload_facts_path/2):
+%   reload_dir(Dir) from --reload_dir.
+:- dynamic reload_dir/1.
+
+% The search index (see index_search/0):
+%   search_entry(Kind, Id, Key, Entry) where Kind is `symbol` or
+%     `line`, Key is the lower-case text that a query is matched
+%     against and Entry is one of:
+%       symbol(Signature,Corpus,Root,Path,Language, NumRefs, Defs)
+%         for a node that has a /kythe/edge/defines/binding anchor,
+%         where Defs are its (definition) postings (see
+%         xref_postings/7) and NumRefs is its number of postings.
+%       line(Corpus,Root,Path, LineNo, Text) for a source line (only
+%         if search_source_lines(true)).
+%   search_trigram(Kind, Trigram, Ids) with the (sorted) Ids of the
+%     entries whose Key contains Trigram.
+%   search_source_lines(SearchSourceLines) from --search_source_lines.
+:- dynamic search_entry/4, search_trigram/3, search_source_lines/1.
+
+% The progress of the start-up stages (see run_startup_stage/2), for
+% the /status request:
+%   startup_stage(Stage, Status, StartTime, EndTime) where Status is
+%   pending, running, done, skipped or failed(Error) and the times are
+%   from get_time/1 (0 if the stage hasn't started or ended).
+:- dynamic startup_stage/4.
+
+% Metrics, for the /metrics request:
+%   request_metric(Type, Count, Timeouts, Errors, TotalSeconds, MaxSeconds,
+%                  BucketCounts)
+%     for each request type (see timed_request/2), where Count,
+%     TotalSeconds, MaxSeconds and BucketCounts are for the requests
+%     that succeeded (BucketCounts has the number of requests for
+%     each bucket of latency_buckets/1, plus one for slower
+%     requests) and Timeouts, Errors are the numbers of requests that
+%     timed out or failed.
+%   cache_metric(Cache, Hits, Misses) for each cache (see
+%     record_cache/2).
+%   request_timeout(Seconds) from --request_timeout.
+:- dynamic request_metric/7, cache_metric/3, request_timeout/1.
+
+% The color items (see assert_color_table/5), one fact per item, with
+% the file's vname and the token_color names shared by all its items:
+%   color_file(FileId, Corpus, Root, Path, Language, Colors)
+%   color_item(FileId, Start, End, LineNo, Column, ColorCode, Value)
+% where ColorCode is a (0-origin) index into Colors. The JIT indexes
+% for color_item/7 are on FileId+Start and FileId+LineNo.
+:- dynamic color_file/6, color_item/7.
+
+% The color items' line index (see assert_color_table/5):
+%   color_line(Corpus, Root, Path, LineNo, Starts) with the start
+%     offsets of the color items on each line.
+%   file_num_lines(Corpus, Root, Path, NumLines)
+:- dynamic color_line/5, file_num_lines/4.
+
+%! prewarm_block_lines(-NumLines:int) is det.
+% The size of the line ranges for --prewarm_file_cache, which should
+% be the same as SRC_BLOCK_LINES in src_browser.js.
+prewarm_block_lines(500).
+
+%! default_xref_page_size(-PageSize:int) is det.
+% The number of anchors in an anchor_xref response, if the request
+% doesn't specify page_size.
+default_xref_page_size(200).
+
+%! max_xref_page_size(-PageSize:int) is det.
+% The largest page_size for an anchor_xref request (a larger one is
+% reduced to this; see request_page/5).
+max_xref_page_size(1000).
+
+%! startup_stages(-Stages:list(atom)) is det.
+% The start-up stages, in the order that they're run (see
+% src_browser_main2/0). Only load_facts and file_tree are done before
+% the server starts; the others are done in a background thread, and
+% a request that needs one of them waits for it (see
+% wait_for_startup_stage/1).
+startup_stages([load_facts, file_tree, xref_postings, search_index, jit_index,
+                prewarm_file_cache, validation]).
+
+%! latency_buckets(-UpperBounds:list(float)) is det.
+% The upper bounds (in seconds) of the buckets of the request latency
+% histograms (see record_request/3).
+latency_buckets([0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]).
+
+%! default_search_page_size(-PageSize:int) is det.
+% The number of results in a search response, if the request doesn't
+% specify page_size.
+default_search_page_size(50).
+
+%! max_search_page_size(-PageSize:int) is det.
+% The largest page_size for a search request (see request_page/5).
+max_search_page_size(500).
+
 % Convenience predicates for accessing the base Kythe facts,
 % using vname(Signature, Corpus, Root, Path, Language).
 % We also define vname0: Corpus, Root, Path, Language
@@ -196,8 +341,150 @@ src_browser_main2 :-
     browser_opts(Opts),
     % set_prolog_flag(verbose_file_search, true),
     assert_server_locations(Opts),
-    read_and_assert_kythe_facts,
-    server(Opts).
+    retractall(search_source_lines(_)),
+    assertz(search_source_lines(Opts.search_source_lines)),
+    retractall(reload_dir(_)),
+    assertz(reload_dir(Opts.reload_dir)),
+    retractall(file_tree_lazy_files(_)),
+    assertz(file_tree_lazy_files(Opts.file_tree_lazy_files)),
+    retractall(startup_stage(_, _, _, _)),
+    startup_stages(Stages),
+    forall(member(Stage, Stages),
+           assertz(startup_stage(Stage, pending, 0, 0))),
+    run_startup_stage(load_facts, read_and_assert_kythe_facts(Opts)),
+    run_startup_stage(file_tree, index_file_tree),
+    thread_create(background_startup(Opts), _, [detached(true)]),
+    server(Opts),
+    debug(log, 'Server started: to stop, enter ctrl-D or "halt." (including the ".")', []).
+
+%! background_startup(+Opts:dict) is det.
+% The start-up stages after load_facts (see startup_stages/1), which
+% are run while the server is handling requests. The JIT indexes
+% (index_kythe_facts/0) aren't needed for correctness (they're built
+% as needed anyway) and validation (validate_kythe_facts/0) is only
+% done with --validate (or a POST to /admin/validate).
+background_startup(Opts) :-
+    run_startup_stage(xref_postings, with_mutex(kythe_facts, index_xref_postings)),
+    run_startup_stage(search_index, with_mutex(kythe_facts, index_search)),
+    (  sharded_store(_ShardsDir, _MaxResidentShards)
+    -> skip_startup_stage(jit_index) % the facts are loaded as needed
+    ;  run_startup_stage(jit_index, index_kythe_facts)
+    ),
+    (  Opts.prewarm_file_cache == true
+    -> run_startup_stage(prewarm_file_cache, prewarm_file_responses)
+    ;  skip_startup_stage(prewarm_file_cache)
+    ),
+    (  Opts.validate == true
+    -> start_validation
+    ;  skip_startup_stage(validation)
+    ).
+
+:- meta_predicate run_startup_stage(+, 0).
+
+%! run_startup_stage(+Stage:atom, :Goal) is det.
+% Run Goal (once), recording its progress in startup_stage/4. An
+% error in Goal (or its failure) is logged and recorded as the
+% stage's status, but isn't passed on (so that the server can
+% continue).
+run_startup_stage(Stage, Goal) :-
+    get_time(T0),
+    set_startup_stage(Stage, running, T0, 0),
+    catch(( call(Goal)
+          -> Status = done
+          ;  Status = failed(goal_failed)
+          ),
+          Error,
+          Status = failed(Error)),
+    get_time(T1),
+    set_startup_stage(Stage, Status, T0, T1),
+    Seconds is T1 - T0,
+    debug(log, 'Start-up stage ~q: ~q (~3f sec)', [Stage, Status, Seconds]).
+
+skip_startup_stage(Stage) :-
+    set_startup_stage(Stage, skipped, 0, 0).
+
+%! set_startup_stage(+Stage:atom, +Status, +StartTime:float, +EndTime:float) is det.
+% Replace Stage's startup_stage/4 fact and wake the threads in
+% wait_for_startup_stage/1. The new fact is added before the old one
+% is removed, so that a waiting thread never sees Stage as not being
+% done.
+set_startup_stage(Stage, Status, StartTime, EndTime) :-
+    findall(Ref, clause(startup_stage(Stage, _, _, _), true, Ref), OldRefs),
+    assertz(startup_stage(Stage, Status, StartTime, EndTime)),
+    maplist(erase, OldRefs),
+    thread_update(true, []).
+
+%! wait_for_startup_stage(+Stage:atom) is det.
+% Wait until Stage has finished (or been skipped or failed), for a
+% request that needs it, for at most the time from --request_timeout
+% (if it's exceeded, the reply is "503 Service Unavailable"). Does
+% nothing if Stage isn't being done (e.g., in the tests).
+wait_for_startup_stage(Stage) :-
+    (  request_timeout(Timeout),
+       Timeout > 0
+    -> WaitOptions = [db(false), timeout(Timeout)]
+    ;  WaitOptions = [db(false)]
+    ),
+    (  thread_wait(startup_stage_finished(Stage), WaitOptions)
+    -> true
+    ;  format(string(Message), 'Start-up stage ~q took more than ~w seconds',
+              [Stage, Timeout]),
+       throw(http_reply(unavailable(Message)))
+    ).
+
+startup_stage_finished(Stage) :-
+    \+ (  startup_stage(Stage, Status, _StartTime, _EndTime),
+          ( Status == pending ; Status == running )
+       ).
+
+%! start_validation is det.
+% Start validate_kythe_facts/0 as the validation stage in a separate
+% thread, unless it's already running. Validation needs all the
+% facts, so it's skipped if the store is sharded.
+start_validation :-
+    with_mutex(startup_stage,
+               (  startup_stage(validation, running, _StartTime, _EndTime)
+               -> true
+               ;  sharded_store(_ShardsDir, _MaxResidentShards)
+               -> skip_startup_stage(validation)
+               ;  set_startup_stage(validation, pending, 0, 0),
+                  thread_create(run_startup_stage(validation, validate_kythe_facts), _,
+                                [detached(true)])
+               )).
+
+%! startup_status(-Status:dict) is det.
+% The progress of the start-up stages (see startup_stages/1), with
+% the time for each one so far; ready is true when no stage is
+% pending or running.
+startup_status(json{ready:Ready, stages:StagesJson}) :-
+    startup_stages(Stages),
+    get_time(Now),
+    findall(StageJson,
+            ( member(Stage, Stages),
+              startup_stage(Stage, Status, StartTime, EndTime),
+              startup_stage_json(Stage, Status, StartTime, EndTime, Now, StageJson) ),
+            StagesJson),
+    (  member(StageJson, StagesJson),
+       get_dict(status, StageJson, StatusName),
+       memberchk(StatusName, [pending, running])
+    -> Ready = false
+    ;  Ready = true
+    ).
+
+startup_stage_json(Stage, Status, StartTime, EndTime, Now,
+                   json{stage:Stage, status:StatusName, seconds:Seconds, error:ErrorStr}) :-
+    (  Status = failed(Error)
+    -> StatusName = failed,
+       format(string(ErrorStr), '~q', [Error])
+    ;  StatusName = Status,
+       ErrorStr = ''
+    ),
+    (  Status == pending
+    -> Seconds = 0
+    ;  Status == running
+    -> Seconds is Now - StartTime
+    ;  Seconds is EndTime - StartTime
+    ).
 
 % Not used -- a trivial REPL, in case prolog/0 or
 % '$toplevel':'$toplevel'/0 doesn't work.
@@ -230,6 +517,20 @@ assert_server_locations(Opts) :-
 % DO NOT SUBMIT:
 % TODO: move the read/assert stuff to a separate module,
 %       also the convenience preds (kythe_node/3, etc.)
+
+%! read_and_assert_kythe_facts(+Opts:dict) is det.
+% If the files dir has shards (kythe_json_to_prolog.pl --sharded),
+% load only the global shard; otherwise load all the facts from
+% kythe_facts.pl. This is all that's needed to view a file; the
+% indexes are built afterwards (see background_startup/1).
+read_and_assert_kythe_facts(Opts) :-
+    atomic_list_concat([Opts.filesdir, shards], '/', ShardsDir),
+    atomic_list_concat([ShardsDir, 'global.shard'], '/', GlobalShardPath),
+    (  exists_file(GlobalShardPath)
+    -> load_global_shard(ShardsDir, Opts.max_resident_shards)
+    ;  read_and_assert_kythe_facts
+    ).
+
 read_and_assert_kythe_facts :-
     % TODO: open an issue about this (need to have an empty .qlf file to force
     %       saving the compiled facts)
@@ -246,27 +547,123 @@ read_and_assert_kythe_facts :-
                [silent(false),
                 optimise(true),
                 imports([kythe_node/7,
-                         kythe_edge/11])]),
-    index_kythe_facts,
-    forall(retract(kythe_node(Signature, Corpus,Root,Path,Language, '/pykythe/color', ColorTermStr)),
-           assert_color_items(Signature, Corpus,Root,Path,Language, ColorTermStr)),
-    thread_create(validate_kythe_facts, _, [detached(true)]).
-
-assert_color_items(Signature, Corpus,Root,Path,Language, ColorTermStr) :-
-    term_string(ColorTerm, ColorTermStr),
-    dict_pairs(ColorTerm, color, ColorPairs0),
-    adjust_color(Corpus,Root,Path,Language, ColorPairs0, ColorPairs),
-    % TODO: There are more color items than anything else -- need to
-    %       use a more compact representation, especially as there is
-    %       no need for lookup on most of the fields.
-    maplist(assert_color_item(Signature, Corpus,Root,Path,Language), ColorPairs).
-
-adjust_color(Corpus,Root,Path,Language, ColorPairs0, ColorPairs) :-
+                         kythe_edge/11,
+                         xref_posting/13])]),
+    forall(retract(kythe_node(_Signature, Corpus,Root,Path,Language, '/pykythe/color_table', ColorTableStr)),
+           assert_color_table(Corpus,Root,Path,Language, ColorTableStr)),
+    log_color_stats.
+
+%! log_color_stats is det.
+% Log the number of color items and their size (from term_size/2),
+% compared with the size of the previous representation (a
+% kythe_node/7 fact for each of lineno, column, start, end,
+% token_color, value).
+log_color_stats :-
+    aggregate_all(count, color_item(_, _, _, _, _, _, _), NumItems),
+    aggregate_all(sum(Cells),
+                  ( color_item(FileId, Start, End, LineNo, Column, ColorCode, Value),
+                    term_size(color_item(FileId, Start, End, LineNo, Column, ColorCode, Value),
+                              Cells) ),
+                  ItemCells),
+    term_size(kythe_node('#0', corpus, root, path, language, '/pykythe/color/value', value),
+              KytheNodeCells),
+    KytheNodesCells is NumItems * 6 * KytheNodeCells,
+    debug(log, 'Color items: ~D (~D cells; ~D cells as kythe_node/7 facts)',
+          [NumItems, ItemCells, KytheNodesCells]).
+
+%! assert_color_table(+Corpus, +Root, +Path, +Language, +ColorTableStr) is det.
+% Decode a /pykythe/color_table fact (see pykythe.pl kyfact_color_table//1
+% and color_table/2) into color items and assert them (color_file/6,
+% color_item/7 and the line index). The token values are extracted
+% from the file's contents (/kythe/text), using the start and end
+% offsets (which are in bytes).
+% TODO: if the file contents aren't valid UTF-8, kythe_json_to_prolog
+%       leaves /kythe/text as bytes, so the offsets here will be wrong.
+assert_color_table(Corpus,Root,Path,Language, ColorTableStr) :-
+    term_string(color_table(Colors0, StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes),
+                ColorTableStr),
+    must_once(once(kythe_node(_, Corpus,Root,Path,_, '/kythe/text', Text))),
+    atom_codes(Text, TextCodes),
+    phrase(utf8_codes(TextCodes), TextBytes),
+    % adjust_color_code/6 can change '<PUNCTUATION>' to '<PUNCTUATION_REF>'
+    (  memberchk('<PUNCTUATION_REF>', Colors0)
+    -> Colors = Colors0
+    ;  append(Colors0, ['<PUNCTUATION_REF>'], Colors)
+    ),
+    (  nth0(PunctuationCode, Colors, '<PUNCTUATION>')
+    -> true
+    ;  PunctuationCode = -1
+    ),
+    nth0(PunctuationRefCode, Colors, '<PUNCTUATION_REF>'),
+    flag(color_file_id, FileId, FileId + 1),
+    assertz(color_file(FileId, Corpus,Root,Path,Language, Colors)),
+    assert_color_rows(StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes,
+                      FileId, vname0(Corpus,Root,Path,Language),
+                      punctuation(PunctuationCode, PunctuationRefCode),
+                      color_state(0, 1, 0, TextBytes), LineStarts),
+    assert_color_lines(Corpus, Root, Path, LineStarts).
+
+%! assert_color_rows(+StartDeltas, +Lengths, +LinenoDeltas, +Columns, +ColorCodes, +FileId, +Vname0, +Punctuation, +State, -LineStarts) is det.
+% State is color_state(PrevEnd, PrevLineno, BytesPos, Bytes), where
+% Bytes is the remainder of the file's contents starting at offset
+% BytesPos. LineStarts is a list of LineNo-Start for the color items
+% (in order).
+assert_color_rows([], [], [], [], [], _FileId, _Vname0, _Punctuation, _State, []).
+assert_color_rows([StartDelta|StartDeltas], [Length|Lengths], [LinenoDelta|LinenoDeltas],
+                  [Column|Columns], [ColorCode0|ColorCodes],
+                  FileId, Vname0, Punctuation,
+                  color_state(PrevEnd, PrevLineno, BytesPos0, Bytes0),
+                  [Lineno-Start|LineStarts]) :-
+    Start is PrevEnd + StartDelta,
+    End is Start + Length,
+    Lineno is PrevLineno + LinenoDelta,
+    text_bytes_slice(Start, Length, BytesPos0, Bytes0, BytesPos, Bytes, ValueBytes),
+    phrase(utf8_codes(ValueCodes), ValueBytes),
+    atom_codes(Value, ValueCodes),
+    adjust_color_code(Vname0, Punctuation, Start, End, ColorCode0, ColorCode),
+    assertz(color_item(FileId, Start, End, Lineno, Column, ColorCode, Value)),
+    assert_color_rows(StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes,
+                      FileId, Vname0, Punctuation,
+                      color_state(End, Lineno, BytesPos, Bytes), LineStarts).
+
+%! assert_color_lines(+Corpus, +Root, +Path, +LineStarts:list) is det.
+% Assert the line index (color_line/5, file_num_lines/4) from the
+% LineNo-Start pairs (which are in order) for the color items.
+assert_color_lines(Corpus, Root, Path, LineStarts) :-
+    group_pairs_by_key(LineStarts, LineStartsGrouped),
+    % sort/2 removes duplicates (zero-length items, such as a DEDENT,
+    % have the same start as the following item).
+    forall(member(LineNo-Starts0, LineStartsGrouped),
+           ( sort(Starts0, Starts),
+             assertz(color_line(Corpus, Root, Path, LineNo, Starts)) )),
+    (  last(LineStartsGrouped, NumLines-_)
+    -> true
+    ;  NumLines = 0
+    ),
+    assertz(file_num_lines(Corpus, Root, Path, NumLines)).
+
+%! text_bytes_slice(+Start, +Length, +BytesPos0, +Bytes0, -BytesPos, -Bytes, -Slice) is det.
+% Get Length bytes starting at Start, where Bytes0 are the bytes
+% starting at offset BytesPos0. The color items are in order and
+% contiguous, so this typically skips nothing (and Start is never
+% before BytesPos0).
+text_bytes_slice(Start, Length, BytesPos0, Bytes0, BytesPos, Bytes, Slice) :-
+    must_once(Start >= BytesPos0),
+    Skip is Start - BytesPos0,
+    length(SkipBytes, Skip),
+    append(SkipBytes, Bytes1, Bytes0),
+    length(Slice, Length),
+    append(Slice, Bytes, Bytes1),
+    BytesPos is Start + Length.
+
+%! adjust_color_code(+Vname0, +Punctuation, +Start, +End, +ColorCode0, -ColorCode) is det.
+% Punctuation that is an anchor (e.g., "." in an attribute reference)
+% is colored as '<PUNCTUATION_REF>'.
+adjust_color_code(vname0(Corpus,Root,Path,Language),
+                  punctuation(PunctuationCode, PunctuationRefCode),
+                  Start, End, ColorCode0, ColorCode) :-
     % NOTE: assumes that kythe_node/7 facts have already been asserted
-    % [column-0,end-3,lineno-1,start-0,token_color-'<VAR_BINDING>',value-loc]
-    (  select(token_color-'<PUNCTUATION>', ColorPairs0, ColorPairs1),
-       memberchk(start-Start, ColorPairs1),
-       memberchk(end-End, ColorPairs1),
+    (  ColorCode0 == PunctuationCode,
        AnchorPunctuation = vname(_, Corpus,Root,Path,Language),
        AnchorSemantic = vname(_, Corpus,Root,Path,Language),
        kythe_node(AnchorPunctuation, '/kythe/loc/start', Start),
@@ -274,14 +671,541 @@ adjust_color(Corpus,Root,Path,Language, ColorPairs0, ColorPairs) :-
        ( kythe_node(AnchorSemantic, '/kythe/node/kind', 'anchor')
        ; kythe_edge(AnchorSemantic, '/kythe/edge/tagged', _)
        )
-    -> ColorPairs = [token_color-'<PUNCTUATION_REF>'|ColorPairs1]
-    ;  ColorPairs = ColorPairs0
+    -> ColorCode = PunctuationRefCode
+    ;  ColorCode = ColorCode0
+    ).
+
+%! load_global_shard(+ShardsDir:atom, +MaxResidentShards:int) is det.
+% Load the global shard (semantic nodes, shard_file/5, xref_posting/13)
+% and set up sharded_store/2, so that the files' shards are loaded by
+% ensure_shards_loaded/1. The JIT indexes are built as the facts are
+% used, and there's no validation (validate_kythe_facts/0 needs all
+% the facts). The xref_posting/13 facts are indexed afterwards (see
+% background_startup/1).
+load_global_shard(ShardsDir, MaxResidentShards) :-
+    get_time(T0),
+    retractall(sharded_store(_, _)),
+    retractall(resident_shard(_, _, _, _)),
+    retractall(shard_ref(_, _)),
+    retractall(shard_file(_, _, _, _, _)),
+    atomic_list_concat([ShardsDir, 'global.shard'], '/', GlobalShardPath),
+    read_shard(GlobalShardPath, kythe_global_shard(Version, Facts)),
+    validate_shard_version(GlobalShardPath, Version),
+    maplist(assertz, Facts),
+    assertz(sharded_store(ShardsDir, MaxResidentShards)),
+    get_time(T1),
+    Seconds is T1 - T0,
+    aggregate_all(count, shard_file(_, _, _, _, _), NumFiles),
+    term_size(Facts, Cells),
+    debug(log, 'Loaded global shard (~d files, ~D cells) in ~3f sec; max resident shards: ~d',
+          [NumFiles, Cells, Seconds, MaxResidentShards]).
+
+%! shard_format_version(-Version:int) is det.
+% Must be the same as in kythe_json_to_prolog.pl.
+shard_format_version(2).
+
+validate_shard_version(ShardPath, Version) :-
+    shard_format_version(ExpectedVersion),
+    must_once_msg(Version == ExpectedVersion,
+                  'Shard ~q has version ~q (expecting ~q): rerun kythe_json_to_prolog.pl',
+                  [ShardPath, Version, ExpectedVersion]).
+
+read_shard(ShardPath, Shard) :-
+    setup_call_cleanup(
+        open(ShardPath, read, ShardStream, [type(binary)]),
+        fast_read(ShardStream, Shard),
+        close(ShardStream)).
+
+%! ensure_shards_loaded(+Paths:list(atom)) is det.
+% Make sure that the facts for the files in Paths are loaded (does
+% nothing if the store isn't sharded). Files that don't have a shard
+% (e.g., '' for semantic nodes) are ignored. The shards in Paths are
+% referenced by the current thread (see shard_ref/2) until
+% release_shard_refs/0, which timed_request/2 calls when the request
+% is finished. The least recently used shards are evicted if there
+% are more than MaxResidentShards, except for the referenced shards
+% (which are in use by this or a concurrent request), so the number
+% of resident shards can temporarily be more than the maximum.
+ensure_shards_loaded(Paths) :-
+    (  sharded_store(ShardsDir, MaxResidentShards)
+    -> thread_self(ThreadId),
+       with_mutex(kythe_facts,
+                  ( maplist(ensure_shard_loaded(ShardsDir, ThreadId), Paths),
+                    evict_shards(MaxResidentShards) ))
+    ;  true
+    ).
+
+%! release_shard_refs is det.
+% Remove the current thread's references to shards (see
+% ensure_shards_loaded/1), so that they can be evicted.
+release_shard_refs :-
+    thread_self(ThreadId),
+    with_mutex(kythe_facts,
+               retractall(shard_ref(_, ThreadId))).
+
+:- meta_predicate with_shard_refs(0).
+
+%! with_shard_refs(:Goal) is semidet.
+% Call Goal (once) and then release_shard_refs/0.
+with_shard_refs(Goal) :-
+    setup_call_cleanup(true, once(Goal), release_shard_refs).
+
+ensure_shard_loaded(ShardsDir, ThreadId, Path) :-
+    (  shard_ref(Path, ThreadId)
+    -> true
+    ;  assertz(shard_ref(Path, ThreadId))
+    ),
+    flag(shard_clock, LastUse, LastUse + 1),
+    (  retract(resident_shard(Path, _LastUse, Cells, Pinned))
+    -> record_cache(shard, hit),
+       assertz(resident_shard(Path, LastUse, Cells, Pinned))
+    ;  shard_file(_Corpus, _Root, Path, _Language, ShardName),
+       ShardName \== ''
+    -> record_cache(shard, miss),
+       load_shard(ShardsDir, Path, ShardName),
+       path_facts_cells(Path, Cells),
+       assertz(resident_shard(Path, LastUse, Cells, unpinned)),
+       aggregate_all(count, resident_shard(_, _, _, _), NumResident),
+       debug(log, 'Loaded shard for ~q: ~D cells (~d resident)', [Path, Cells, NumResident])
+    ;  true
+    ).
+
+load_shard(ShardsDir, Path, ShardName) :-
+    atomic_list_concat([ShardsDir, ShardName], '/', ShardPath),
+    read_shard(ShardPath, kythe_shard(Version, Facts)),
+    validate_shard_version(ShardPath, Version),
+    maplist(assertz, Facts),
+    forall(retract(kythe_node(_Signature, Corpus,Root,Path,Language,
+                              '/pykythe/color_table', ColorTableStr)),
+           assert_color_table(Corpus,Root,Path,Language, ColorTableStr)).
+
+%! path_facts_cells(+Path:atom, -Cells:int) is det.
+% The size of the facts for Path, as term_size/2 cells (this
+% approximates the memory used by the clauses).
+path_facts_cells(Path, Cells) :-
+    findall(Fact, path_fact(Path, Fact), Facts),
+    term_size(Facts, Cells).
+
+path_fact(Path, kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue)) :-
+    kythe_node(Signature,Corpus,Root,Path,Language, FactName, FactValue).
+path_fact(Path, kythe_edge(Signature1,Corpus1,Root1,Path,Language1, EdgeName,
+                           Signature2,Corpus2,Root2,Path2,Language2)) :-
+    kythe_edge(Signature1,Corpus1,Root1,Path,Language1, EdgeName,
+               Signature2,Corpus2,Root2,Path2,Language2).
+path_fact(Path, color_line(Corpus,Root,Path, LineNo, Starts)) :-
+    color_line(Corpus,Root,Path, LineNo, Starts).
+path_fact(Path, color_item(FileId, Start, End, LineNo, Column, ColorCode, Value)) :-
+    color_file(FileId, _Corpus,_Root,Path,_Language, _Colors),
+    color_item(FileId, Start, End, LineNo, Column, ColorCode, Value).
+
+%! evict_shards(+MaxResidentShards:int) is det.
+% Evict the least recently used shards that aren't pinned or
+% referenced (see shard_ref/2), until there are at most
+% MaxResidentShards (if possible).
+evict_shards(MaxResidentShards) :-
+    aggregate_all(count, resident_shard(_, _, _, _), NumResident),
+    NumEvict is NumResident - MaxResidentShards,
+    (  NumEvict > 0
+    -> findall(LastUse-Path,
+               ( resident_shard(Path, LastUse, _Cells, unpinned),
+                 \+ shard_ref(Path, _) ),
+               Evictable0),
+       keysort(Evictable0, Evictable),
+       pairs_values(Evictable, EvictablePaths),
+       (  length(EvictPaths, NumEvict),
+          append(EvictPaths, _, EvictablePaths)
+       -> true
+       ;  EvictPaths = EvictablePaths
+       ),
+       maplist(evict_shard, EvictPaths)
+    ;  true
+    ).
+
+evict_shard(Path) :-
+    retract(resident_shard(Path, _LastUse, Cells, _Pinned)),
+    retract_path_facts(Path),
+    debug(log, 'Evicted shard for ~q: ~D cells', [Path, Cells]).
+
+%! shard_stats(-Stats:dict) is det.
+% Memory used by the resident shards, most recently used first.
+shard_stats(json{sharded:Sharded, max_resident:MaxResidentShards,
+                 num_resident:NumResident, total_cells:TotalCells,
+                 bytes_per_cell:BytesPerCell,
+                 shards:ShardsJson}) :-
+    (  sharded_store(_ShardsDir, MaxResidentShards)
+    -> Sharded = true
+    ;  Sharded = false,
+       MaxResidentShards = 0
+    ),
+    current_prolog_flag(address_bits, AddressBits),
+    BytesPerCell is AddressBits // 8,
+    findall(NegLastUse-json{path:Path, last_use:LastUse, cells:Cells, pinned:Pinned},
+            ( resident_shard(Path, LastUse, Cells, Pinned),
+              NegLastUse is -LastUse ),
+            Shards0),
+    keysort(Shards0, Shards),
+    pairs_values(Shards, ShardsJson),
+    length(ShardsJson, NumResident),
+    aggregate_all(sum(Cells), resident_shard(_, _, Cells, _), TotalCells).
+
+%! index_xref_postings is det.
+% Replace the xref_posting/13 facts by xref_postings/7 (one sorted
+% list for each node), so that an anchor_xref request can get a page
+% of cross-references (and their total count) without joining the
+% anchors through their semantic nodes.
+index_xref_postings :-
+    get_time(T0),
+    retractall(xref_postings(_, _, _, _, _, _, _)),
+    findall(Node-Posting, retract_xref_posting(Node, Posting), NodePostings0),
+    keysort(NodePostings0, NodePostings),
+    group_pairs_by_key(NodePostings, NodePostingsGrouped),
+    maplist(assert_xref_postings, NodePostingsGrouped),
+    get_time(T1),
+    Seconds is T1 - T0,
+    length(NodePostings, NumPostings),
+    length(NodePostingsGrouped, NumNodes),
+    debug(log, 'Indexed ~D xref postings for ~D nodes in ~3f sec',
+          [NumPostings, NumNodes, Seconds]).
+
+retract_xref_posting(Node, Posting) :-
+    retract(xref_posting(Signature,Corpus,Root,Path,Language, Edge,
+                         AnchorCorpus,AnchorRoot,AnchorPath, LineNo, Start,
+                         AnchorLanguage, AnchorSignature)),
+    xref_posting_pair(xref_posting(Signature,Corpus,Root,Path,Language, Edge,
+                                   AnchorCorpus,AnchorRoot,AnchorPath, LineNo, Start,
+                                   AnchorLanguage, AnchorSignature),
+                      Node-Posting).
+
+xref_posting_pair(xref_posting(Signature,Corpus,Root,Path,Language, Edge,
+                               AnchorCorpus,AnchorRoot,AnchorPath, LineNo, Start,
+                               AnchorLanguage, AnchorSignature),
+                  vname(Signature,Corpus,Root,Path,Language)-
+                  posting(Edge, AnchorCorpus,AnchorRoot,AnchorPath, LineNo, Start,
+                          AnchorLanguage, AnchorSignature)).
+
+assert_xref_postings(vname(Signature,Corpus,Root,Path,Language)-Postings0) :-
+    sort(Postings0, Postings),
+    length(Postings, Count),
+    (  Count > 0
+    -> assertz(xref_postings(Signature,Corpus,Root,Path,Language, Count, Postings))
+    ;  true
+    ).
+
+%! update_xref_postings(+Paths:list(atom), +XrefPostings:list) is det.
+% Replace the postings for anchors in Paths by XrefPostings (a list of
+% xref_posting/13 terms), for reload_kythe_facts/2.
+% TODO: this scans all the postings to find the nodes with anchors in
+%       Paths.
+update_xref_postings(Paths, XrefPostings) :-
+    maplist(xref_posting_pair, XrefPostings, NewNodePostings0),
+    keysort(NewNodePostings0, NewNodePostings),
+    group_pairs_by_key(NewNodePostings, NewNodePostingsGrouped),
+    findall(vname(Signature,Corpus,Root,Path,Language),
+            ( xref_postings(Signature,Corpus,Root,Path,Language, _Count, Postings),
+              once(( member(posting(_,_,_,AnchorPath,_,_,_,_), Postings),
+                     memberchk(AnchorPath, Paths) )) ),
+            OldNodes),
+    pairs_keys(NewNodePostingsGrouped, NewNodes),
+    append(OldNodes, NewNodes, Nodes0),
+    sort(Nodes0, Nodes),
+    forall(member(Node, Nodes),
+           update_node_xref_postings(Paths, NewNodePostingsGrouped, Node)).
+
+update_node_xref_postings(Paths, NewNodePostingsGrouped, vname(Signature,Corpus,Root,Path,Language)) :-
+    (  retract(xref_postings(Signature,Corpus,Root,Path,Language, _Count, OldPostings0))
+    -> exclude(posting_in_paths(Paths), OldPostings0, OldPostings)
+    ;  OldPostings = []
+    ),
+    (  memberchk(vname(Signature,Corpus,Root,Path,Language)-NewPostings, NewNodePostingsGrouped)
+    -> true
+    ;  NewPostings = []
+    ),
+    append(OldPostings, NewPostings, Postings),
+    assert_xref_postings(vname(Signature,Corpus,Root,Path,Language)-Postings).
+
+posting_in_paths(Paths, posting(_Edge, _Corpus,_Root,Path, _LineNo, _Start, _Language, _Signature)) :-
+    memberchk(Path, Paths).
+
+%! anchor_xref_postings(+AnchorVname, -Postings:list) is det.
+% The (sorted) postings for all the nodes that AnchorVname is linked
+% to; usually there's only one such node, so there's no need to sort.
+anchor_xref_postings(AnchorVname, Postings) :-
+    findall(Node, anchor_xref_node(AnchorVname, Node), Nodes0),
+    sort(Nodes0, Nodes),
+    (  Nodes = [vname(Signature,Corpus,Root,Path,Language)]
+    -> (  xref_postings(Signature,Corpus,Root,Path,Language, _Count, Postings)
+       -> true
+       ;  Postings = []
+       )
+    ;  findall(Posting,
+               ( member(vname(Signature,Corpus,Root,Path,Language), Nodes),
+                 xref_postings(Signature,Corpus,Root,Path,Language, _Count, NodePostings),
+                 member(Posting, NodePostings) ),
+               Postings0),
+       sort(Postings0, Postings)
     ).
 
-assert_color_item(Signature, Corpus,Root,Path,Language, Key-Value) :-
-    % Key: lineno, column, start, end, token_color, value
-    atomic_list_concat(['/pykythe/color/', Key], FactName),
-    assertz(kythe_node(Signature, Corpus,Root,Path,Language, FactName, Value)).
+anchor_xref_node(AnchorVname, Node) :-
+    kythe_edge(AnchorVname, _Edge, Node),
+    \+ kythe_node(Node, '/kythe/node/kind', 'anchor').
+
+%! list_page(+List:list, +PageStart:int, +PageSize:int, -Page:list) is det.
+list_page(List, PageStart, PageSize, Page) :-
+    length(List, Length),
+    Skip is min(max(PageStart, 0), Length),
+    Take is min(max(PageSize, 0), Length - Skip),
+    length(Skipped, Skip),
+    append(Skipped, Rest, List),
+    length(Page, Take),
+    append(Page, _, Rest).
+
+%! index_search is det.
+% Build the search index (search_entry/4, search_trigram/3) for the
+% symbols (from the xref_postings/7 facts, so it doesn't need the
+% files' shards) and, if search_source_lines(true), for the source
+% lines (from the /kythe/text facts, so it isn't possible if the store
+% is sharded).
+index_search :-
+    get_time(T0),
+    findall(Key-Entry, search_symbol(Key, Entry), SymbolKeyEntries),
+    index_search_entries(symbol, SymbolKeyEntries),
+    (  search_source_lines(true)
+    -> (  sharded_store(_ShardsDir, _MaxResidentShards)
+       -> debug(log, 'Source lines aren\'t searchable in a sharded store', []),
+          LineKeyEntries = []
+       ;  findall(Key-Entry, search_line(Key, Entry), LineKeyEntries)
+       )
+    ;  LineKeyEntries = []
+    ),
+    index_search_entries(line, LineKeyEntries),
+    get_time(T1),
+    Seconds is T1 - T0,
+    length(SymbolKeyEntries, NumSymbols),
+    length(LineKeyEntries, NumLines),
+    aggregate_all(count, search_trigram(_, _, _), NumTrigrams),
+    debug(log, 'Indexed ~D symbols and ~D lines for search (~D trigrams) in ~3f sec',
+          [NumSymbols, NumLines, NumTrigrams, Seconds]).
+
+search_symbol(Key, symbol(Signature,Corpus,Root,Path,Language, NumRefs, Defs)) :-
+    xref_postings(Signature,Corpus,Root,Path,Language, NumRefs, Postings),
+    include(definition_posting, Postings, Defs),
+    Defs \== [],
+    downcase_atom(Signature, Key).
+
+definition_posting(posting('/kythe/edge/defines/binding', _Corpus,_Root,_Path,
+                           _LineNo, _Start, _Language, _Signature)).
+
+search_line(Key, line(Corpus,Root,Path, LineNo, Line)) :-
+    kythe_node('',Corpus,Root,Path,_Language, '/kythe/text', Text),
+    split_string(Text, "\n", "", LineStrs),
+    nth1(LineNo, LineStrs, LineStr),
+    \+ split_string(LineStr, "", " \t\r\f", [""]), % skip blank lines
+    atom_string(Line, LineStr),
+    downcase_atom(Line, Key).
+
+%! index_search_entries(+Kind, +KeyEntries:list(pair)) is det.
+% Replace the search index entries of Kind by KeyEntries, with their
+% trigrams.
+index_search_entries(Kind, KeyEntries) :-
+    retractall(search_entry(Kind, _, _, _)),
+    retractall(search_trigram(Kind, _, _)),
+    foldl(assert_search_entry(Kind), KeyEntries, 0, _NumEntries),
+    findall(Trigram-Id,
+            ( search_entry(Kind, Id, Key, _Entry),
+              key_trigram(Key, Trigram) ),
+            TrigramIds0),
+    sort(TrigramIds0, TrigramIds),
+    group_pairs_by_key(TrigramIds, TrigramIdsGrouped),
+    forall(member(Trigram-Ids, TrigramIdsGrouped),
+           assertz(search_trigram(Kind, Trigram, Ids))).
+
+assert_search_entry(Kind, Key-Entry, Id0, Id) :-
+    Id is Id0 + 1,
+    assertz(search_entry(Kind, Id, Key, Entry)).
+
+key_trigram(Key, Trigram) :-
+    sub_atom(Key, _, 3, _, Trigram).
+
+%! search_entries(+Kind, +Query, +Match, -Entries:list) is det.
+% The entries of Kind whose key contains Query (case-insensitive), in
+% rank order (see search_rank/5). If Match is `prefix`, only entries
+% that have a prefix match are included (for a symbol, its name or
+% its FQN starts with Query; for a line, its text after indentation
+% does). A query with at least 3 characters is answered from the
+% trigram index, by intersecting the Ids for its trigrams (smallest
+% first) and checking the candidates; a shorter query scans all the
+% entries.
+search_entries(Kind, Query, Match, Entries) :-
+    downcase_atom(Query, Key),
+    atom_length(Key, KeyLength),
+    (  KeyLength >= 3
+    -> findall(Length-Ids,
+               ( distinct(Trigram, key_trigram(Key, Trigram)),
+                 (  search_trigram(Kind, Trigram, Ids)
+                 -> true
+                 ;  Ids = []
+                 ),
+                 length(Ids, Length) ),
+               LengthIdsList0),
+       keysort(LengthIdsList0, LengthIdsList),
+       pairs_values(LengthIdsList, [Ids0|IdsList]),
+       foldl([Ids1, Ids2, Ids3]>>ord_intersection(Ids2, Ids1, Ids3), IdsList, Ids0, CandidateIds),
+       findall(Rank-Entry,
+               ( member(Id, CandidateIds),
+                 search_entry(Kind, Id, EntryKey, Entry),
+                 search_match(Kind, Key, Match, EntryKey, Entry, Rank) ),
+               RankEntries0)
+    ;  KeyLength > 0
+    -> findall(Rank-Entry,
+               ( search_entry(Kind, _Id, EntryKey, Entry),
+                 search_match(Kind, Key, Match, EntryKey, Entry, Rank) ),
+               RankEntries0)
+    ;  RankEntries0 = []
+    ),
+    keysort(RankEntries0, RankEntries),
+    pairs_values(RankEntries, Entries).
+
+search_match(Kind, Key, Match, EntryKey, Entry, Rank) :-
+    once(sub_atom(EntryKey, Before, _, _, Key)),
+    search_rank(Kind, Key, Before, EntryKey, Entry, Rank),
+    (  Match == prefix
+    -> search_prefix_rank(Kind, Rank)
+    ;  true
+    ).
+
+%! search_rank(+Kind, +Key, +Before:int, +EntryKey, +Entry, -Rank) is det.
+% Rank is a term whose standard order is the order of the results
+% (Before is the offset of the first match of Key in EntryKey). For a
+% symbol, the match's quality is: 0 if its name (the last component
+% of its FQN) is Key; 1 if its name starts with Key; 2 if its FQN
+% starts with Key; 3 otherwise. Symbols with the same match quality
+% are ordered by number of references (most first), then by FQN. For
+% a line, the match's quality is 0 if the line (after indentation)
+% starts with Key, 1 otherwise, and then the order is by file and
+% line.
+search_rank(symbol, Key, Before, EntryKey,
+            symbol(Signature,_Corpus,_Root,_Path,_Language, NumRefs, _Defs),
+            rank(Quality, NegNumRefs, EntryLength, Signature)) :-
+    atomic_list_concat(Components, '.', EntryKey),
+    last(Components, Name),
+    (  Name == Key
+    -> Quality = 0
+    ;  sub_atom(Name, 0, _, _, Key)
+    -> Quality = 1
+    ;  Before == 0
+    -> Quality = 2
+    ;  Quality = 3
+    ),
+    NegNumRefs is -NumRefs,
+    atom_length(EntryKey, EntryLength).
+search_rank(line, _Key, Before, EntryKey,
+            line(Corpus,Root,Path, LineNo, _Line),
+            rank(Quality, Corpus, Root, Path, LineNo)) :-
+    sub_atom(EntryKey, 0, Before, _, Indentation),
+    (  split_string(Indentation, "", " \t\f", [""])
+    -> Quality = 0
+    ;  Quality = 1
+    ).
+
+search_prefix_rank(symbol, rank(Quality, _NegNumRefs, _EntryLength, _Signature)) :-
+    Quality =< 2.
+search_prefix_rank(line, rank(0, _Corpus, _Root, _Path, _LineNo)).
+
+search_entry_json(symbol(Signature,Corpus,Root,Path,Language, NumRefs, Defs),
+                  json{kind:symbol, signature:Signature,
+                       corpus:Corpus, root:Root, path:Path, language:Language,
+                       num_refs:NumRefs, definitions:DefsJson}) :-
+    maplist(definition_json, Defs, DefsJson).
+search_entry_json(line(Corpus,Root,Path, LineNo, Line),
+                  json{kind:line, corpus:Corpus, root:Root, path:Path,
+                       lineno:LineNo, text:Line}).
+
+definition_json(posting(_Edge, Corpus,Root,Path, LineNo, _Start, Language, Signature),
+                json{signature:Signature, corpus:Corpus, root:Root, path:Path,
+                     language:Language, lineno:LineNo}).
+
+%! reload_kythe_facts(+FactsPath:atom, -Paths:list(atom)) is det.
+% Replace the facts for the files in FactsPath (a kythe_facts.pl file
+% created by kythe_json_to_prolog.pl from some .kythe.json files, as
+% done by scripts/watch_and_reindex.py), without reloading all the
+% facts. Paths are the files whose facts were replaced: their
+% kythe_node/7 and kythe_edge/11 facts are retracted before the new
+% ones are asserted. Semantic nodes don't have a path, so they are
+% added (if new) but not removed. The files' xref postings are
+% replaced (see update_xref_postings/2) and the file tree and search
+% index are rebuilt (see index_file_tree/0, index_search/0). If the store is sharded, the
+% files' facts are pinned (their shards are out of date) and the
+% global shard's shard_file/5 facts are extended for them.
+% FactsPath may only contain kythe_node/7, kythe_edge/11 and
+% xref_posting/13 facts (see reload_fact/1); nothing in it is called.
+% TODO: remove semantic nodes that are no longer referenced.
+reload_kythe_facts(FactsPath, Paths) :-
+    read_file_to_terms(FactsPath, AllFacts, [encoding(utf8)]),
+    forall(member(Fact, AllFacts),
+           (  reload_fact(Fact)
+           -> true
+           ;  domain_error(reload_fact, Fact)
+           )),
+    partition([Fact]>>functor(Fact, xref_posting, 13), AllFacts, XrefPostings, Facts),
+    findall(Path, ( member(Fact, Facts), fact_path(Fact, Path), Path \== '' ), Paths0),
+    sort(Paths0, Paths),
+    with_mutex(kythe_facts,
+               ( maplist(retract_path_facts, Paths),
+                 maplist(assert_new_fact, Facts),
+                 update_xref_postings(Paths, XrefPostings),
+                 invalidate_file_responses,
+                 index_file_tree,
+                 forall(( member(Path, Paths),
+                          retract(kythe_node(_Signature, Corpus,Root,Path,Language,
+                                             '/pykythe/color_table', ColorTableStr)) ),
+                        assert_color_table(Corpus,Root,Path,Language, ColorTableStr)),
+                 % TODO: update the search index only for Paths.
+                 index_search,
+                 (  sharded_store(_ShardsDir, _MaxResidentShards)
+                 -> pin_reloaded_shards(Facts, Paths)
+                 ;  true
+                 ) )).
+
+pin_reloaded_shards(Facts, Paths) :-
+    forall(( member(kythe_node('',Corpus,Root,Path,_, '/kythe/node/kind', file), Facts),
+             \+ shard_file(Corpus, Root, Path, _, _) ),
+           assertz(shard_file(Corpus, Root, Path, '', ''))),
+    forall(member(Path, Paths),
+           ( retractall(resident_shard(Path, _, _, _)),
+             flag(shard_clock, LastUse, LastUse + 1),
+             path_facts_cells(Path, Cells),
+             assertz(resident_shard(Path, LastUse, Cells, pinned)) )).
+
+fact_path(kythe_node(_Signature,_Corpus,_Root,Path,_Language, _FactName, _FactValue), Path).
+fact_path(kythe_edge(_Signature1,_Corpus1,_Root1,Path,_Language1, _EdgeName,
+                     _Signature2,_Corpus2,_Root2,_Path2,_Language2), Path).
+
+retract_path_facts(Path) :-
+    forall(retract(color_file(FileId, _Corpus,_Root,Path,_Language, _Colors)),
+           retractall(color_item(FileId, _Start, _End, _LineNo, _Column, _ColorCode, _Value))),
+    retractall(color_line(_Corpus,_Root,Path, _LineNo, _Starts)),
+    retractall(file_num_lines(_Corpus,_Root,Path, _NumLines)),
+    retractall(kythe_node(_Signature,_Corpus,_Root,Path,_Language, _FactName, _FactValue)),
+    retractall(kythe_edge(_Signature1,_Corpus1,_Root1,Path,_Language1, _EdgeName,
+                          _Signature2,_Corpus2,_Root2,_Path2,_Language2)).
+
+%! reload_fact(+Fact) is semidet.
+% Fact is a (ground) fact that reload_kythe_facts/2 accepts.
+reload_fact(Fact) :-
+    ground(Fact),
+    (  Fact = kythe_node(_,_,_,_,_, _,_)
+    ;  Fact = kythe_edge(_,_,_,_,_, _, _,_,_,_,_)
+    ;  Fact = xref_posting(_,_,_,_,_,_,_,_,_,_,_,_,_)
+    ),
+    !.
+
+%! assert_new_fact(+Fact) is det.
+% Add Fact (see reload_fact/1) if it isn't already there.
+assert_new_fact(Fact) :-
+    (   clause(Fact, true)
+    ->  true
+    ;   assertz(Fact)
+    ).
 
 % index_kythe_facts/0 takes a bit of time because it builds the
 % JIT indexes; if you run it a second time, it's fast. (The indexes
@@ -326,13 +1250,12 @@ validate_kythe_facts :-
     forall(kythe_edge(V1, Edge, V2),
            must_once( ground(kythe_edge(V1, Edge, V2)) )),
     forall(( kythe_node(Anchor, '/kythe/node/kind', 'anchor'),
-             Anchor=(_,Corpus,Root,Path,Language),
-             ColorAnchor=(_,Corpus,Root,Path,Language)
+             Anchor=(_,Corpus,Root,Path,Language)
            ),
            must_once(( kythe_node(Anchor, '/kythe/loc/start', Start),
                        kythe_node(Anchor, '/kythe/loc/end', End),
-                       kythe_node(ColorAnchor, '/pykythe/color/start', Start),
-                       kythe_node(ColorAnchor, '/pykythe/color/end', End),
+                       color_file(FileId, Corpus,Root,Path,Language, _Colors),
+                       color_item(FileId, Start, End, _LineNo, _Column, _ColorCode, _Value),
                        semantic_or_tagged(Anchor)
                      ))
           ),
@@ -344,15 +1267,12 @@ validate_kythe_facts :-
     forall(kythe_node(Vname, _, _),
            must_once( ( kythe_node(Vname, Name , _),
                         memberchk(Name, ['/kythe/node/kind',
-                                         '/pykythe/type',
-                                         '/pykythe/color/token_color']) ) )),
+                                         '/pykythe/type']) ) )),
     % show_jiti,    % Not needed - should be the same as the first one
     % validate_anchor_link_anchor, % DO NOT SUBMIT: fix this test, which is also slow
     statistics(cputime, T2),
     Tvalid is T2 - T0,
-    debug(log, 'Validation done: ~3f sec)', [Tvalid]),
-    debug(log, '',[]),
-    debug(log, 'Server started: to stop, enter ctrl-D or "halt." (including the ".")', []).
+    debug(log, 'Validation done: ~3f sec)', [Tvalid]).
 
 semantic_or_tagged(Anchor) :-
     anchor_semantic(Anchor, _Semantic).
@@ -386,13 +1306,24 @@ validate_anchor_link_anchor :-
                            anchor_link_anchor(AnchorVname1, Edge1, SemanticVname2, Edge2, AnchorVname2),
                            [_]))).
 
+%! server(+Opts:dict) is det.
+% Start the HTTP server, with Opts.workers threads for accepting and
+% handling requests. The /json and /src_browser_file requests (which
+% can be slow) are handled by the src_browser_requests thread pool
+% (see the http_handler/3 directives), which has Opts.request_workers
+% threads and a queue of at most Opts.request_queue waiting requests
+% (more get "503 Service Unavailable").
 server(Opts) :-
+    retractall(request_timeout(_)),
+    assertz(request_timeout(Opts.request_timeout)),
+    thread_pool_create(src_browser_requests, Opts.request_workers,
+                       [backlog(Opts.request_queue)]),
     % See comments with "Support HTTPS" above.
     http_server([port(Opts.port),
                  % TODO: enable ssl (https):
                  % ssl([certificate_file('cacert.pem'), % or cert.csr?
                  %      key_file('privkey.pem')]),
-                 workers(5)]).
+                 workers(Opts.workers)]).
 
 browser_opts(Opts) :-
     validate_prolog_version,
@@ -402,7 +1333,27 @@ browser_opts(Opts) :-
      [opt(filesdir), type(atom), default('filesdir-must-be-specified'), longflags([filesdir]),
       help('Directory for the files\'s contents (for "files" URL)')],
      [opt(staticdir), type(atom), default('staticdir-must-be-specified'), longflags([staticdir]),
-      help('Directory for the static files (for "static" URL)')]
+      help('Directory for the static files (for "static" URL)')],
+     [opt(reload_dir), type(atom), default(''), longflags([reload_dir]),
+      help('Directory for the facts files of /reload requests (\'\' to disable /reload)')],
+     [opt(max_resident_shards), type(integer), default(100), longflags([max_resident_shards]),
+      help('Maximum number of files\'s shards to keep loaded (if the files dir has shards)')],
+     [opt(prewarm_file_cache), type(boolean), default(false), longflags([prewarm_file_cache]),
+      help('Fill the cache of file responses for all files (in a background thread) after loading')],
+     [opt(file_tree_lazy_files), type(integer), default(5000), longflags([file_tree_lazy_files]),
+      help('If there are more files than this, the file tree is sent a directory at a time')],
+     [opt(search_source_lines), type(boolean), default(false), longflags([search_source_lines]),
+      help('Index the source lines for search requests (not if the files dir has shards)')],
+     [opt(validate), type(boolean), default(false), longflags([validate]),
+      help('Validate the facts (in the background) after loading (see also /admin/validate)')],
+     [opt(workers), type(integer), default(5), longflags([workers]),
+      help('Number of HTTP server worker threads')],
+     [opt(request_workers), type(integer), default(5), longflags([request_workers]),
+      help('Number of threads for /json and /src_browser_file requests')],
+     [opt(request_queue), type(integer), default(100), longflags([request_queue]),
+      help('Maximum number of /json and /src_browser_file requests waiting for a thread')],
+     [opt(request_timeout), type(float), default(0.0), longflags([request_timeout]),
+      help('Time limit (seconds) for a /json or /src_browser_file request (0 for no limit)')]
     ],
     opt_arguments(OptsSpec, Opts0, PositionalArgs),
     dict_create(Opts, opts, Opts0),
@@ -428,7 +1379,20 @@ browser_opts(Opts) :-
                 [prefix]).
 
 :- http_handler('/json',  % json(.),     % localhost:9999/json  -- DO NOT SUBMIT - json(.) is better?
-                reply_with_json, [priority(0)]).
+                reply_with_json, [priority(0), spawn(src_browser_requests)]).
+
+:- http_handler('/reload', reply_reload, [method(post)]).
+
+:- http_handler('/src_browser_file', reply_src_browser_file,
+                [method(get), spawn(src_browser_requests)]).
+
+:- http_handler('/status', reply_status, [method(get)]).
+
+:- http_handler('/admin/validate', reply_validate, [method(post)]).
+
+:- http_handler('/metrics', reply_metrics, [method(get)]).
+
+:- http_handler('/src_file_tree', reply_src_file_tree, [method(get)]).
 
 pykythe_http_reply_from_files(Dir, Options, Request) :-
     (  false
@@ -469,8 +1433,13 @@ reply_with_json(Request) :-
     statistics(cputime, T1),
     Tdelta1 is T1 - T0,
     debug(timing, 'Request-JSON: ~q [~3f sec]', [JsonIn, Tdelta1]),
-    must_once(
-              json_response(JsonIn, JsonOut)), % TODO: improve this error handling
+    (  dict_pairs(JsonIn, _Tag, [RequestType-_])
+    -> true
+    ;  RequestType = unknown
+    ),
+    timed_request(RequestType,
+                  must_once(
+                            json_response(JsonIn, JsonOut))), % TODO: improve this error handling
     statistics(cputime, T2),
     Tdelta2 is T2 - T1,
     debug(timing, 'Request-response: ~q [~3f sec]', [JsonIn, Tdelta2]),
@@ -479,17 +1448,488 @@ reply_with_json(Request) :-
     Tdelta3 is T3 - T2,
     debug(timing, 'Request-reply: ~q [~3f sec]', [JsonIn, Tdelta3]).
 
+%! reply_reload(+Request) is det.
+% Handle a POST of {"facts_file": FactsPath} (from localhost only):
+% see reload_facts_path/2 and reload_kythe_facts/2. The reply is
+% {"paths": Paths, "seconds": Seconds}.
+reply_reload(Request) :-
+    admin_request(Request),
+    get_time(T0),
+    http_handler_read_json_dict(Request, JsonIn),
+    (  reload_facts_path(JsonIn.facts_file, FactsPath)
+    -> true
+    ;  memberchk(path(RequestPath), Request),
+       throw(http_reply(forbidden(RequestPath)))
+    ),
+    reload_kythe_facts(FactsPath, Paths),
+    get_time(T1),
+    Seconds is T1 - T0,
+    length(Paths, NumPaths),
+    debug(log, 'Reloaded ~d files from ~q (~3f sec)', [NumPaths, FactsPath, Seconds]),
+    reply_json_dict(json{paths: Paths, seconds: Seconds}, [width(0)]).
+
+%! reload_facts_path(+FactsFile, -FactsPath:atom) is semidet.
+% FactsPath is FactsFile (from a /reload request) resolved against
+% --reload_dir; fails if FactsFile isn't inside that directory (or
+% it's '', which disables /reload).
+reload_facts_path(FactsFile, FactsPath) :-
+    reload_dir(ReloadDir0),
+    ReloadDir0 \== '',
+    absolute_file_name(ReloadDir0, ReloadDir, [file_type(directory)]),
+    atom_string(FactsFileAtom, FactsFile),
+    absolute_file_name(FactsFileAtom, FactsPath, [relative_to(ReloadDir)]),
+    atom_concat(ReloadDir, '/', ReloadDirPrefix),
+    atom_concat(ReloadDirPrefix, _, FactsPath).
+
+%! admin_request(+Request) is det.
+% Refuse ("403 Forbidden") a request for an admin handler (/reload,
+% /admin/...) that isn't from localhost.
+admin_request(Request) :-
+    (  memberchk(peer(Peer), Request),
+       localhost_peer(Peer)
+    -> true
+    ;  memberchk(path(Path), Request),
+       throw(http_reply(forbidden(Path)))
+    ).
+
+localhost_peer(ip(127,_,_,_)).
+localhost_peer(ip(0,0,0,0,0,0,0,1)).
+
+%! reply_status(+Request) is det.
+% Handle a GET of /status: the progress of the start-up stages (see
+% startup_status/1).
+reply_status(_Request) :-
+    startup_status(Status),
+    reply_json_dict(Status, [width(0)]).
+
+%! reply_validate(+Request) is det.
+% Handle a POST to /admin/validate (from localhost only): start validating the facts (see
+% start_validation/0), whose progress can be seen with /status. The
+% reply is the validation stage's current status.
+reply_validate(Request) :-
+    admin_request(Request),
+    start_validation,
+    get_time(Now),
+    startup_stage(validation, Status, StartTime, EndTime),
+    startup_stage_json(validation, Status, StartTime, EndTime, Now, StageJson),
+    reply_json_dict(StageJson, [width(0)]).
+
+%! reply_metrics(+Request) is det.
+% Handle a GET of /metrics: see metrics/1.
+reply_metrics(_Request) :-
+    metrics(Metrics),
+    reply_json_dict(Metrics, [width(0)]).
+
+:- meta_predicate timed_request(+, 0).
+
+%! timed_request(+Type:atom, :Goal) is det.
+% Call Goal (once; it handles a request of Type) with the time limit
+% from --request_timeout (if it's exceeded, the reply is "503 Service
+% Unavailable"), then release the request's shards (see
+% release_shard_refs/0) and record its outcome and latency (see
+% request_outcome/2, record_request/3). The time limit is wall-clock
+% time (see call_with_time_limit/2), which includes any waiting for
+% wait_for_startup_stage/1 or the kythe_facts mutex.
+timed_request(Type, Goal) :-
+    get_time(T0),
+    (  request_timeout(Timeout),
+       Timeout > 0
+    -> TimedGoal = call_with_time_limit(Timeout, Goal)
+    ;  TimedGoal = Goal
+    ),
+    catch(setup_call_catcher_cleanup(
+              true,
+              once(TimedGoal),
+              Catcher,
+              ( release_shard_refs,
+                request_outcome(Catcher, Outcome),
+                get_time(T1),
+                Seconds is T1 - T0,
+                record_request(Type, Seconds, Outcome) )),
+          time_limit_exceeded,
+          request_timed_out(Timeout)).
+
+request_timed_out(Timeout) :-
+    format(string(Message), 'Request took more than ~w seconds', [Timeout]),
+    throw(http_reply(unavailable(Message))).
+
+%! request_outcome(+Catcher, -Outcome:atom) is det.
+% The Outcome (`ok`, `timeout` or `error`) of a request, from the
+% Catcher of setup_call_catcher_cleanup/4. A handler can reply by
+% throwing http_reply(...) (as reply_gzip_json/3 does), so that's
+% `ok`.
+request_outcome(exit, ok) :- !.
+request_outcome(!, ok) :- !.
+request_outcome(exception(time_limit_exceeded), timeout) :- !.
+request_outcome(exception(http_reply(_)), ok) :- !.
+request_outcome(exception(http_reply(_, _)), ok) :- !.
+request_outcome(_Catcher, error).
+
+%! record_request(+Type:atom, +Seconds:float, +Outcome:atom) is det.
+% Add a request's latency to the metrics for its Type, if Outcome is
+% `ok`; otherwise count it as a timeout or error (Seconds is ignored).
+record_request(Type, Seconds, Outcome) :-
+    latency_buckets(UpperBounds),
+    with_mutex(metrics,
+               ( (  retract(request_metric(Type, Count0, Timeouts0, Errors0, TotalSeconds0,
+                                          MaxSeconds0, BucketCounts0))
+                 -> true
+                 ;  Count0 = 0, Timeouts0 = 0, Errors0 = 0,
+                    TotalSeconds0 = 0.0, MaxSeconds0 = 0.0,
+                    length(UpperBounds, NumBuckets0),
+                    NumBuckets is NumBuckets0 + 1,
+                    length(BucketCounts0, NumBuckets),
+                    maplist(=(0), BucketCounts0)
+                 ),
+                 (  Outcome == ok
+                 -> Count is Count0 + 1,
+                    Timeouts = Timeouts0,
+                    Errors = Errors0,
+                    TotalSeconds is TotalSeconds0 + Seconds,
+                    MaxSeconds is max(MaxSeconds0, Seconds),
+                    increment_bucket(UpperBounds, Seconds, BucketCounts0, BucketCounts)
+                 ;  Count = Count0,
+                    TotalSeconds = TotalSeconds0,
+                    MaxSeconds = MaxSeconds0,
+                    BucketCounts = BucketCounts0,
+                    (  Outcome == timeout
+                    -> Timeouts is Timeouts0 + 1,
+                       Errors = Errors0
+                    ;  Timeouts = Timeouts0,
+                       Errors is Errors0 + 1
+                    )
+                 ),
+                 assertz(request_metric(Type, Count, Timeouts, Errors, TotalSeconds,
+                                        MaxSeconds, BucketCounts)) )).
+
+increment_bucket([], _Seconds, [Count0], [Count]) :-
+    Count is Count0 + 1.
+increment_bucket([UpperBound|UpperBounds], Seconds, [Count0|Counts0], [Count|Counts]) :-
+    (  Seconds =< UpperBound
+    -> Count is Count0 + 1,
+       Counts = Counts0
+    ;  Count = Count0,
+       increment_bucket(UpperBounds, Seconds, Counts0, Counts)
+    ).
+
+%! record_cache(+Cache:atom, +HitOrMiss:atom) is det.
+% Count a lookup in a cache: `file_response` (file_response/7),
+% `etag` (a src_browser_file or src_file_tree request whose
+% If-None-Match has the response's ETag) or `shard` (a resident shard in
+% ensure_shards_loaded/1).
+record_cache(Cache, HitOrMiss) :-
+    with_mutex(metrics,
+               ( (  retract(cache_metric(Cache, Hits0, Misses0))
+                 -> true
+                 ;  Hits0 = 0, Misses0 = 0
+                 ),
+                 (  HitOrMiss == hit
+                 -> Hits is Hits0 + 1,
+                    Misses = Misses0
+                 ;  Hits = Hits0,
+                    Misses is Misses0 + 1
+                 ),
+                 assertz(cache_metric(Cache, Hits, Misses)) )).
+
+%! metrics(-Metrics:dict) is det.
+% The request counts and latency histograms (by request type: the key
+% of a /json request, or src_browser_file for a GET of
+% /src_browser_file), the cache hit rates and the request thread
+% pool's settings. Each histogram bucket has the number of requests
+% whose latency is at most its upper bound (`le`, in seconds) and
+% more than the previous bucket's.
+metrics(json{requests:RequestsJson, caches:CachesJson,
+             request_timeout:Timeout, request_pool:PoolJson}) :-
+    latency_buckets(UpperBounds0),
+    append(UpperBounds0, ['+Inf'], UpperBounds),
+    findall(json{type:Type, count:Count, timeouts:Timeouts, errors:Errors,
+                 total_seconds:TotalSeconds, mean_seconds:MeanSeconds,
+                 max_seconds:MaxSeconds, histogram:HistogramJson},
+            ( request_metric(Type, Count, Timeouts, Errors, TotalSeconds, MaxSeconds,
+                             BucketCounts),
+              MeanSeconds is TotalSeconds / max(Count, 1),
+              maplist([UpperBound, BucketCount, json{le:UpperBound, count:BucketCount}]>>true,
+                      UpperBounds, BucketCounts, HistogramJson) ),
+            RequestsJson),
+    findall(json{cache:Cache, hits:Hits, misses:Misses, hit_rate:HitRate},
+            ( cache_metric(Cache, Hits, Misses),
+              HitRate is Hits / max(Hits + Misses, 1) ),
+            CachesJson),
+    (  request_timeout(Timeout)
+    -> true
+    ;  Timeout = 0
+    ),
+    (  catch(thread_pool_property(src_browser_requests, size(Size)), _, fail),
+       thread_pool_property(src_browser_requests, backlog(Backlog)),
+       thread_pool_property(src_browser_requests, running(Running))
+    -> PoolJson = json{size:Size, running:Running, backlog:Backlog}
+    ;  PoolJson = json{}
+    ).
+
+%! reply_src_browser_file(+Request) is det.
+% Handle a GET of /src_browser_file?corpus=...&root=...&path=... (and
+% optionally line_start=...&line_end=...) with the same JSON as a
+% src_browser_file request to /json, but from the cache of compressed
+% responses (see file_response/7), with an ETag
+% (so the reply is "304 Not Modified" if the request's If-None-Match
+% has it) and Content-Encoding gzip (if the request's Accept-Encoding
+% allows it).
+reply_src_browser_file(Request) :-
+    timed_request(src_browser_file, reply_src_browser_file_(Request)).
+
+reply_src_browser_file_(Request) :-
+    http_parameters(Request, [corpus(Corpus, []), root(Root, []), path(Path, []),
+                              line_start(LineStart, [integer, default(1)]),
+                              line_end(LineEnd0, [integer, optional(true)])]),
+    (  var(LineEnd0)
+    -> LineEnd = end
+    ;  LineEnd = LineEnd0
+    ),
+    file_response(Corpus, Root, Path, LineStart, LineEnd, ETag, GzipBytes),
+    reply_gzip_json(Request, ETag, GzipBytes).
+
+%! reply_gzip_json(+Request, +ETag:atom, +GzipBytes:string) is det.
+% Reply with gzip-compressed JSON and its ETag: "304 Not Modified" if
+% the request's If-None-Match has the ETag, else the JSON
+% (compressed if the request's Accept-Encoding allows it).
+reply_gzip_json(Request, ETag, GzipBytes) :-
+    Headers = [etag(ETag), cache_control('no-cache'), vary('Accept-Encoding')],
+    (  memberchk(if_none_match(IfNoneMatch), Request),
+       sub_atom(IfNoneMatch, _, _, _, ETag)
+    -> ETagHit = hit
+    ;  ETagHit = miss
+    ),
+    record_cache(etag, ETagHit),
+    (  ETagHit == hit
+    -> throw(http_reply(not_modified, Headers))
+    ;  request_accepts_gzip(Request)
+    -> throw(http_reply(bytes('application/json; charset=UTF-8', GzipBytes),
+                        [content_encoding(gzip)|Headers]))
+    ;  gunzip_string(GzipBytes, JsonStr),
+       string_utf8_bytes(JsonStr, JsonBytes),
+       throw(http_reply(bytes('application/json; charset=UTF-8', JsonBytes), Headers))
+    ).
+
+request_accepts_gzip(Request) :-
+    memberchk(accept_encoding(AcceptEncoding), Request),
+    format(atom(AcceptEncodingAtom), '~w', [AcceptEncoding]),
+    sub_atom(AcceptEncodingAtom, _, _, _, gzip).
+
+%! file_response(+Corpus, +Root, +Path, +LineStart:int, +LineEnd, -ETag:atom, -GzipBytes:string) is det.
+% The response for a src_browser_file request (see
+% color_data_lines/6), as gzip-compressed JSON, from the cache if
+% it's there for the current facts generation. The ETag is a hash of
+% the (uncompressed) JSON, so it's the same after a restart if the
+% facts are the same. Only block-aligned line ranges (see
+% block_line_range/2) are cached, so that the cache has at most one
+% entry per block of each file; other ranges are computed each time.
+file_response(Corpus, Root, Path, LineStart, LineEnd, ETag, GzipBytes) :-
+    flag(kythe_facts_generation, Generation, Generation),
+    (  file_response_cache(Corpus, Root, Path, LineStart, LineEnd, Generation,
+                           ETag0, GzipBytes0)
+    -> record_cache(file_response, hit),
+       ETag = ETag0,
+       GzipBytes = GzipBytes0
+    ;  record_cache(file_response, miss),
+       ensure_shards_loaded([Path]),
+       color_data_lines(Corpus, Root, Path, LineStart, LineEnd, Contents),
+       gzip_json(Contents, ETag, GzipBytes),
+       (  block_line_range(LineStart, LineEnd)
+       -> with_mutex(file_response_cache,
+                     ( retractall(file_response_cache(Corpus, Root, Path, LineStart, LineEnd,
+                                                      _, _, _)),
+                       assertz(file_response_cache(Corpus, Root, Path, LineStart, LineEnd,
+                                                   Generation, ETag, GzipBytes)) ))
+       ;  true
+       )
+    ).
+
+%! block_line_range(+LineStart:int, +LineEnd) is semidet.
+% LineStart..LineEnd is a block of prewarm_block_lines/1 lines (as
+% requested by src_browser.js and prewarm_file_responses/0).
+block_line_range(LineStart, LineEnd) :-
+    prewarm_block_lines(BlockLines),
+    integer(LineStart),
+    integer(LineEnd),
+    LineStart >= 1,
+    (LineStart - 1) mod BlockLines =:= 0,
+    LineEnd =:= LineStart + BlockLines - 1.
+
+%! gzip_json(+Json, -ETag:atom, -GzipBytes:string) is det.
+% Json as gzip-compressed JSON, with an ETag that is a hash of the
+% (uncompressed) JSON.
+gzip_json(Json, ETag, GzipBytes) :-
+    with_output_to(string(JsonStr),
+                   json_write_dict(current_output, Json, [width(0)])),
+    sha_hash(JsonStr, Hash, [encoding(utf8)]),
+    hash_atom(Hash, HashHex),
+    format(atom(ETag), '"~w"', [HashHex]),
+    gzip_string(JsonStr, GzipBytes).
+
+%! reply_src_file_tree(+Request) is det.
+% Handle a GET of /src_file_tree (optionally with dir=...): see
+% file_tree_response/3.
+reply_src_file_tree(Request) :-
+    timed_request(src_file_tree, reply_src_file_tree_(Request)).
+
+reply_src_file_tree_(Request) :-
+    http_parameters(Request, [dir(Dir, [default('')])]),
+    file_tree_response(Dir, ETag, GzipBytes),
+    reply_gzip_json(Request, ETag, GzipBytes).
+
+%! file_tree_response(+Dir:atom, -ETag:atom, -GzipBytes:string) is det.
+% The file tree (a list of `file` and `dir` items, as made by
+% tree_to_json/2) for Dir, as gzip-compressed JSON, made by
+% index_file_tree/0 for the current facts generation (or now, if it
+% hasn't been made yet). For Dir='', this is the whole tree if there
+% are at most --file_tree_lazy_files files, or else only the top
+% level. Otherwise, it's Dir's items. A `dir` item without its
+% children has lazy:true; its children are fetched with a request
+% for its path.
+file_tree_response(Dir, ETag, GzipBytes) :-
+    flag(kythe_facts_generation, Generation, Generation),
+    (  file_tree_response(Generation, _, _, _)
+    -> true
+    ;  with_mutex(kythe_facts,
+                  (  file_tree_response(Generation, _, _, _)
+                  -> true
+                  ;  index_file_tree
+                  ))
+    ),
+    (  file_tree_response(Generation, Dir, ETag0, GzipBytes0)
+    -> ETag = ETag0,
+       GzipBytes = GzipBytes0
+    ;  existence_error(file_tree_dir, Dir)
+    ).
+
+%! index_file_tree is det.
+% Make the src_file_tree responses (see file_tree_response/3) for the
+% current facts generation: one for the top of the tree and one for
+% each directory. Called when the facts are loaded or reloaded.
+index_file_tree :-
+    get_time(T0),
+    flag(kythe_facts_generation, Generation, Generation),
+    (  setof(Path, file_path(Path), PathNames)
+    -> true
+    ;  PathNames = []
+    ),
+    length(PathNames, NumFiles),
+    files_to_tree(PathNames, PathTree),
+    retractall(file_tree_response(_, _, _, _)),
+    (  file_tree_lazy_files(LazyFiles),
+       NumFiles > LazyFiles
+    -> maplist(tree_to_lazy_json, PathTree, TreeJson)
+    ;  maplist(tree_to_json, PathTree, TreeJson)
+    ),
+    assert_file_tree_response(Generation, '', TreeJson),
+    forall(tree_dir(PathTree, Dir, DirTree),
+           ( maplist(tree_to_lazy_json, DirTree, DirTreeJson),
+             assert_file_tree_response(Generation, Dir, DirTreeJson) )),
+    get_time(T1),
+    Seconds is T1 - T0,
+    aggregate_all(count, file_tree_response(_, _, _, _), NumResponses),
+    debug(log, 'Indexed file tree: ~d files, ~d responses (~3f sec)',
+          [NumFiles, NumResponses, Seconds]).
+
+assert_file_tree_response(Generation, Dir, TreeJson) :-
+    gzip_json(TreeJson, ETag, GzipBytes),
+    assertz(file_tree_response(Generation, Dir, ETag, GzipBytes)).
+
+%! tree_dir(+Tree, -Dir:atom, -DirTree) is nondet.
+% Dir is a directory (at any depth) in Tree (from files_to_tree/2),
+% with DirTree its items.
+tree_dir(Tree, Dir, DirTree) :-
+    member(dir(_Name, Path, Children), Tree),
+    (  Dir = Path,
+       DirTree = Children
+    ;  tree_dir(Children, Dir, DirTree)
+    ).
+
+%! invalidate_file_responses is det.
+% Called when the facts change: increment the facts generation and
+% remove the cached responses.
+invalidate_file_responses :-
+    flag(kythe_facts_generation, Generation, Generation + 1),
+    retractall(file_response_cache(_, _, _, _, _, _, _, _)).
+
+%! prewarm_file_responses is det.
+% Fill the cache of file responses for all the files (for the
+% --prewarm_file_cache option), in ranges of prewarm_block_lines/1
+% lines. If the store is sharded, this loads (and evicts) all the
+% shards.
+prewarm_file_responses :-
+    get_time(T0),
+    findall(Corpus-Root-Path, kythe_file(Corpus, Root, Path, _Language), Files),
+    forall(member(Corpus-Root-Path, Files),
+           catch(with_shard_refs(prewarm_file_response(Corpus, Root, Path)),
+                 Error,
+                 print_message(error, Error))),
+    get_time(T1),
+    Seconds is T1 - T0,
+    length(Files, NumFiles),
+    aggregate_all(sum(Len), ( file_response_cache(_, _, _, _, _, _, _, GzipBytes),
+                              string_length(GzipBytes, Len) ),
+                  TotalBytes),
+    debug(log, 'Prewarmed file cache: ~d files, ~D compressed bytes (~3f sec)',
+          [NumFiles, TotalBytes, Seconds]).
+
+prewarm_file_response(Corpus, Root, Path) :-
+    prewarm_block_lines(BlockLines),
+    file_response(Corpus, Root, Path, 1, BlockLines, _ETag, _GzipBytes),
+    (  file_num_lines(Corpus, Root, Path, NumLines)
+    -> true
+    ;  NumLines = 0
+    ),
+    NumBlocks is (NumLines + BlockLines - 1) // BlockLines,
+    forall(between(2, NumBlocks, Block),
+           ( LineStart is (Block - 1) * BlockLines + 1,
+             LineEnd is Block * BlockLines,
+             file_response(Corpus, Root, Path, LineStart, LineEnd, _, _) )).
+
+%! gzip_string(+Str:string, -GzipBytes:string) is det.
+% Compress the UTF-8 encoding of Str.
+gzip_string(Str, GzipBytes) :-
+    setup_call_cleanup(
+        new_memory_file(MemFile),
+        ( setup_call_cleanup(
+              open_memory_file(MemFile, write, OutStream, [encoding(octet)]),
+              ( zopen(OutStream, ZStream, [format(gzip), close_parent(false)]),
+                set_stream(ZStream, encoding(utf8)),
+                write(ZStream, Str),
+                close(ZStream) ),
+              close(OutStream)),
+          memory_file_to_string(MemFile, GzipBytes, octet) ),
+        free_memory_file(MemFile)).
+
+%! gunzip_string(+GzipBytes:string, -Str:string) is det.
+% The inverse of gzip_string/2.
+gunzip_string(GzipBytes, Str) :-
+    setup_call_cleanup(
+        open_string(GzipBytes, InStream),
+        ( set_stream(InStream, encoding(octet)),
+          zopen(InStream, ZStream, [format(gzip), close_parent(false)]),
+          set_stream(ZStream, encoding(utf8)),
+          call_cleanup(read_string(ZStream, _, Str),
+                       close(ZStream)) ),
+        close(InStream)).
+
+string_utf8_bytes(Str, Bytes) :-
+    string_codes(Str, Codes),
+    phrase(utf8_codes(Codes), ByteCodes),
+    string_codes(Bytes, ByteCodes).
+
 json_response(json{fetch:FileName},
               json_result{file:FileName,
                           contents:Contents}) :-
     !,
     % TODO: catch error(existence_error(source_sink,...),_)
     read_file_to_string(files(FileName), Contents, []).
-json_response(json{anchor_xref: json{signature: Signature,
-                                     corpus: Corpus,
-                                     root: Root,
-                                     path: Path,
-                                     language: Language}},
+% The anchor_xref request can also have page_start (default 0) and
+% page_size (default from default_xref_page_size/1, at most
+% max_xref_page_size/1), to get a page of the cross-references; the
+% response's total is the number of cross-referenced anchors (in all
+% pages).
+json_response(json{anchor_xref: AnchorXref},
               json{signature: Signature,
                    lineno: LineNo,
                    line: LineChunks,
@@ -497,37 +1937,89 @@ json_response(json{anchor_xref: json{signature: Signature,
                    path: Path, language: Language,
                    semantics: SemanticVnamesJson,
                    semantic_node_values: SemanticNodeValuesJson,
-                   edge_links: EdgeLinksJson}) :-
+                   edge_links: EdgeLinksJson,
+                   total: Total,
+                   page_start: PageStart,
+                   page_size: PageSize}) :-
     !,
+    json{signature: Signature,
+         corpus: Corpus,
+         root: Root,
+         path: Path,
+         language: Language} :< AnchorXref,
+    default_xref_page_size(DefaultPageSize),
+    max_xref_page_size(MaxPageSize),
+    request_page(AnchorXref, DefaultPageSize, MaxPageSize, PageStart, PageSize),
     AnchorVname = vname(Signature, Corpus, Root, Path, Language),
-    % TODO: probably better to use nested setof/bagof, but with
-    %       library(solution_sequences) for ordering, grouping
+    wait_for_startup_stage(xref_postings),
+    ensure_shards_loaded([Path]),
     anchor_to_line_chunks(AnchorVname, LineNo, LineChunks),
     debug(log, 'Xref ~q lineno: ~q', [[signature: Signature, corpus=Corpus, root: Root, path: Path, language: Language], LineNo]),
-    anchor_links_grouped(AnchorVname, SemanticNodeValues, EdgeLinks0),
+    anchor_links_grouped(AnchorVname, PageStart, PageSize,
+                         SemanticNodeValues, Total, EdgeLinks0),
     maplist(expand_edge_link, EdgeLinks0, EdgeLinks),
     setof_or_empty(S, anchor_semantic_json(AnchorVname, S), SemanticVnamesJson),
     maplist(pair_to_json(kind, value), SemanticNodeValues, SemanticNodeValuesJson),
     maplist(edge_links_group_to_dict, EdgeLinks, EdgeLinksJson).
-json_response(json{src_browser_file:
-                  json{corpus:Corpus, root:Root, path:Path}},
-              Contents) :-
+% The src_browser_file request can also have line_start (default 1)
+% and line_end (default: the last line), to get only those lines.
+json_response(json{src_browser_file: SrcBrowserFile}, Contents) :-
     !,
-    color_data_one_file(Corpus, Root, Path, Contents).
-json_response(json{src_file_tree: _}, PathTreeJson) :-
+    json{corpus:Corpus, root:Root, path:Path} :< SrcBrowserFile,
+    get_dict_default(line_start, SrcBrowserFile, 1, LineStart),
+    get_dict_default(line_end, SrcBrowserFile, end, LineEnd),
+    ensure_shards_loaded([Path]),
+    color_data_lines(Corpus, Root, Path, LineStart, LineEnd, Contents).
+json_response(json{shard_stats: _}, Stats) :-
     !,
-    setof(Path, file_path(Path), PathNames),
-    files_to_tree(PathNames, PathTree),
-    tree_to_json(PathTree, PathTreeJson).
-
-% TODO: Can we use library(solution_sequences) group_by/4?  It has
-%       bagof rather than setof at bottom, which is not necessarily a
-%       bad thing, as it might show errors in the Kythe facts
-%       (although probably not -- duplicates should have been removed
-%       by the processing pipeline).
-%! anchor_links_grouped(+AnchorVname, -SemanticNodeValues, -GroupedLinks) is det.
-anchor_links_grouped(AnchorVname, SemanticNodeValues, GroupedLinks) :-
-    anchor_links(AnchorVname, SemanticNodeValues, SortedLinks),
+    shard_stats(Stats).
+% The search request has query and optionally kind (`symbol`, the
+% default, or `line`), match (`substring`, the default, or `prefix`),
+% page_start (default 0) and page_size (default from
+% default_search_page_size/1, at most max_search_page_size/1); the
+% response's total is the number of results (in all pages). See
+% search_entries/4.
+json_response(json{search: Search},
+              json{query: Query, kind: Kind, match: Match,
+                   results: ResultsJson,
+                   total: Total,
+                   page_start: PageStart,
+                   page_size: PageSize,
+                   seconds: Seconds}) :-
+    !,
+    json{query: Query} :< Search,
+    get_dict_default(kind, Search, symbol, Kind),
+    must_be(oneof([symbol, line]), Kind),
+    get_dict_default(match, Search, substring, Match),
+    must_be(oneof([substring, prefix]), Match),
+    default_search_page_size(DefaultPageSize),
+    max_search_page_size(MaxPageSize),
+    request_page(Search, DefaultPageSize, MaxPageSize, PageStart, PageSize),
+    wait_for_startup_stage(search_index),
+    get_time(T0),
+    search_entries(Kind, Query, Match, Entries),
+    length(Entries, Total),
+    list_page(Entries, PageStart, PageSize, Page),
+    maplist(search_entry_json, Page, ResultsJson),
+    get_time(T1),
+    Seconds is T1 - T0.
+
+%! request_page(+Request:dict, +DefaultPageSize:int, +MaxPageSize:int, -PageStart:int, -PageSize:int) is det.
+% The page_start (default 0) and page_size (default DefaultPageSize,
+% reduced to MaxPageSize if it's larger) of a request, which must be
+% non-negative integers.
+request_page(Request, DefaultPageSize, MaxPageSize, PageStart, PageSize) :-
+    get_dict_default(page_start, Request, 0, PageStart),
+    must_be(nonneg, PageStart),
+    get_dict_default(page_size, Request, DefaultPageSize, PageSize0),
+    must_be(nonneg, PageSize0),
+    PageSize is min(PageSize0, MaxPageSize).
+
+%! anchor_links_grouped(+AnchorVname, +PageStart:int, +PageSize:int, -SemanticNodeValues, -Total:int, -GroupedLinks) is det.
+% GroupedLinks is a page of the cross-references, grouped by edge and
+% file; Total is the number of cross-references in all the pages.
+anchor_links_grouped(AnchorVname, PageStart, PageSize, SemanticNodeValues, Total, GroupedLinks) :-
+    anchor_links(AnchorVname, PageStart, PageSize, SemanticNodeValues, Total, SortedLinks),
     group_pairs_by_key(SortedLinks, GroupedLinks0),
     maplist(group_edge_by_files, GroupedLinks0, GroupedLinks).
 
@@ -539,13 +2031,19 @@ group_edge_by_files(Edge-Vnames, Edge-GroupVnamePaths) :-
 path_vname(Vname0-Signatures, Vname0-Vnames) :-
     maplist(vname0_join_signature(Vname0), Signatures, Vnames).
 
-%! anchor_links(+AnchorVname, -SemanticNodeValues, -SortedLinks) is det.
-anchor_links(AnchorVname, SemanticNodeValues, SortedLinks) :-
+%! anchor_links(+AnchorVname, +PageStart:int, +PageSize:int, -SemanticNodeValues, -Total:int, -SortedLinks) is det.
+% The links are from the xref postings (see anchor_xref_postings/2),
+% so only the page's files' shards need to be loaded.
+anchor_links(AnchorVname, PageStart, PageSize, SemanticNodeValues, Total, SortedLinks) :-
     % TODO: filter Edge1 by anchor_out_edge?
-    setof_or_empty(Edge2-AnchorVname2flipped,
-                   anchor_link_anchor_sort_order(AnchorVname, Edge2, AnchorVname2flipped),
-                   SortedLinks0),
-    maplist(pair_vname_remove_start, SortedLinks0, SortedLinks),
+    anchor_xref_postings(AnchorVname, Postings),
+    length(Postings, Total),
+    list_page(Postings, PageStart, PageSize, PagePostings),
+    findall(PagePath, member(posting(_,_,_,PagePath,_,_,_,_), PagePostings), PagePaths0),
+    sort(PagePaths0, PagePaths),
+    vname_vname0(AnchorVname, vname0(_Corpus, _Root, Path, _Language)),
+    ensure_shards_loaded([Path|PagePaths]),
+    maplist(posting_link, PagePostings, SortedLinks),
     setof_or_empty(NodeKind-NodeValue,
                    node_link_node_value(AnchorVname, NodeKind, NodeValue), SemanticNodeValues).
 
@@ -589,10 +2087,8 @@ http_handler_read_json_dict(Request, JsonIn) :-
                         [value_string_as(atom), end_of_file(@(end)), default_tag(json),
                          true(#(true)),false(#(false)),null(#(null))]).
 
-%! anchor_link_anchor_sort_order(+AnchorVname, -Edge2, -AnchorVname2flipped) is det.
-anchor_link_anchor_sort_order(AnchorVname, Edge2, AnchorVnameSort) :-
-    anchor_link_anchor(AnchorVname, _Edge1, _SemanticVname, Edge2, AnchorVname2),
-    vname_sort(AnchorVname2, AnchorVnameSort).
+posting_link(posting(Edge, Corpus,Root,Path, _LineNo, _Start, Language, Signature),
+             Edge-vname(Signature,Corpus,Root,Path,Language)).
 
 % An orphan semantic doesn't have an associated anchor
 orphan_semantic(AnchorVname1, SemanticVname, Edge) :-
@@ -625,12 +2121,8 @@ node_link_node_value(Vname, Edge, Name, Value) :-
 node_link_node_value(Vname, Edge, NodeVname, Name, Value) :-
     kythe_edge(Vname, Edge, NodeVname),
     \+ kythe_node(NodeVname, '/kythe/node/kind', 'anchor'),
-    \+ kythe_node(NodeVname, '/pykythe/color/token_color', _),
     kythe_node(NodeVname, Name, Value).
 
-pair_vname_remove_start(Key-VnameSort, Key-Vname) :-
-    vname_sort(Vname, VnameSort).
-
 % Change the ordering of items in a vname, for sorting
 vname_flip(vname(Signature, Corpus, Root, Path, Language),
            vname_flip(Corpus, Root, Path, Signature, Language)).
@@ -716,6 +2208,15 @@ file_path(CombinedPath) :-
     % TODO: escape '/' inside Corpus, Root
     format(atom(CombinedPath), '~w/~w/~w', [Corpus, Root, Path]).
 
+kythe_file(Corpus, Root, Path, Language) :-
+    sharded_store(_ShardsDir, _MaxResidentShards),
+    !,
+    shard_file(Corpus, Root, Path, Language0, _ShardName),
+    (  Language0 \== ''
+    -> Language = Language0
+    ;  file_name_extension(_, Extension, Path),
+       guess_language(Extension, Language)
+    ).
 kythe_file(Corpus, Root, Path, Language) :-
     kythe_node(vname('',Corpus,Root,Path,_), '/kythe/node/kind', file),
     (  kythe_node(vname('',Corpus,Root,Path,_), '/kythe/language', Language)
@@ -734,21 +2235,53 @@ tree_to_json(file(N,Path), json([type=file, name=N, path=Path])).
 tree_to_json(dir(N,Path,Children), json([type=dir, name=N, path=Path, children=ChildrenDict])) :-
     tree_to_json(Children, ChildrenDict).
 
-color_data_one_file(Corpus, Root, Path,
-                    json{corpus:Corpus, root:Root, path:Path, language:Language,
-                         lines:ColorTextLines}) :-
+%! tree_to_lazy_json(+Item, -ItemJson) is det.
+% Like tree_to_json/2 for a single item, but without a directory's
+% children (see file_tree_response/3).
+tree_to_lazy_json(file(N,Path), json([type=file, name=N, path=Path])).
+tree_to_lazy_json(dir(N,Path,_Children), json([type=dir, name=N, path=Path, lazy=true])).
+
+color_data_one_file(Corpus, Root, Path, Contents) :-
+    color_data_lines(Corpus, Root, Path, 1, end, Contents).
+
+%! color_data_lines(+Corpus, +Root, +Path, +LineStart:int, +LineEnd, -Contents:dict) is det.
+% The color chunks (with their links) for lines LineStart..LineEnd
+% (LineEnd can be `end` for the file's last line), using the line
+% index (color_line/5), so the time doesn't depend on the file's size.
+% Contents has lines (a list of the chunks for each line that has
+% any) and num_lines (the number of lines in the file).
+color_data_lines(Corpus, Root, Path, LineStart, LineEnd,
+                 json{corpus:Corpus, root:Root, path:Path, language:Language,
+                      lines:ColorTextLines, num_lines:NumLines,
+                      line_start:LineStart, line_end:LineEnd2}) :-
     kythe_file(Corpus,Root,Path,Language),
+    (  file_num_lines(Corpus, Root, Path, NumLines)
+    -> true
+    ;  NumLines = 0
+    ),
+    (  LineEnd == end
+    -> LineEnd2 = NumLines
+    ;  LineEnd2 is min(LineEnd, NumLines)
+    ),
     Vname0 = vname0(Corpus,Root,Path,Language),
-    setof(KeyedColorText, keyed_color_fact(Corpus, Root, Path, Language, KeyedColorText),
-          LineNoAndChunks0),
-    pairs_values(LineNoAndChunks0, LineNoAndChunks),
-    group_pairs_by_key(LineNoAndChunks, ColorTextLines0),
+    findall(LineNo-Chunks,
+            ( between(LineStart, LineEnd2, LineNo),
+              line_chunks(Vname0, LineNo, Chunks) ),
+            ColorTextLines0),
     maplist(add_links(Vname0), ColorTextLines0, ColorTextLines1), % concurrent gives slight slow-down
     pairs_values(ColorTextLines1, ColorTextLines).
 
-keyed_color_fact(Corpus, Root, Path, Language, Start-(LineNo-ColorChunk)) :-
-    line_chunk(vname(_ColorAnchor, Corpus,Root,Path,Language), LineNo, ColorChunk),
-    Start = ColorChunk.start.
+%! line_chunks(+Vname0, +LineNo:int, -Chunks:list(dict)) is semidet.
+% The color chunks (in order) for a line, from the line index; fails
+% if the line has no chunks (e.g., it's inside a multi-line string).
+line_chunks(Vname0, LineNo, Chunks) :-
+    Vname0 = vname0(Corpus,Root,Path,Language),
+    color_file(FileId, Corpus,Root,Path,Language, Colors),
+    color_line(Corpus, Root, Path, LineNo, Starts),
+    findall(Chunk,
+            ( member(Start, Starts),
+              line_chunk(FileId, Colors, Vname0, Start, LineNo, Chunk) ),
+            Chunks).
 
 add_links(Vname0, LineNo-Items, LineNo-AppendedItems) :-
     maplist(add_link(Vname0), Items, AppendedItems).
@@ -801,54 +2334,32 @@ path_pair_vname(vname(Signature,Corpus,Root,Path,Language),
 vname0_join_signature(vname0(Corpus,Root,Path,Language), Signature,
                       vname(Signature,Corpus,Root,Path,Language)).
 
-vname_sort(vname(Signature, Corpus, Root, Path, Language),
-           vname_sort(Corpus, Root, Path, Start, Language, Signature)) :-
-    (  var(Start)               % No need to do the lookup if nonvar
-    -> kythe_node(Signature, Corpus, Root, Path, Language, '/kythe/loc/start', Start)
-    ;  true
-    ).
-
-vname_strip_signature(vname(_Signature1,Corpus,Root,Path,Language),
-                      vname(_Signature2,Corpus,Root,Path,Language)).
-
 %! anchor_to_line_chunks(+AnchorVname:vname, -LineNo:int, -Chunks:list(dict)) is semidet.
 % Given an AnchorVname, get all the color chunks (in order) for the
 % line that anchor is in. Can fail if the anchor is invalid (and if
 % there isn't a color anchor that matches the token anchor).
-% TODO: refactor with color_data_one_file
 anchor_to_line_chunks(AnchorVname, LineNo, Chunks) :-
     anchor_to_lineno(AnchorVname, LineNo),
     vname_vname0(AnchorVname, Vname0),
-    setof(KeyedChunk, keyed_color_chunk(Vname0, LineNo, KeyedChunk), KeyedChunks),
-    pairs_values(KeyedChunks, Chunks).
+    line_chunks(Vname0, LineNo, Chunks).
 
 anchor_to_lineno(AnchorVname, LineNo) :-
     kythe_node(AnchorVname, '/kythe/loc/start', Start),
-    vname_strip_signature(AnchorVname, ColorVname),
-    kythe_node(ColorVname, '/pykythe/color/start', Start),
-    % There can be multiple chunks for a color anchor, but all have
-    % the same line#.
-    once(kythe_node(ColorVname, '/pykythe/color/lineno', LineNo)). % TODO: once(...)
-
-keyed_color_chunk(Vname0, LineNo, Start-Chunk) :-
-    vname_vname0(ColorVname, Vname0),
-    kythe_node(ColorVname, '/pykythe/color/lineno', LineNo),
-    line_chunk(ColorVname, LineNo, Chunk),
-    Start = Chunk.start.
-
-line_chunk(ColorVname, LineNo, color{lineno:LineNo, column:Column,
-                                     start:Start, end:End,
-                                     signature:Signature,
-                                     semantic_signature:'***', % DO NOT SUBMIT fixme
-                                     token_color:TokenColor, value:Value}) :-
+    vname_vname0(AnchorVname, vname0(Corpus,Root,Path,Language)),
+    color_file(FileId, Corpus,Root,Path,Language, _Colors),
+    % There can be multiple color items with the same start (e.g., a
+    % zero-length item), but all have the same line#.
+    once(color_item(FileId, Start, _End, LineNo, _Column, _ColorCode, _Value)).
+
+line_chunk(FileId, Colors, Vname0, Start, LineNo,
+           color{lineno:LineNo, column:Column,
+                 start:Start, end:End,
+                 signature:Signature,
+                 semantic_signature:'***', % DO NOT SUBMIT fixme
+                 token_color:TokenColor, value:Value}) :-
     % DO NOT SUBMIT - needs semantic_signature (above)
-    kythe_node(ColorVname, '/pykythe/color/lineno',      LineNo),
-    kythe_node(ColorVname, '/pykythe/color/column',      Column),
-    kythe_node(ColorVname, '/pykythe/color/start',       Start),
-    kythe_node(ColorVname, '/pykythe/color/end',         End),
-    kythe_node(ColorVname, '/pykythe/color/token_color', TokenColor),
-    kythe_node(ColorVname, '/pykythe/color/value',       Value),
-    vname_vname0(ColorVname, Vname0),
+    color_item(FileId, Start, End, LineNo, Column, ColorCode, Value),
+    nth0(ColorCode, Colors, TokenColor),
     vname_vname0(AnchorVname, Signature, Vname0),
     (  kythe_node(AnchorVname, '/kythe/loc/start', Start)
     -> true
@@ -973,6 +2484,379 @@ test(f1, [true]) :-
               ]
              = Ftree).
 
+test(lazy, [true]) :-
+    t1(Ftree),
+    findall(Dir, tree_dir(Ftree, Dir, _), Dirs),
+    assertion(Dirs == ['a', 'a/b', 'a/d', 'a/d/e']),
+    once(tree_dir(Ftree, 'a', DirTree)),
+    maplist(tree_to_lazy_json, DirTree, DirTreeJson),
+    assertion(DirTreeJson == [json([type=dir, name=b, path='a/b', lazy=true]),
+                              json([type=dir, name=d, path='a/d', lazy=true]),
+                              json([type=file, name=c, path='a/c'])]).
+
 :- end_tests(file_tree).
 
+:- begin_tests(reload).
+
+test(reload, [cleanup(( retract_path_facts('/r/a.py'),
+                        retract_path_facts('/r/b.py'),
+                        retractall(kythe_node(sem_r,_,_,_,_,_,_)) ))]) :-
+    assertz(kythe_node('#1', 'C','R','/r/a.py',python, '/kythe/node/kind', anchor)),
+    assertz(kythe_node('#2', 'C','R','/r/a.py',python, '/kythe/node/kind', anchor)),
+    assertz(kythe_node('#1', 'C','R','/r/b.py',python, '/kythe/node/kind', anchor)),
+    tmp_file(reload, FactsPath),
+    setup_call_cleanup(
+        open(FactsPath, write, FactsStream, [encoding(utf8)]),
+        forall(member(Fact,
+                      [kythe_node('#3', 'C','R','/r/a.py',python, '/kythe/node/kind', anchor),
+                       kythe_node(sem_r, 'C','R','',python, '/kythe/node/kind', variable),
+                       kythe_edge('#3', 'C','R','/r/a.py',python, '/kythe/edge/ref',
+                                  sem_r, 'C','R','',python)]),
+               format(FactsStream, '~q.~n', [Fact])),
+        close(FactsStream)),
+    reload_kythe_facts(FactsPath, Paths),
+    delete_file(FactsPath),
+    assertion(Paths == ['/r/a.py']),
+    findall(Sig, kythe_node(Sig,_,_,'/r/a.py',_,_,_), SigsA),
+    assertion(SigsA == ['#3']),
+    findall(Sig, kythe_node(Sig,_,_,'/r/b.py',_,_,_), SigsB),
+    assertion(SigsB == ['#1']),
+    assertion(kythe_edge(vname('#3','C','R','/r/a.py',python), '/kythe/edge/ref',
+                         vname(sem_r,'C','R','',python))),
+    assertion(kythe_node(vname(sem_r,'C','R','',python), '/kythe/node/kind', variable)).
+
+test(reload_only_facts, [error(domain_error(reload_fact, shell(false)))]) :-
+    tmp_file(reload, FactsPath),
+    setup_call_cleanup(
+        open(FactsPath, write, FactsStream, [encoding(utf8)]),
+        format(FactsStream, '~q.~n', [shell(false)]),
+        close(FactsStream)),
+    call_cleanup(reload_kythe_facts(FactsPath, _Paths),
+                 delete_file(FactsPath)).
+
+test(reload_facts_path, [cleanup(retractall(reload_dir(_)))]) :-
+    retractall(reload_dir(_)),
+    assertz(reload_dir('/tmp')),
+    assertion(reload_facts_path("/tmp/watch/facts/kythe_facts.pl",
+                                '/tmp/watch/facts/kythe_facts.pl')),
+    assertion(reload_facts_path("watch/kythe_facts.pl", '/tmp/watch/kythe_facts.pl')),
+    assertion(\+ reload_facts_path("/etc/passwd", _)),
+    assertion(\+ reload_facts_path("/tmp/../etc/passwd", _)),
+    retractall(reload_dir(_)),
+    assertz(reload_dir('')),
+    assertion(\+ reload_facts_path("/tmp/kythe_facts.pl", _)).
+
+:- end_tests(reload).
+
+:- begin_tests(shards).
+
+write_test_shard(ShardsDir, ShardName, Shard) :-
+    atomic_list_concat([ShardsDir, ShardName], '/', ShardPath),
+    setup_call_cleanup(
+        open(ShardPath, write, ShardStream, [type(binary)]),
+        fast_write(ShardStream, Shard),
+        close(ShardStream)).
+
+make_test_shards(ShardsDir) :-
+    tmp_file(shards, ShardsDir),
+    make_directory(ShardsDir),
+    shard_format_version(Version),
+    write_test_shard(ShardsDir, 'global.shard',
+                     kythe_global_shard(
+                         Version,
+                         [kythe_node(sem_s, 'C','R','',python, '/kythe/node/kind', variable),
+                          shard_file('C','R','/s/a.py','', 'a.shard'),
+                          shard_file('C','R','/s/b.py',python, 'b.shard'),
+                          xref_posting(sem_s,'C','R','',python, '/kythe/edge/defines/binding',
+                                       'C','R','/s/a.py', 1, 0, python, '#1'),
+                          xref_posting(sem_s,'C','R','',python, '/kythe/edge/ref',
+                                       'C','R','/s/b.py', 1, 0, python, '#5')])),
+    write_test_shard(ShardsDir, 'a.shard',
+                     kythe_shard(
+                         Version,
+                         [kythe_node('#1', 'C','R','/s/a.py',python, '/kythe/node/kind', anchor),
+                          kythe_edge('#1', 'C','R','/s/a.py',python, '/kythe/edge/defines/binding',
+                                     sem_s, 'C','R','',python)])),
+    write_test_shard(ShardsDir, 'b.shard',
+                     kythe_shard(
+                         Version,
+                         [kythe_node('#5', 'C','R','/s/b.py',python, '/kythe/node/kind', anchor),
+                          kythe_edge('#5', 'C','R','/s/b.py',python, '/kythe/edge/ref',
+                                     sem_s, 'C','R','',python)])).
+
+cleanup_test_shards(ShardsDir) :-
+    retractall(sharded_store(_, _)),
+    retractall(resident_shard(_, _, _, _)),
+    retractall(shard_ref(_, _)),
+    retractall(shard_file(_, _, _, _, _)),
+    retractall(xref_postings(_, _, _, _, _, _, _)),
+    retract_path_facts('/s/a.py'),
+    retract_path_facts('/s/b.py'),
+    retractall(kythe_node(sem_s,_,_,_,_,_,_)),
+    delete_directory_and_contents(ShardsDir).
+
+test(lazy_load_and_evict, [setup(make_test_shards(ShardsDir)),
+                           cleanup(cleanup_test_shards(ShardsDir))]) :-
+    load_global_shard(ShardsDir, 1),
+    assertion(\+ kythe_node(_,_,_,'/s/a.py',_,_,_)),
+    assertion(kythe_file('C','R','/s/a.py',python)),
+    % Loads the anchor's file and the files in the page of
+    % cross-references, even though that's more than the maximum.
+    ensure_shards_loaded(['/s/a.py']),
+    anchor_links(vname('#1','C','R','/s/a.py',python), 0, 10, _SemanticNodeValues, Total, Links),
+    assertion(Total == 2),
+    assertion(Links == ['/kythe/edge/defines/binding'-vname('#1','C','R','/s/a.py',python),
+                        '/kythe/edge/ref'-vname('#5','C','R','/s/b.py',python)]),
+    findall(Path, resident_shard(Path,_,_,_), Paths1),
+    msort(Paths1, Paths1Sorted),
+    assertion(Paths1Sorted == ['/s/a.py', '/s/b.py']),
+    assertion(anchor_link_anchor(vname('#1','C','R','/s/a.py',python), _, _, _,
+                                 vname('#5','C','R','/s/b.py',python))),
+    % A shard that's referenced by a request isn't evicted.
+    thread_self(ThreadId),
+    assertion(shard_ref('/s/a.py', ThreadId)),
+    ensure_shards_loaded(['/s/b.py']),
+    assertion(resident_shard('/s/a.py',_,_,_)),
+    release_shard_refs,
+    ensure_shards_loaded(['/s/b.py']),
+    release_shard_refs,
+    assertion(\+ resident_shard('/s/a.py',_,_,_)),
+    assertion(\+ kythe_node(_,_,_,'/s/a.py',_,_,_)),
+    assertion(kythe_node(sem_s,'C','R','',python, '/kythe/node/kind', variable)),
+    shard_stats(Stats),
+    assertion(Stats.num_resident == 1).
+
+:- end_tests(shards).
+
+:- begin_tests(xref_postings).
+
+test(page_and_update, [cleanup(retractall(xref_postings(sem_x,_,_,_,_,_,_)))]) :-
+    forall(member(Path-LineNo, ['/x/b.py'-3, '/x/a.py'-7, '/x/a.py'-2]),
+           ( Start is LineNo * 10,
+             assertz(xref_posting(sem_x,'C','R','',python, '/kythe/edge/ref',
+                                  'C','R',Path, LineNo, Start, python, '#s')) )),
+    index_xref_postings,
+    assertion(xref_postings(sem_x,'C','R','',python, 3,
+                            [posting('/kythe/edge/ref', 'C','R','/x/a.py', 2, 20, python, '#s'),
+                             posting('/kythe/edge/ref', 'C','R','/x/a.py', 7, 70, python, '#s'),
+                             posting('/kythe/edge/ref', 'C','R','/x/b.py', 3, 30, python, '#s')])),
+    xref_postings(sem_x,'C','R','',python, _, Postings),
+    list_page(Postings, 1, 5, Page),
+    assertion(Page = [posting(_,_,_,'/x/a.py', 7, _,_,_),
+                      posting(_,_,_,'/x/b.py', 3, _,_,_)]),
+    list_page(Postings, 5, 5, PageEmpty),
+    assertion(PageEmpty == []),
+    update_xref_postings(['/x/a.py'],
+                         [xref_posting(sem_x,'C','R','',python, '/kythe/edge/ref',
+                                       'C','R','/x/a.py', 4, 40, python, '#s')]),
+    assertion(xref_postings(sem_x,'C','R','',python, 2,
+                            [posting('/kythe/edge/ref', 'C','R','/x/a.py', 4, 40, python, '#s'),
+                             posting('/kythe/edge/ref', 'C','R','/x/b.py', 3, 30, python, '#s')])).
+
+test(request_page) :-
+    request_page(json{}, 200, 1000, PageStart1, PageSize1),
+    assertion(PageStart1-PageSize1 == 0-200),
+    request_page(json{page_start: 3, page_size: 1000000}, 200, 1000, PageStart2, PageSize2),
+    assertion(PageStart2-PageSize2 == 3-1000),
+    catch((request_page(json{page_size: -1}, 200, 1000, _, _), fail), error(type_error(nonneg, -1), _), true),
+    catch((request_page(json{page_start: x}, 200, 1000, _, _), fail), error(type_error(nonneg, x), _), true).
+
+:- end_tests(xref_postings).
+
+:- begin_tests(file_response).
+
+test(gzip_round_trip) :-
+    Str = "{\"value\":\"x \u00e9 \u4e16\"}",
+    gzip_string(Str, GzipBytes),
+    assertion(sub_string(GzipBytes, 0, 2, _, "\x1f\\x8b\")),
+    gunzip_string(GzipBytes, Str2),
+    assertion(Str2 == Str).
+
+test(invalidate, [cleanup(retractall(file_response_cache('C','R','/f/a.py',_,_,_,_,_)))]) :-
+    flag(kythe_facts_generation, Generation, Generation),
+    assertz(file_response_cache('C','R','/f/a.py', 1, end, Generation, '"etag"', "bytes")),
+    invalidate_file_responses,
+    assertion(\+ file_response_cache('C','R','/f/a.py', _, _, _, _, _)),
+    flag(kythe_facts_generation, Generation2, Generation2),
+    assertion(Generation2 =:= Generation + 1).
+
+test(block_line_range) :-
+    prewarm_block_lines(BlockLines),
+    assertion(block_line_range(1, BlockLines)),
+    Start2 is BlockLines + 1,
+    End2 is 2 * BlockLines,
+    assertion(block_line_range(Start2, End2)),
+    assertion(\+ block_line_range(1, end)),
+    assertion(\+ block_line_range(2, BlockLines)),
+    assertion(\+ block_line_range(1, 7)).
+
+:- end_tests(file_response).
+
+:- begin_tests(line_index).
+
+test(line_range, [cleanup(retract_path_facts('/l/a.py'))]) :-
+    assertz(kythe_node('', 'C','R','/l/a.py','', '/kythe/node/kind', file)),
+    assertz(kythe_node('', 'C','R','/l/a.py','', '/kythe/text', 'ab\ncd\n')),
+    format(atom(ColorTableStr), '~q',
+           [color_table(['<NEWLINE>', '<VAR_REF>'],
+                        [0, 0, 0, 0], [2, 1, 2, 1], [0, 0, 1, 0], [0, 2, 0, 2], [1, 0, 1, 0])]),
+    assert_color_table('C','R','/l/a.py',python, ColorTableStr),
+    assertion(color_line('C','R','/l/a.py', 2, [3, 5])),
+    assertion(\+ kythe_node(_, 'C','R','/l/a.py',_, '/pykythe/color/start', _)),
+    aggregate_all(count,
+                  ( color_file(FileId, 'C','R','/l/a.py',python, _Colors),
+                    color_item(FileId, _, _, _, _, _, _) ),
+                  NumItems),
+    assertion(NumItems == 4),
+    color_data_lines('C','R','/l/a.py', 2, end, Contents),
+    assertion(Contents.num_lines == 2),
+    assertion(Contents.line_end == 2),
+    Lines = Contents.lines,
+    assertion(Lines = [[_, _]]),
+    Lines = [Chunks],
+    findall(LineNo-Start-Value,
+            ( member(Chunk, Chunks),
+              color{lineno:LineNo, start:Start, value:Value} :< Chunk ),
+            ChunkValues),
+    assertion(ChunkValues == [2-3-cd, 2-5-'\n']).
+
+:- end_tests(line_index).
+
+:- begin_tests(search).
+
+make_test_search_index :-
+    assertz(xref_postings('m.Foo', 'C','R','',python, 3,
+                          [posting('/kythe/edge/defines/binding', 'C','R','/s/m.py', 1, 6, python, '@6:9'),
+                           posting('/kythe/edge/ref', 'C','R','/s/m.py', 3, 38, python, '@38:41'),
+                           posting('/kythe/edge/ref', 'C','R','/s/n.py', 1, 0, python, '@0:3')])),
+    assertz(xref_postings('m.Foo.foo_bar', 'C','R','',python, 1,
+                          [posting('/kythe/edge/defines/binding', 'C','R','/s/m.py', 2, 17, python, '@17:24')])),
+    assertz(xref_postings('m.barfoo', 'C','R','',python, 1,
+                          [posting('/kythe/edge/defines/binding', 'C','R','/s/n.py', 2, 10, python, '@10:16')])),
+    assertz(xref_postings('m.foo_ref', 'C','R','',python, 1,
+                          [posting('/kythe/edge/ref', 'C','R','/s/n.py', 3, 20, python, '@20:27')])),
+    assertz(kythe_node('', 'C','R','/s/m.py',python, '/kythe/text',
+                       'class Foo:\n  def foo_bar(self): pass\n\nFoo()\n')),
+    retractall(search_source_lines(_)),
+    assertz(search_source_lines(true)),
+    index_search.
+
+cleanup_test_search_index :-
+    retractall(xref_postings(_, 'C','R','',python, _, _)),
+    retract_path_facts('/s/m.py'),
+    retractall(search_source_lines(_)),
+    index_search.
+
+search_signatures(Query, Match, Signatures) :-
+    search_entries(symbol, Query, Match, Entries),
+    findall(Signature, member(symbol(Signature,_,_,_,_,_,_), Entries), Signatures).
+
+test(symbols, [setup(make_test_search_index),
+               cleanup(cleanup_test_search_index)]) :-
+    % m.foo_ref has no definition, so it isn't in the index
+    search_signatures(foo, substring, Signatures1),
+    assertion(Signatures1 == ['m.Foo', 'm.Foo.foo_bar', 'm.barfoo']),
+    search_signatures('FOO', prefix, Signatures2),
+    assertion(Signatures2 == ['m.Foo', 'm.Foo.foo_bar']),
+    search_signatures(fo, substring, Signatures3), % shorter than a trigram
+    assertion(Signatures3 == Signatures1),
+    search_signatures('m.foo.', substring, Signatures4),
+    assertion(Signatures4 == ['m.Foo.foo_bar']),
+    search_signatures(xyzzy, substring, Signatures5),
+    assertion(Signatures5 == []),
+    json_response(json{search: json{query: foo, page_start: 1, page_size: 1}}, Response),
+    assertion(Response.total == 3),
+    Response.results = [Result],
+    assertion(Result.signature == 'm.Foo.foo_bar'),
+    Result.definitions = [Definition],
+    assertion(Definition.path == '/s/m.py'),
+    assertion(Definition.lineno == 2),
+    json_response(json{search: json{query: foo, page_size: 1000000}}, ResponseMax),
+    assertion(ResponseMax.page_size == 500).
+
+test(lines, [setup(make_test_search_index),
+             cleanup(cleanup_test_search_index)]) :-
+    search_entries(line, foo, substring, Entries1),
+    findall(LineNo, member(line(_,_,'/s/m.py', LineNo, _), Entries1), LineNos1),
+    assertion(LineNos1 == [4, 1, 2]),
+    search_entries(line, 'def foo', prefix, Entries2),
+    assertion(Entries2 == [line('C','R','/s/m.py', 2, '  def foo_bar(self): pass')]).
+
+:- end_tests(search).
+
+:- begin_tests(startup).
+
+test(stages, [cleanup(retractall(startup_stage(_, _, _, _)))]) :-
+    retractall(startup_stage(_, _, _, _)),
+    assertz(startup_stage(load_facts, pending, 0, 0)),
+    assertz(startup_stage(xref_postings, pending, 0, 0)),
+    startup_status(Status1),
+    assertion(Status1.ready == false),
+    run_startup_stage(load_facts, true),
+    run_startup_stage(xref_postings, fail),
+    wait_for_startup_stage(xref_postings),
+    assertion(startup_stage(load_facts, done, _, _)),
+    assertion(startup_stage(xref_postings, failed(goal_failed), _, _)),
+    startup_status(Status2),
+    assertion(Status2.ready == true),
+    Stages = Status2.stages,
+    findall(Stage-StatusName,
+            ( member(StageJson, Stages),
+              json{stage:Stage, status:StatusName} :< StageJson ),
+            StageStatuses),
+    assertion(StageStatuses == [load_facts-done, xref_postings-failed]).
+
+test(wait_timeout, [cleanup(( retractall(startup_stage(_, _, _, _)),
+                              retractall(request_timeout(_)) ))]) :-
+    retractall(startup_stage(_, _, _, _)),
+    retractall(request_timeout(_)),
+    assertz(request_timeout(0.1)),
+    set_startup_stage(search_index, running, 0, 0),
+    catch(( wait_for_startup_stage(search_index), fail ),
+          http_reply(unavailable(_)), true),
+    thread_create(( sleep(0.05), set_startup_stage(search_index, done, 0, 0) ), Id, []),
+    wait_for_startup_stage(search_index),
+    thread_join(Id, JoinStatus),
+    assertion(JoinStatus == true).
+
+:- end_tests(startup).
+
+:- begin_tests(metrics).
+
+test(metrics, [cleanup(( retractall(request_metric(_, _, _, _, _, _, _)),
+                         retractall(cache_metric(_, _, _)),
+                         retractall(request_timeout(_)) ))]) :-
+    retractall(request_metric(_, _, _, _, _, _, _)),
+    retractall(cache_metric(_, _, _)),
+    retractall(request_timeout(_)),
+    record_request(fetch, 0.002, ok),
+    record_request(fetch, 0.2, ok),
+    record_request(fetch, 10.0, ok),
+    record_request(fetch, 0.0, timeout),
+    timed_request(anchor_xref, true),
+    catch(timed_request(anchor_xref, throw(http_reply(not_modified))), http_reply(_), true),
+    assertion(\+ timed_request(anchor_xref, fail)),
+    catch(timed_request(anchor_xref, throw(oops)), oops, true),
+    assertz(request_timeout(0.1)),
+    catch(timed_request(anchor_xref, sleep(1)), http_reply(unavailable(_)), true),
+    retractall(request_timeout(_)),
+    record_cache(file_response, hit),
+    record_cache(file_response, hit),
+    record_cache(file_response, hit),
+    record_cache(file_response, miss),
+    assertion(request_metric(fetch, 3, 1, 0, _, 10.0, [0,1,0,0,0,1,0,0,1])),
+    assertion(request_metric(anchor_xref, 2, 1, 2, _, _, _)),
+    metrics(Metrics),
+    assertion(Metrics.request_timeout == 0),
+    get_dict(caches, Metrics, [CacheJson]),
+    assertion(CacheJson.hit_rate =:= 0.75),
+    get_dict(requests, Metrics, RequestsJson),
+    findall(Type-Count,
+            ( member(RequestJson, RequestsJson),
+              json{type:Type, count:Count} :< RequestJson ),
+            TypeCounts),
+    assertion(TypeCounts == [fetch-3, anchor_xref-2]).
+
+:- end_tests(metrics).
+
 end_of_file.
@@ -58,7 +58,9 @@ class SourceItem {
 // items (see color_data.lines[*].edges)
 var g_anchor_edges = [];
 
-// tree of dir/file entries - set by dynamic load from server
+// tree of dir/file entries - set by dynamic load from server; a 'dir'
+// entry with lazy:true doesn't have its children yet (see
+// fetchFileTreeChildren)
 // TODO: can we get rid of this (singleton) global?
 var g_file_tree = null;
 
@@ -101,6 +103,17 @@ const is_token_name = {
     '<WHITESPACE>':         false,
 };
 
+// Number of lines fetched (and rendered) at a time for a source file;
+// should be the same as prewarm_block_lines/1 in src_browser.pl.
+const SRC_BLOCK_LINES = 500;
+
+// Delay (msec) after a keystroke in the search box before the search
+// request is sent (so that fast typing sends only one request).
+const SEARCH_DELAY_MSEC = 150;
+
+// Timer for SEARCH_DELAY_MSEC (see searchQueryChanged)
+var g_search_timeout = null;
+
 // Map a path item type ('dir' or 'file') to a class in the dropdown
 const path_type_to_class = {
     'dir':  'file_nav_sel_dir',
@@ -117,17 +130,44 @@ function renderPage() {
     } else {
         lineno = 1;
     }
-    fetchFromServer({src_file_tree: ''},
-                    file_tree_from_server => setFileTree(
-                        file_tree_from_server,
-                        new SourceItem(
-                            params.get('corpus'),
-                            params.get('root'),
-                            params.get('path'),
-                            lineno)));
+    fetchFileTree('',
+                  file_tree_from_server => setFileTree(
+                      file_tree_from_server,
+                      new SourceItem(
+                          params.get('corpus'),
+                          params.get('root'),
+                          params.get('path'),
+                          lineno)));
+}
+
+// Fetch the file tree for a directory ('' for the top of the tree).
+// This is a GET (rather than fetchFromServer's POST), so that the
+// browser can cache the response and revalidate it with its ETag.
+function fetchFileTree(dir, callback) {
+    fetch('/src_file_tree?' + new URLSearchParams({dir: dir}),
+          {method: 'GET',
+           credentials: 'same-origin',
+          })
+        .then(response => response.json())
+        .then(callback);
+}
+
+// Call callback after making sure that a 'dir' tree node has its
+// children (for a large tree, the server omits the children of
+// directories and marks them with lazy:true).
+function fetchFileTreeChildren(dir_node, callback) {
+    if (dir_node.lazy) {
+        fetchFileTree(dir_node.path, children => {
+            dir_node.children = children;
+            delete dir_node.lazy;
+            callback();
+        });
+    } else {
+        callback();
+    }
 }
 
-// Callback from fetchFromServer({src_file_tree: ''}),
+// Callback from fetchFileTree(''),
 // for displaying the file navigation tree
 function setFileTree(file_tree_from_server, source_item) {
     g_file_tree = file_tree_from_server;
@@ -183,8 +223,10 @@ function displayFileTreeItems(item_i, path_items, file_tree_nodes, lineno) {
 
     if (path_items.length > 0) {
         if (selected_node.type == 'dir') {
-            displayFileTreeItems(item_i + 1, path_items.slice(1),
-                                 selected_node.children, lineno);
+            fetchFileTreeChildren(
+                selected_node,
+                () => displayFileTreeItems(item_i + 1, path_items.slice(1),
+                                           selected_node.children, lineno));
         } else if (selected_node.type == 'file') {
             displayNewSrcFile(SourceItem.newFromCombined(selected_node.path, lineno));
         } else {
@@ -192,7 +234,9 @@ function displayFileTreeItems(item_i, path_items, file_tree_nodes, lineno) {
         }
     } else if (file_tree_nodes.length == 1) {
         if (file_tree_nodes[0].type == 'dir') {
-            displayFileTreeItems(item_i + 1, [], file_tree_nodes[0].children, lineno);
+            fetchFileTreeChildren(
+                file_tree_nodes[0],
+                () => displayFileTreeItems(item_i + 1, [], file_tree_nodes[0].children, lineno));
         } else if (file_tree_nodes[0].type == 'file') {
             displayNewSrcFile(SourceItem.newFromCombined(selected_node.path, lineno));
         } else {
@@ -231,42 +275,63 @@ function addDropdownOption(dropdown, text, type, id) {
 }
 
 // Callback from file tree navigation click, to load a file into the
-// file_nav_element() via displaySrcContents.
+// file_nav_element() via displaySrcContents. Only the block of lines
+// containing source_item.lineno is fetched; the other blocks are
+// fetched when they're scrolled into view (see fetchSrcBlockWhenVisible).
 function displayNewSrcFile(source_item) {
     var progress = document.createElement('span');
     progress.innerHTML = '&nbsp;&nbsp;&nbsp;Fetching file ' +
         sanitizeText(source_item.combinedFilePath()) + ' ...';
     file_nav_element().appendChild(progress);
+    const block = lineno_block(source_item.lineno);
+    fetchSrcBlock(source_item, block,
+                  color_data => displaySrcContents(source_item, color_data, block));
+}
+
+// Fetch a block of lines of a source file.
+function fetchSrcBlock(source_item, block, callback) {
     // TODO: alert if fetch fails
-    fetchFromServer(
-        {src_browser_file: {corpus: source_item.corpus,
-                            root: source_item.root,
-                            path: source_item.path}},
-        color_data => displaySrcContents(source_item, color_data));
+    // This is a GET (rather than fetchFromServer's POST), so that the
+    // browser can cache the response and revalidate it with its ETag.
+    const line_start = block * SRC_BLOCK_LINES + 1;
+    fetch('/src_browser_file?' +
+          new URLSearchParams({corpus: source_item.corpus,
+                               root: source_item.root,
+                               path: source_item.path,
+                               line_start: line_start,
+                               line_end: line_start + SRC_BLOCK_LINES - 1}),
+          {method: 'GET',
+           credentials: 'same-origin',
+          })
+        .then(response => response.json())
+        .then(callback);
 }
 
-// Callback from server fetch of a single source file (from displayNewSrcFile)
-function displaySrcContents(source_item, color_data) {
+// Callback from server fetch of a block of a single source file (from
+// displayNewSrcFile). The table has a <tbody> for each block; the
+// ones that haven't been fetched have a placeholder row.
+function displaySrcContents(source_item, color_data, block) {
     file_nav_element().lastChild.innerHTML =
         'Rendering file ' + source_item.combinedFilePath() + '...';
+    g_anchor_edges = [];
     var table = document.createElement('table');
     table.setAttribute('class', 'src_table');
-    for (var line_key = 1; line_key <= color_data.lines.length; line_key++) {
-        const line_parts = color_data.lines[line_key - 1];
-        var row = table.insertRow();
-        var td1 = row.insertCell();
-        td1.setAttribute('class', 'src_lineno');
-        td1.id = lineno_id(line_key);
-        var td2 = row.insertCell();
-        td2.setAttribute('class', 'src_line');
-        var txt_span = document.createElement('span');
-        if (line_parts.length) {
-            td1.appendChild(document.createTextNode(line_parts[0].lineno));
-            srcLineText(line_parts, txt_span, source_item);
+    const num_blocks = Math.max(1, Math.ceil(color_data.num_lines / SRC_BLOCK_LINES));
+    const observer = new IntersectionObserver(
+        entries => fetchSrcBlockWhenVisible(source_item, observer, entries));
+    for (var b = 0; b < num_blocks; b++) {
+        const tbody = table.createTBody();
+        tbody.id = 'src_block_' + b;
+        if (b == block) {
+            displaySrcBlock(tbody, source_item, color_data);
         } else {
-            txt_span.innerHTML = '&nbsp;';
+            const num_lines = Math.min(SRC_BLOCK_LINES, color_data.num_lines - b * SRC_BLOCK_LINES);
+            const placeholder = tbody.insertRow().insertCell();
+            placeholder.colSpan = 2;
+            placeholder.style.height = (num_lines * 1.2) + 'em';  // approximate
+            tbody.dataset.block = b;
+            observer.observe(tbody);
         }
-        td2.appendChild(txt_span);
     }
     replaceChildWith('src', table);
     if (source_item.lineno) {
@@ -280,6 +345,41 @@ function displaySrcContents(source_item, color_data) {
     file_nav_element().lastChild.remove(); // Remove status message
 }
 
+// Callback from the IntersectionObserver for the placeholder blocks
+function fetchSrcBlockWhenVisible(source_item, observer, entries) {
+    for (const entry of entries) {
+        if (entry.isIntersecting && entry.target.dataset.block !== undefined) {
+            const tbody = entry.target;
+            const block = parseInt(tbody.dataset.block);
+            delete tbody.dataset.block;
+            observer.unobserve(tbody);
+            fetchSrcBlock(source_item, block,
+                          color_data => displaySrcBlock(tbody, source_item, color_data));
+        }
+    }
+}
+
+// Fill in a <tbody> with a block of lines
+function displaySrcBlock(tbody, source_item, color_data) {
+    deleteAllChildren(tbody);
+    for (const line_parts of color_data.lines) {
+        var row = tbody.insertRow();
+        var td1 = row.insertCell();
+        td1.setAttribute('class', 'src_lineno');
+        var td2 = row.insertCell();
+        td2.setAttribute('class', 'src_line');
+        var txt_span = document.createElement('span');
+        if (line_parts.length) {
+            td1.id = lineno_id(line_parts[0].lineno);
+            td1.appendChild(document.createTextNode(line_parts[0].lineno));
+            srcLineText(line_parts, txt_span, source_item);
+        } else {
+            txt_span.innerHTML = '&nbsp;';
+        }
+        td2.appendChild(txt_span);
+    }
+}
+
 // Simplified source display (no active links)
 function srcLineTextSimple(txt_span, parts, highlight_semantic) {
     // DO NOT SUBMIT -- highlight_semantic_signature is FQN but
@@ -353,12 +453,19 @@ function mouseoverAnchor(target, class_action, class_id) {
 // Callback for a click on a token (anchor) in the source display
 function clickAnchor(target, source_item) {
     console.log('CLICK ' + target.id + ' in ' + source_item.combinedFilePath());
-    fetchFromServer({anchor_xref: {signature: target.id,
+    fetchXref(source_item, target.id, 0);
+}
+
+// Get a page of the cross-references for an anchor (the server
+// decides the page size).
+function fetchXref(source_item, signature, page_start) {
+    fetchFromServer({anchor_xref: {signature: signature,
                                    corpus: source_item.corpus,
                                    root: source_item.root,
                                    path: source_item.path,
-                                   language: 'python'}},  // DO NOT SUBMIT - don't hard-code language
-                    data => setXref(source_item, target.id, data));
+                                   language: 'python',  // DO NOT SUBMIT - don't hard-code language
+                                   page_start: page_start}},
+                    data => setXref(source_item, signature, data));
 }
 
 // Callback from getting Kythe facts for a token (anchor) click
@@ -421,11 +528,123 @@ function setXref(source_item, signature, data) {
             }
         }
     }
+    if (data.total > data.page_size) {
+        addXrefPageLinks(table, source_item, signature, data);
+    }
     row_cell = tableInsertRowCell(table);
     cellHTML(row_cell, '&nbsp;');  // ensure some space at the bottom
     replaceChildWith('xref', table);
 }
 
+// Add "previous" and "next" links for a page of cross-references
+function addXrefPageLinks(table, source_item, signature, data) {
+    const page_end = Math.min(data.page_start + data.page_size, data.total);
+    const row_cell = tableInsertRowCell(table);
+    row_cell.setAttribute('class', 'xref_head');
+    cellHTML(row_cell, sanitizeText('Showing ' + (data.page_start + 1) + '-' + page_end +
+                                    ' of ' + data.total + ' '));
+    if (data.page_start > 0) {
+        const prev = row_cell.appendChild(document.createElement('a'));
+        prev.href = 'javascript:void(0)';
+        prev.innerHTML = '&lt;&nbsp;previous ';
+        prev.onclick = () => fetchXref(source_item, signature,
+                                       Math.max(data.page_start - data.page_size, 0));
+    }
+    if (page_end < data.total) {
+        const next = row_cell.appendChild(document.createElement('a'));
+        next.href = 'javascript:void(0)';
+        next.innerHTML = 'next&nbsp;&gt;';
+        next.onclick = () => fetchXref(source_item, signature, page_end);
+    }
+}
+
+// Callback from the search box (id='search_query') or its kind
+// dropdown (id='search_kind')
+function searchQueryChanged() {
+    clearTimeout(g_search_timeout);
+    g_search_timeout = setTimeout(() => fetchSearch(0), SEARCH_DELAY_MSEC);
+}
+
+// Get a page of search results (the server decides the page size).
+function fetchSearch(page_start) {
+    const query = document.getElementById('search_query').value;
+    const kind = document.getElementById('search_kind').value;
+    if (query.length == 0) {
+        return;
+    }
+    fetchFromServer({search: {query: query,
+                              kind: kind,
+                              page_start: page_start}},
+                    data => setSearchResults(data));
+}
+
+// Callback from fetchSearch: display the results (id='xref'), with
+// links to the definitions (symbols) or lines.
+function setSearchResults(data) {
+    if (data.query != document.getElementById('search_query').value) {
+        return;  // A newer query has been sent
+    }
+    var table = document.createElement('table');
+    table.setAttribute('class', 'src_table');
+    var row_cell = tableInsertRowCell(table);
+    row_cell.setAttribute('class', 'xref_head');
+    cellHTML(row_cell, sanitizeText('Search for "' + data.query + '": ' +
+                                    singular_plural(data.total, 'result', 'results') +
+                                    ' (' + Math.round(data.seconds * 1000) + ' msec)'));
+    for (const result of data.results) {
+        row_cell = tableInsertRowCell(table);
+        if (result.kind == 'symbol') {
+            cellHTML(row_cell, '<i><b>' + sanitizeText(result.signature) + '</b></i>' +
+                     sanitizeText(' (' + singular_plural(result.num_refs, 'ref', 'refs') + ')'));
+            for (const def of result.definitions) {
+                addSearchResultLink(tableInsertRowCell(table), def,
+                                    def.path + ':' + def.lineno);
+            }
+        } else {
+            addSearchResultLink(row_cell, result,
+                                result.path + ':' + result.lineno + ': ' + result.text);
+        }
+    }
+    if (data.total > data.page_size) {
+        addSearchPageLinks(table, data);
+    }
+    row_cell = tableInsertRowCell(table);
+    cellHTML(row_cell, '&nbsp;');  // ensure some space at the bottom
+    replaceChildWith('xref', table);
+}
+
+// Add a link to a file's line (link has corpus, root, path, lineno)
+function addSearchResultLink(cell, link, text) {
+    const a = cell.appendChild(document.createElement('a'));
+    a.href = location.origin + location.pathname + '?' +
+        new URLSearchParams({corpus: link.corpus,
+                             root: link.root,
+                             path: link.path}) +
+        '#' + lineno_id(link.lineno);
+    a.innerHTML = '&nbsp;&nbsp;' + sanitizeText(text);
+}
+
+// Add "previous" and "next" links for a page of search results
+function addSearchPageLinks(table, data) {
+    const page_end = Math.min(data.page_start + data.page_size, data.total);
+    const row_cell = tableInsertRowCell(table);
+    row_cell.setAttribute('class', 'xref_head');
+    cellHTML(row_cell, sanitizeText('Showing ' + (data.page_start + 1) + '-' + page_end +
+                                    ' of ' + data.total + ' '));
+    if (data.page_start > 0) {
+        const prev = row_cell.appendChild(document.createElement('a'));
+        prev.href = 'javascript:void(0)';
+        prev.innerHTML = '&lt;&nbsp;previous ';
+        prev.onclick = () => fetchSearch(Math.max(data.page_start - data.page_size, 0));
+    }
+    if (page_end < data.total) {
+        const next = row_cell.appendChild(document.createElement('a'));
+        next.href = 'javascript:void(0)';
+        next.innerHTML = 'next&nbsp;&gt;';
+        next.onclick = () => fetchSearch(page_end);
+    }
+}
+
 function tableInsertRowCell(table) {
     return table.insertRow().insertCell();
 }
@@ -525,6 +744,11 @@ function file_nav_element() {
     return document.getElementById('file_nav');
 }
 
+// The (0-origin) block number for a lineno (see SRC_BLOCK_LINES)
+function lineno_block(lineno) {
+    return Math.floor(Math.max(lineno - 1, 0) / SRC_BLOCK_LINES);
+}
+
 // Convert a lineno to an ID
 function lineno_id(lineno) {
     return 'L' + lineno;
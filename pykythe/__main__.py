@@ -6,21 +6,33 @@ This is called by pykythe.pl, which further processes the AST.
 
 import argparse
 import base64
+import contextlib
 from dataclasses import dataclass
 import hashlib
 import logging
+import re
+import resource
+import signal
 import sys
+import time
 import traceback
 from lib2to3 import pytree
 from lib2to3.pgen2 import parse as pgen2_parse
 from lib2to3.pgen2 import tokenize as pgen2_tokenize
-from typing import Iterable, Optional, Text, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, Optional, Text, Tuple, Union
 
 from . import ast, ast_raw, ast_cooked, ast_color, pod
 from .typing_debug import cast as xcast
 
 # TODO: a bit more refactoring - look at error types, for example.
 
+# Version of the output format and contents (the cooked AST with FQNs
+# and the color items). Bump this when a change could alter the output
+# for some source file; it's part of the cache version (see
+# scripts/cache_versions.py), so bumping it invalidates all cache
+# entries.
+PARSER_OUTPUT_VERSION = 1
+
 RawBaseType = Union[ast_raw.Node, ast_raw.Leaf]
 
 
@@ -41,17 +53,36 @@ def main() -> int:
     # TODO: add to ast.File: args.root, args.corpus (even though they're in Meta)
 
     args = _get_args()
+    _validate_cache_version(args.cache_version)
     pykythe_logger.info('Start parsing %s', args.srcpath)
-    src_file, parse_error = _make_file(args)
+    metrics = Metrics()
+    with metrics.phase('read_decode'):
+        src_file, parse_error = _make_file(args)
     if src_file:
         assert not parse_error
-        parse_tree, parse_error = _parse_file(src_file, args)
-        if parse_tree:
-            assert not parse_error
-            parse_tree, with_fqns, parse_error = _process_ast(src_file, parse_tree, args)
-        else:
-            assert parse_error
-            with_fqns = parse_error
+        metrics.values['src_bytes'] = len(src_file.contents_bytes)
+        parse_tree = None
+        budget = _set_budget(args)
+        try:
+            with metrics.phase('parse'):
+                parse_tree, parse_error = _parse_file(src_file, args)
+            if parse_tree:
+                assert not parse_error
+                parse_tree, with_fqns, parse_error = _process_ast(
+                        src_file, parse_tree, args, metrics)
+            else:
+                assert parse_error
+                with_fqns = parse_error
+        except (BudgetExceeded, MemoryError, RecursionError) as exc:
+            # Output only the file-level information (and colors, if
+            # the parse finished).
+            with_fqns = Crash(str=f'{BUDGET_EXCEEDED}: {exc!r}',
+                              repr=repr(exc),
+                              srcpath=args.srcpath)
+            parse_error = None
+            pykythe_logger.error('pykythe.__main__.main: %s: %s', with_fqns.str, args.srcpath)
+        finally:
+            _clear_budget(budget)
 
         # b64encode returns bytes, so use decode() to turn it into a
         # string, because json.dumps can't process bytes -- it
@@ -84,13 +115,27 @@ def main() -> int:
                 sha1=hashlib.sha1(b'').hexdigest(),
                 encoding='ascii')
 
-    colored = ast_color.ColorFile(src_file, parse_tree, dict(with_fqns.name_astns())).color()
-
+    with metrics.phase('color'):
+        try:
+            colored = ast_color.ColorFile(src_file, parse_tree,
+                                          dict(with_fqns.name_astns())).color()
+        except RecursionError:  # A deeply nested parse tree that exceeded the budget.
+            colored = []
+
+    with metrics.phase('serialize'):
+        out_strs = [
+                meta.as_prolog_str(),
+                with_fqns.as_prolog_str(),
+                ast_color.colored_list_as_prolog_str(colored)
+        ]
+    metrics.values['output_bytes'] = sum(len(out_str.encode('utf-8')) + 2 for out_str in out_strs)
     with open(args.out_fqn_ast, 'w') as out_fqn_ast_file:
         pykythe_logger.debug('Output fqn= %r', out_fqn_ast_file)
-        print(meta.as_prolog_str() + '.', file=out_fqn_ast_file)
-        print(with_fqns.as_prolog_str() + '.', file=out_fqn_ast_file)
-        print(ast_color.colored_list_as_prolog_str(colored) + '.', file=out_fqn_ast_file)
+        for out_str in out_strs:
+            print(out_str + '.', file=out_fqn_ast_file)
+        # The metrics are the last item, so that pykythe.pl can treat
+        # them as optional.
+        print(metrics.as_prolog_str() + '.', file=out_fqn_ast_file)
     pykythe_logger.debug('Finished')
     pykythe_logger.info('End parsing %s', args.srcpath)
     return 0
@@ -119,9 +164,88 @@ def _get_args() -> argparse.Namespace:
             choices=[2, 3],
             type=int,
             help='Python major version')
+    parser.add_argument('--cache_version',
+                        default='',
+                        help='Cache version (from pykythe.pl --version), to check '
+                        'against PARSER_OUTPUT_VERSION')
+    parser.add_argument('--max_cpu_seconds',
+                        default=0.0,
+                        type=float,
+                        help='CPU time budget for parsing (0 for no limit)')
+    parser.add_argument('--max_memory_mb',
+                        default=0,
+                        type=int,
+                        help='Memory (address space) budget for parsing, in MB (0 for no limit)')
     return parser.parse_args()
 
 
+def _validate_cache_version(cache_version: str) -> None:
+    """Check the parser layer of a layered cache version (see scripts/cache_versions.py)."""
+    match = re.fullmatch(r'parser(\d+)-symtab\d+-kythe\d+', cache_version)
+    if match and int(match.group(1)) != PARSER_OUTPUT_VERSION:
+        raise SystemExit(f'--cache_version={cache_version} should have '
+                         f'parser{PARSER_OUTPUT_VERSION} (see scripts/cache_versions.py)')
+
+
+# Prefix of Crash.str when a budget is exceeded (see pykythe.pl's
+# parser_budget_exceeded/2).
+BUDGET_EXCEEDED = 'Budget exceeded'
+
+
+class BudgetExceeded(BaseException):
+    """Raised when --max_cpu_seconds is exceeded.
+
+    This is a BaseException (like KeyboardInterrupt) so that it isn't
+    caught by the "except Exception" handlers.
+    """
+
+
+def _cpu_budget_exceeded(signum: int, frame: object) -> None:  # pylint: disable=unused-argument
+    raise BudgetExceeded('cpu')
+
+
+@dataclass(frozen=True)
+class _Budget:
+    """What _set_budget() changed, for _clear_budget() to restore.
+
+    Attributes:
+      cpu_timer: whether the SIGPROF timer was set (for --max_cpu_seconds).
+      sigprof_handler: the original SIGPROF handler (if cpu_timer).
+      memory_rlimit: the original (soft, hard) RLIMIT_AS (None if
+           there's no --max_memory_mb).
+    """
+
+    cpu_timer: bool
+    sigprof_handler: Any
+    memory_rlimit: Optional[Tuple[int, int]]
+
+
+def _set_budget(args: argparse.Namespace) -> _Budget:
+    """Apply --max_cpu_seconds and --max_memory_mb (see _clear_budget())."""
+    sigprof_handler: Any = None
+    memory_rlimit = None
+    if args.max_cpu_seconds:
+        sigprof_handler = signal.signal(signal.SIGPROF, _cpu_budget_exceeded)
+        signal.setitimer(signal.ITIMER_PROF, args.max_cpu_seconds)
+    if args.max_memory_mb:
+        # Exceeding this raises MemoryError.
+        memory_rlimit = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS,
+                           (args.max_memory_mb * 1024 * 1024, memory_rlimit[1]))
+    return _Budget(cpu_timer=bool(args.max_cpu_seconds),
+                   sigprof_handler=sigprof_handler,
+                   memory_rlimit=memory_rlimit)
+
+
+def _clear_budget(budget: _Budget) -> None:
+    """Restore what _set_budget() changed, so that output can be done."""
+    if budget.cpu_timer:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, budget.sigprof_handler or signal.SIG_DFL)
+    if budget.memory_rlimit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, budget.memory_rlimit)
+
+
 def _make_file(
         args: argparse.Namespace) -> Tuple[Optional[ast.File], Optional['CompilationError']]:
     parse_error: Optional['CompilationError']
@@ -184,7 +308,7 @@ def _parse_file(src_file: ast.File,
 
 
 def _process_ast(
-        src_file: ast.File, parse_tree: RawBaseType, args: argparse.Namespace
+        src_file: ast.File, parse_tree: RawBaseType, args: argparse.Namespace, metrics: 'Metrics'
 ) -> Tuple[Optional[RawBaseType], Union['Crash', 'ParseError', ast_cooked.Base],
            Optional['ParseError']]:
     logging.getLogger('pykythe').debug('RAW= %r', parse_tree)
@@ -192,8 +316,10 @@ def _process_ast(
     with_fqns: Union[ast_cooked.Base, 'ParseError', 'Crash']
     parse_error: Optional[Union['ParseError', Exception]]
     try:
-        cooked_nodes = ast_raw.cvt_parse_tree(parse_tree, args.python_version, src_file)
-        with_fqns = ast_cooked.add_fqns(cooked_nodes, args.module, args.python_version)
+        with metrics.phase('cvt_parse_tree'):
+            cooked_nodes = ast_raw.cvt_parse_tree(parse_tree, args.python_version, src_file)
+        with metrics.phase('add_fqns'):
+            with_fqns = ast_cooked.add_fqns(cooked_nodes, args.module, args.python_version)
         parse_error = None
         new_parse_tree = parse_tree
     except pgen2_parse.ParseError as exc:
@@ -207,6 +333,8 @@ def _process_ast(
         with_fqns = parse_error
         logging.getLogger('pykythe').error('pykythe.__main__._process_ast: Parse error: %s',
                                            parse_error)  # DO NOT SUBMIT - error message form
+    except (MemoryError, RecursionError):
+        raise  # Handled by main() as exceeding the budget
     except Exception as exc:  # pylint: disable=broad-except
         # DO NOT SUBMIT: the parse_error assignment is probably incorrect
         parse_error = exc  # TODO: is this correct? we get this from an assertion check, for example
@@ -219,6 +347,36 @@ def _process_ast(
     return new_parse_tree, with_fqns, parse_error
 
 
+class Metrics:
+    """Timings (in seconds) and sizes for the phases of processing a file.
+
+    These are output as a Prolog dict (the last item in --out_fqn_ast);
+    pykythe.pl adds them to its own metrics for the file (see its
+    --metrics_out option).
+    """
+
+    values: Dict[str, Union[int, float]]
+
+    def __init__(self) -> None:
+        self.values = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Context manager that records the elapsed time as `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.values[name] = time.perf_counter() - start
+
+    def as_prolog_str(self) -> str:
+        # Floats are formatted without an exponent, which some Prolog
+        # readers don't accept in the form Python outputs (e.g., 1e-05).
+        return 'parser_metrics{' + ','.join(
+                f'{key}:{value:.6f}' if isinstance(value, float) else f'{key}:{value}'
+                for key, value in sorted(self.values.items())) + '}'
+
+
 class CompilationError(pod.PlainOldDataExtended):
     """Base error class that defines do-nothing pre_order, name_astns."""
 
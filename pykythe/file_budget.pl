@@ -0,0 +1,132 @@
+% -*- mode: Prolog -*-
+
+%% Per-file time budget and skip list.
+%%
+%% A few pathological source files (e.g., huge generated tables or
+%% deeply nested expressions) can take far more time or memory than
+%% the rest of a corpus put together. So, processing of a file (pass 1
+%% and the fixpoint) can be given a time budget and, if it's exceeded
+%% (or the Prolog stacks overflow), the file gets only file-level
+%% output (see process_module_from_src_impl/5 in pykythe.pl) and is
+%% recorded in the skip list, which is a file of JSON lines (one per
+%% overrun, with the file's metrics). Files in the skip list (with the
+%% same SHA1 as when they were recorded) aren't processed again. The
+%% file-level output is also cached like any other output, so to retry
+%% a file (e.g., with a bigger budget), remove its line from the skip
+%% list and its cache files (or use a different --version).
+%%
+%% The Python parser has its own CPU and memory budget
+%% (--parse_cpu_limit, --parse_memory_limit, which are passed to
+%% pykythe/__main__.py); if it's exceeded, the parser outputs only the
+%% file's text and colors.
+
+:- module(file_budget, [skip_list_add/3,
+                        skip_list_load/1,
+                        skip_listed/2,
+                        with_file_budget/3
+                       ]).
+:- encoding(utf8).
+% :- set_prolog_flag(autoload, false).  % TODO: seems to break plunit, qsave
+
+:- use_module(library(http/json), [json_write_dict/3]).
+:- use_module(library(rdet), [rdet/1]).
+:- use_module(library(time), [alarm/4, remove_alarm/1]).
+:- use_module(pykythe_utils).
+
+:- style_check(+singleton).
+:- style_check(+var_branches).
+:- style_check(+no_effect).
+:- style_check(+discontiguous).
+% :- set_prolog_flag(generate_debug_info, false).
+
+:- meta_predicate
+       with_file_budget(+, 0, -).
+
+:- if(true).  % Turning off rdet can sometimes make debugging easier.
+
+:- maplist(rdet, [
+                  skip_list_add/3,
+                  skip_list_load/1,
+                  with_file_budget/3
+                 ]).
+:- endif.
+
+%! skip_listed(?SrcPath:atom, ?Sha1:atom) is nondet.
+% SrcPath (with contents that have Sha1) exceeded its budget in a
+% previous run.
+:- dynamic skip_listed/2.
+
+%! with_file_budget(+Seconds:float, :Goal, -Result) is det.
+% Call Goal (once) with a time limit of Seconds (0 for no limit),
+% unifying Result with `ok` if it finishes or overrun(Reason) if it
+% exceeds the time limit (Reason=time) or a resource limit (e.g.,
+% Reason=stack_overflow). Other exceptions are passed through.
+% The time is wall-clock (see alarm/4) and includes any imported
+% modules that Goal processes from source. The alarm's exception term
+% is unique to this call, so a nested with_file_budget/3 (for an
+% imported module) doesn't catch the time limit of an outer one.
+with_file_budget(Seconds, Goal, Result) :-
+    (   Seconds =< 0
+    ->  Tag = none,
+        BudgetGoal = Goal
+    ;   flag(file_budget_tag, Tag, Tag + 1),
+        BudgetGoal = call_with_alarm(Seconds, Goal, Tag)
+    ),
+    catch(( once(BudgetGoal), Result = ok ),
+          Error,
+          budget_error(Error, Tag, Result)).
+
+%! call_with_alarm(+Seconds:float, :Goal, +Tag:integer) is semidet.
+% Similar to call_with_time_limit/2, but throws file_budget_exceeded(Tag).
+call_with_alarm(Seconds, Goal, Tag) :-
+    setup_call_cleanup(alarm(Seconds, throw(file_budget_exceeded(Tag)), AlarmId, []),
+                       once(Goal),
+                       remove_alarm(AlarmId)).
+
+%! budget_error(+Error, +Tag, -Result) is det.
+budget_error(file_budget_exceeded(Tag), Tag, overrun(time)) :- !.
+budget_error(error(resource_error(Resource), _), _Tag, overrun(Resource)) :- !.
+budget_error(Error, _Tag, _Result) :-
+    throw(Error).
+
+%! skip_list_load(+SkipListPath:atom) is det.
+% Load the skip list written by skip_list_add/3. Does nothing if
+% SkipListPath is '' or the file doesn't exist.
+skip_list_load(SkipListPath) :-
+    retractall(skip_listed(_, _)),
+    (   SkipListPath \== '',
+        maybe_open_read(SkipListPath, SkipListStream)
+    ->  call_cleanup(read_skip_list(SkipListStream),
+                     close(SkipListStream))
+    ;   true
+    ).
+
+read_skip_list(SkipListStream) :-
+    pykythe_json_read_dict(SkipListStream, Entry),
+    (   Entry == @(end)
+    ->  true
+    ;   assertz(skip_listed(Entry.path, Entry.sha1)),
+        read_skip_list(SkipListStream)
+    ).
+
+%! skip_list_add(+SkipListPath:atom, +SrcPath:atom, +Entry:dict) is det.
+% Record that SrcPath exceeded its budget, appending Entry (which must
+% have path and sha1 keys, plus whatever metrics are available) as a
+% JSON line to SkipListPath (if it isn't '').
+skip_list_add(SkipListPath, SrcPath, Entry) :-
+    assertz(skip_listed(SrcPath, Entry.sha1)),
+    (   SkipListPath == ''
+    ->  true
+    ;   with_output_to(
+            string(EntryJson),
+            json_write_dict(current_output, Entry, [width(0)])),
+        % A single write of the whole line, so that lines from
+        % concurrent processes aren't interleaved.
+        string_concat(EntryJson, "\n", EntryLine),
+        setup_call_cleanup(
+            open(SkipListPath, append, SkipListStream, [encoding(utf8), buffer(full)]),
+            write(SkipListStream, EntryLine),
+            close(SkipListStream))
+    ).
+
+end_of_file.
@@ -122,6 +122,7 @@ is_module(Sym-Type, Sym-Type) :-
 write_symtab_fact(Opts, BuiltinsModule, Symtab, BuiltinsSymtab, BuiltinsPairs, SymtabModules, Stream) :-
     format(Stream, '~k.~n', [builtins_version(Opts.version)]),
     format(Stream, '~k.~n', [builtins_module(BuiltinsModule)]), % TODO: needed?
+    format(Stream, '~k.~n', [builtins_pythonpath(Opts.pythonpath)]),
     format(Stream, '~k.~n', [builtins_symtab(Symtab)]),
     format(Stream, '~k.~n', [builtins_pairs(BuiltinsPairs)]),
     format(Stream, '~k.~n', [builtins_symtab_modules(SymtabModules)]),
@@ -0,0 +1,202 @@
+% -*- mode: Prolog -*-
+
+%% Import graph, for incremental reindexing of changed files.
+%%
+%% The cache (see process_module_cached_or_from_src/6 in pykythe.pl)
+%% only validates a module's forward dependencies, and only when the
+%% module is processed: if a module changes, the modules that import it
+%% aren't reprocessed unless they're asked for -- and even then, their
+%% cache entries are reused once the changed module's cache entry has
+%% been updated. So, each module that's processed from source records
+%% the modules that it imports; the resulting graph is saved between
+%% runs (import_graph_save/1, import_graph_load/1) and, given a list of
+%% changed files, import_graph_affected/4 computes the modules that
+%% need to be reprocessed: the changed files and everything that
+%% (transitively) imports them.
+%%
+%% Several pykythe processes can share the graph file (e.g., "parallel"
+%% in the Makefile), so import_graph_save/1 merges this run's changes
+%% into the file's current contents, under a lock.
+
+:- module(import_graph, [import_graph_affected/4,
+                         import_graph_load/1,
+                         import_graph_remove/1,
+                         import_graph_save/1,
+                         import_graph_set_imports/2
+                        ]).
+:- encoding(utf8).
+% :- set_prolog_flag(autoload, false).  % TODO: seems to break plunit, qsave
+
+:- use_module(library(apply), [foldl/4, maplist/2, partition/4]).
+:- use_module(library(lists), [append/3, member/2, reverse/2]).
+:- use_module(library(ordsets), [list_to_ord_set/2, ord_add_element/3, ord_memberchk/2, ord_subtract/3]).
+:- use_module(library(rdet), [rdet/1]).
+:- use_module(must_once, [must_once/1]).
+:- use_module(pykythe_utils).
+
+:- style_check(+singleton).
+:- style_check(+var_branches).
+:- style_check(+no_effect).
+:- style_check(+discontiguous).
+% :- set_prolog_flag(generate_debug_info, false).
+
+:- if(true).  % Turning off rdet can sometimes make debugging easier.
+
+:- maplist(rdet, [
+                  import_graph_affected/4,
+                  import_graph_load/1,
+                  import_graph_remove/1,
+                  % import_graph_save/1,  % Is det, but expansion confuses write_atomic_stream/2.
+                  % merge_save_import_graph/1,  % ditto
+                  import_graph_set_imports/2,
+                  affected_closure/3,
+                  dependency_order/2,
+                  write_import_graph/1
+                 ]).
+:- endif.
+
+%! graph_module(?SrcPath:atom) is nondet.
+% SrcPath was processed from source, so its imports are known.
+%! graph_import(?SrcPath:atom, ?ImportedPath:atom) is nondet.
+% SrcPath imports ImportedPath. Lookups are done with either argument
+% instantiated (relying on JIT indexing for the second argument).
+%! graph_changed(?SrcPath:atom) is nondet.
+% SrcPath's imports were set or removed by this run (rather than
+% loaded by import_graph_load/1), so they take precedence over the
+% graph file's when saving.
+:- dynamic
+    graph_module/1,
+    graph_import/2,
+    graph_changed/1.
+
+%! import_graph_set_imports(+SrcPath:atom, +ImportedPaths:list(atom)) is det.
+% Record (replacing any previous information) that SrcPath imports
+% ImportedPaths.
+import_graph_set_imports(SrcPath, ImportedPaths) :-
+    set_graph_changed(SrcPath),
+    set_graph_imports(SrcPath, ImportedPaths).
+
+set_graph_imports(SrcPath, ImportedPaths) :-
+    remove_graph_module(SrcPath),
+    assertz(graph_module(SrcPath)),
+    list_to_ord_set(ImportedPaths, ImportedPathsSet),
+    forall(member(ImportedPath, ImportedPathsSet),
+           assertz(graph_import(SrcPath, ImportedPath))).
+
+%! import_graph_remove(+SrcPath:atom) is det.
+% Remove SrcPath's imports (e.g., because it has been deleted).
+% Any imports of SrcPath are left, so that if it is re-created, the
+% modules that import it are still known.
+import_graph_remove(SrcPath) :-
+    set_graph_changed(SrcPath),
+    remove_graph_module(SrcPath).
+
+remove_graph_module(SrcPath) :-
+    retractall(graph_module(SrcPath)),
+    retractall(graph_import(SrcPath, _)).
+
+set_graph_changed(SrcPath) :-
+    (   graph_changed(SrcPath)
+    ->  true
+    ;   assertz(graph_changed(SrcPath))
+    ).
+
+%! import_graph_affected(+ChangedPaths:list(atom), -Affected:list(atom), -Unknown:list(atom), -Skipped:list(atom)) is det.
+% Affected is ChangedPaths and all the modules that (transitively)
+% import them, ordered so that a module comes after the modules that it
+% imports (except for import cycles, which are broken arbitrarily).
+% Unknown are the elements of ChangedPaths that aren't in the graph
+% (these are left out of Affected), and Skipped are the modules in the
+% graph that aren't in Affected.
+import_graph_affected(ChangedPaths, Affected, Unknown, Skipped) :-
+    partition(is_graph_path, ChangedPaths, KnownPaths, Unknown),
+    affected_closure(KnownPaths, [], AffectedSet),
+    dependency_order(AffectedSet, Affected),
+    findall(SrcPath, graph_module(SrcPath), GraphModules0),
+    list_to_ord_set(GraphModules0, GraphModules),
+    ord_subtract(GraphModules, AffectedSet, Skipped).
+
+%! is_graph_path(+Path:atom) is semidet.
+is_graph_path(Path) :-
+    once(( graph_module(Path) ; graph_import(_, Path) )).
+
+%! affected_closure(+Paths:list(atom), +AffectedSet0:ordset, -AffectedSet:ordset) is det.
+affected_closure([], AffectedSet, AffectedSet).
+affected_closure([Path|Paths], AffectedSet0, AffectedSet) :-
+    (   ord_memberchk(Path, AffectedSet0)
+    ->  affected_closure(Paths, AffectedSet0, AffectedSet)
+    ;   ord_add_element(AffectedSet0, Path, AffectedSet1),
+        findall(Importer, graph_import(Importer, Path), Importers),
+        append(Importers, Paths, Paths2),
+        affected_closure(Paths2, AffectedSet1, AffectedSet)
+    ).
+
+%! dependency_order(+PathSet:ordset, -Ordered:list(atom)) is det.
+% Order PathSet depth-first, so that each module comes after the
+% modules that it imports (only imports within PathSet are considered).
+dependency_order(PathSet, Ordered) :-
+    foldl(visit(PathSet), PathSet, []-[], _Visited-RevOrdered),
+    reverse(RevOrdered, Ordered).
+
+%! visit(+PathSet:ordset, +Path:atom, +VisitedRevOrdered0:pair, -VisitedRevOrdered:pair) is det.
+visit(PathSet, Path, Visited0-RevOrdered0, Visited-RevOrdered) :-
+    (   ord_memberchk(Path, Visited0)
+    ->  Visited = Visited0,
+        RevOrdered = RevOrdered0
+    ;   ord_add_element(Visited0, Path, Visited1),
+        findall(ImportedPath,
+                ( graph_import(Path, ImportedPath),
+                  ord_memberchk(ImportedPath, PathSet) ),
+                ImportedPaths),
+        foldl(visit(PathSet), ImportedPaths, Visited1-RevOrdered0, Visited-RevOrdered1),
+        RevOrdered = [Path|RevOrdered1]
+    ).
+
+%! import_graph_load(+GraphPath:atom) is det.
+% Load the graph from a file written by import_graph_save/1.
+% Does nothing if GraphPath is '' or the file doesn't exist (or is for
+% a different version of this file's format).
+import_graph_load(GraphPath) :-
+    (   GraphPath \== '',
+        maybe_open_read(GraphPath, GraphStream)
+    ->  call_cleanup(read_term(GraphStream, GraphTerm, []),
+                     close(GraphStream)),
+        (   GraphTerm = import_graph(1, Modules)
+        ->  maplist(load_graph_module, Modules)
+        ;   log_if(true, 'WARNING: ignoring import graph ~q', [GraphPath])
+        )
+    ;   true
+    ).
+
+load_graph_module(module(SrcPath, ImportedPaths)) :-
+    % Information from this run (if any) takes precedence.
+    (   graph_changed(SrcPath)
+    ->  true
+    ;   set_graph_imports(SrcPath, ImportedPaths)
+    ).
+
+%! import_graph_save(+GraphPath:atom) is det.
+% Write the graph, for use by import_graph_load/1. Does nothing if
+% GraphPath is ''. Other processes might have saved the graph since
+% it was loaded, so this run's changes (graph_changed/1) are merged
+% into the file's current contents.
+import_graph_save(GraphPath) :-
+    (   GraphPath == ''
+    ->  true
+    ;   must_once(with_file_lock(GraphPath, merge_save_import_graph(GraphPath)))
+    ).
+
+merge_save_import_graph(GraphPath) :-
+    forall(( graph_module(SrcPath), \+ graph_changed(SrcPath) ),
+           remove_graph_module(SrcPath)),
+    import_graph_load(GraphPath),
+    write_atomic_stream(write_import_graph, GraphPath).
+
+write_import_graph(GraphStream) :-
+    findall(module(SrcPath, ImportedPaths),
+            ( graph_module(SrcPath),
+              findall(ImportedPath, graph_import(SrcPath, ImportedPath), ImportedPaths) ),
+            Modules),
+    format(GraphStream, '~k.~n', [import_graph(1, Modules)]).
+
+end_of_file.
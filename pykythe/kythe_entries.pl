@@ -0,0 +1,254 @@
+% -*- mode: Prolog -*-
+
+%% Write Kythe entries in the "delimited" protobuf wire format, as
+%% output by `entrystream` (its default output format): each
+%% kythe.proto.storage.Entry is preceded by its length as a varint.
+%% This avoids writing the facts as JSON and then running the
+%% external `entrystream --read_format=json` command to convert them.
+%%
+%% The protobuf definitions are in kythe/proto/storage.proto:
+%%   message VName { string signature = 1; string corpus = 2; string root = 3;
+%%                   string path = 4; string language = 5; }
+%%   message Entry { VName source = 1; string edge_kind = 2; VName target = 3;
+%%                   string fact_name = 4; bytes fact_value = 5; }
+%% Fields are output in field-number order and empty strings are
+%% omitted (proto3 semantics), which is what the Go proto library (used
+%% by `entrystream`) does, so the output is byte-for-byte the same.
+%% (See the Makefile target check-entries for verifying this.)
+%%
+%% Entries can also be read back (read_kythe_entry/2), e.g., by
+%% browser/kythe_json_to_prolog.pl.
+
+:- module(kythe_entries, [bytes_kythe_entry/2,
+                          kythe_entry_bytes/2,
+                          read_kythe_entry/2,
+                          write_kythe_entry/2
+                         ]).
+:- encoding(utf8).
+% :- set_prolog_flag(autoload, false).  % TODO: seems to break plunit, qsave
+
+:- use_module(library(apply), [maplist/2]).
+:- use_module(library(lists), [append/3]).
+:- use_module(library(error), [domain_error/2, syntax_error/1]).
+:- use_module(library(rdet), [rdet/1]).
+:- use_module(library(utf8), [utf8_codes//1]).
+:- use_module(pykythe_utils).
+
+:- style_check(+singleton).
+:- style_check(+var_branches).
+:- style_check(+no_effect).
+:- style_check(+discontiguous).
+% :- set_prolog_flag(generate_debug_info, false).
+
+
+:- if(true).  % Turning off rdet can sometimes make debugging easier.
+
+:- maplist(rdet, [
+                  bytes_kythe_entry/2,
+                  kythe_entry_bytes/2,
+                  read_kythe_entry/2,
+                  write_kythe_entry/2
+                 ]).
+:- endif.
+
+%! write_kythe_entry(+Stream, +Entry) is det.
+% Write a single Entry (see kythe_entry_bytes/2), preceded by its
+% length as a varint. Stream must be binary.
+write_kythe_entry(Stream, Entry) :-
+    kythe_entry_bytes(Entry, Bytes),
+    length(Bytes, Len),
+    phrase(varint(Len), LenBytes),
+    maplist(put_byte(Stream), LenBytes),
+    maplist(put_byte(Stream), Bytes).
+
+%! kythe_entry_bytes(+Entry, -Bytes:list(integer)) is det.
+% Encode Entry as a kythe.proto.storage.Entry protobuf (without the
+% length prefix). Entry is of the form
+%   entry(Source:dict, EdgeKind:atom, Target, FactName:atom, FactValue:list(integer))
+% where EdgeKind is '' for a node fact, Target is either a dict or
+% `none` (for a node fact) and FactValue is a list of bytes (UTF-8
+% encoded, if it's text). The dicts for Source and Target have any
+% of the keys signature, corpus, root, path, language (missing keys
+% are treated as '').
+kythe_entry_bytes(entry(Source, EdgeKind, Target, FactName, FactValue), Bytes) :-
+    phrase(entry_fields(Source, EdgeKind, Target, FactName, FactValue), Bytes).
+
+entry_fields(Source, EdgeKind, Target, FactName, FactValue) -->
+    vname_field(1, Source),
+    string_field(2, EdgeKind),
+    vname_field(3, Target),
+    string_field(4, FactName),
+    bytes_field(5, FactValue).
+
+%! vname_field(+FieldNumber:integer, +VName)// is det.
+% A VName sub-message; unlike a string field, it's output even if all
+% its fields are empty (but not if it is `none`).
+vname_field(_FieldNumber, none) --> !, [ ].
+vname_field(FieldNumber, VName) -->
+    { phrase(vname_fields(VName), Bytes) },
+    length_delimited(FieldNumber, Bytes).
+
+vname_fields(VName) -->
+    vname_string_field(1, signature, VName),
+    vname_string_field(2, corpus, VName),
+    vname_string_field(3, root, VName),
+    vname_string_field(4, path, VName),
+    vname_string_field(5, language, VName).
+
+vname_string_field(FieldNumber, Key, VName) -->
+    { get_dict_default(Key, VName, '', Value) },
+    string_field(FieldNumber, Value).
+
+%! string_field(+FieldNumber:integer, +Value)// is det.
+% A string field (UTF-8 encoded), omitted if it's empty.
+string_field(FieldNumber, Value) -->
+    { atom_codes(Value, Codes),
+      phrase(utf8_codes(Codes), Bytes)
+    },
+    bytes_field(FieldNumber, Bytes).
+
+%! bytes_field(+FieldNumber:integer, +Bytes:list(integer))// is det.
+% A bytes field, omitted if it's empty.
+bytes_field(_FieldNumber, []) --> !, [ ].
+bytes_field(FieldNumber, Bytes) -->
+    length_delimited(FieldNumber, Bytes).
+
+%! length_delimited(+FieldNumber:integer, +Bytes:list(integer))// is det.
+% Output a field with wire type 2 ("length-delimited").
+length_delimited(FieldNumber, Bytes) -->
+    { Key is (FieldNumber << 3) \/ 2,
+      length(Bytes, Len)
+    },
+    varint(Key),
+    varint(Len),
+    bytes(Bytes).
+
+%! varint(+Value:integer)// is det.
+% Base 128 varint: least significant group first, with the high bit
+% set on all but the last byte.
+varint(Value) -->
+    { Value < 0x80 },
+    !,
+    [ Value ].
+varint(Value) -->
+    { Byte is 0x80 \/ (Value /\ 0x7f),
+      Value2 is Value >> 7
+    },
+    [ Byte ],
+    varint(Value2).
+
+bytes(Bytes, S0, S) :-
+    append(Bytes, S, S0).
+
+%! read_kythe_entry(+Stream, -Entry) is det.
+% Read a single Entry that's preceded by its length as a varint (as
+% written by write_kythe_entry/2 or `entrystream`), or `end_of_file`
+% if there are no more entries. Stream must be binary. See
+% bytes_kythe_entry/2 for Entry.
+read_kythe_entry(Stream, Entry) :-
+    get_byte(Stream, Byte),
+    (   Byte == -1
+    ->  Entry = end_of_file
+    ;   read_varint(Stream, Byte, 0, 0, Len),
+        length(Bytes, Len),
+        maplist(get_entry_byte(Stream), Bytes),
+        bytes_kythe_entry(Bytes, Entry)
+    ).
+
+read_varint(Stream, Byte, Shift, Value0, Value) :-
+    Value1 is Value0 \/ ((Byte /\ 0x7f) << Shift),
+    (   Byte < 0x80
+    ->  Value = Value1
+    ;   get_entry_byte(Stream, Byte2),
+        Shift2 is Shift + 7,
+        read_varint(Stream, Byte2, Shift2, Value1, Value)
+    ).
+
+get_entry_byte(Stream, Byte) :-
+    get_byte(Stream, Byte),
+    (   Byte == -1
+    ->  syntax_error(kythe_entry_truncated)
+    ;   true
+    ).
+
+%! bytes_kythe_entry(+Bytes:list(integer), -Entry) is det.
+% The inverse of kythe_entry_bytes/2, except that the Source and
+% Target dicts have all the keys signature, corpus, root, path,
+% language (missing fields are ''), Target is `none` if it's missing
+% and the atoms are decoded from UTF-8. Unknown fields are ignored.
+bytes_kythe_entry(Bytes, entry(Source, EdgeKind, Target, FactName, FactValue)) :-
+    phrase(decode_fields(Fields), Bytes),
+    field_vname(1, Fields, Source),
+    field_string(2, Fields, EdgeKind),
+    (   memberchk(3-_, Fields)
+    ->  field_vname(3, Fields, Target)
+    ;   Target = none
+    ),
+    field_string(4, Fields, FactName),
+    field_bytes(5, Fields, FactValue).
+
+field_vname(FieldNumber, Fields, json{signature:Signature, corpus:Corpus, root:Root,
+                                      path:Path, language:Language}) :-
+    field_bytes(FieldNumber, Fields, Bytes),
+    phrase(decode_fields(VNameFields), Bytes),
+    field_string(1, VNameFields, Signature),
+    field_string(2, VNameFields, Corpus),
+    field_string(3, VNameFields, Root),
+    field_string(4, VNameFields, Path),
+    field_string(5, VNameFields, Language).
+
+field_string(FieldNumber, Fields, Value) :-
+    field_bytes(FieldNumber, Fields, Bytes),
+    phrase(utf8_codes(Codes), Bytes),
+    atom_codes(Value, Codes).
+
+%! field_bytes(+FieldNumber:integer, +Fields:list(pair), -Bytes:list(integer)) is det.
+% The (last) value of a field, or [] if it's missing (proto3
+% semantics).
+field_bytes(FieldNumber, Fields, Bytes) :-
+    (   last_field(Fields, FieldNumber, Bytes0)
+    ->  Bytes = Bytes0
+    ;   Bytes = []
+    ).
+
+last_field([FieldNumber2-Value2|Fields], FieldNumber, Value) :-
+    (   last_field(Fields, FieldNumber, Value)
+    ->  true
+    ;   FieldNumber2 == FieldNumber,
+        Value = Value2
+    ).
+
+%! decode_fields(-Fields:list(pair))// is det.
+% Decode a message's fields into a list of FieldNumber-Value, where
+% Value is a list of bytes (wire type 2) or an integer (wire type 0).
+decode_fields([FieldNumber-Value|Fields]) -->
+    decode_varint(Key),
+    !,
+    { FieldNumber is Key >> 3,
+      WireType is Key /\ 7
+    },
+    decode_field_value(WireType, Value),
+    decode_fields(Fields).
+decode_fields([]) --> [ ].
+
+decode_field_value(0, Value) --> !,
+    decode_varint(Value).
+decode_field_value(2, Bytes) --> !,
+    decode_varint(Len),
+    { length(Bytes, Len) },
+    bytes(Bytes).
+decode_field_value(WireType, _Value) -->
+    { domain_error(protobuf_wire_type, WireType) }.
+
+decode_varint(Value) -->
+    [ Byte ],
+    decode_varint(Byte, 0, 0, Value).
+
+decode_varint(Byte, Shift, Value0, Value) -->
+    { Value1 is Value0 \/ ((Byte /\ 0x7f) << Shift) },
+    (   { Byte < 0x80 }
+    ->  { Value = Value1 }
+    ;   [ Byte2 ],
+        { Shift2 is Shift + 7 },
+        decode_varint(Byte2, Shift2, Value1, Value)
+    ).
@@ -0,0 +1,153 @@
+% -*- mode: Prolog -*-
+
+%% Index of directory contents, for resolving imports.
+%%
+%% Resolving an import tries each --pythonpath entry in turn, with each
+%% of the py_ext_ext/1 extensions, for both the module_alone and
+%% module_and_token forms (see module_path:path_expand/3). Doing a
+%% separate absolute_file_name/3 (stat) for each candidate results in
+%% tens of thousands of system calls per run; instead, each directory
+%% is read once (directory_files/2) and its entries are recorded, so
+%% that checking a candidate is a hashed lookup.
+%%
+%% Directories are indexed when they're first needed rather than by
+%% scanning each --pythonpath root: the roots (e.g., /usr/lib/python3.7)
+%% are large and only a small part of them is ever imported.
+%%
+%% The index can be saved to a file (module_index_save/1) and reused by
+%% a later run (module_index_load/1); a directory's entries are reused
+%% only if the directory's modification time hasn't changed (adding or
+%% removing a file changes the directory's modification time).
+%% Several pykythe processes can share the index file (e.g., "parallel"
+%% in the Makefile), so module_index_save/1 merges the file's current
+%% contents into what it writes, under a lock.
+
+:- module(module_index, [module_index_dir/1,
+                         module_index_file/1,
+                         module_index_load/1,
+                         module_index_save/1
+                        ]).
+:- encoding(utf8).
+% :- set_prolog_flag(autoload, false).  % TODO: seems to break plunit, qsave
+
+:- use_module(library(apply), [exclude/3, maplist/2]).
+:- use_module(library(filesex), [directory_file_path/3]).
+:- use_module(library(rdet), [rdet/1]).
+:- use_module(must_once, [must_once/1]).
+:- use_module(pykythe_utils).
+
+:- style_check(+singleton).
+:- style_check(+var_branches).
+:- style_check(+no_effect).
+:- style_check(+discontiguous).
+% :- set_prolog_flag(generate_debug_info, false).
+
+:- if(true).  % Turning off rdet can sometimes make debugging easier.
+
+:- maplist(rdet, [
+                  module_index_load/1,
+                  % module_index_save/1,  % Is det, but expansion confuses write_atomic_stream/2.
+                  index_dir/3,
+                  write_index_dirs/1
+                 ]).
+:- endif.
+
+%! indexed_dir(?Dir:atom, ?MTime, ?Names:list(atom)) is nondet.
+% Dir has been indexed, with entries Names. MTime is its modification
+% time, or `none` if it isn't a (readable) directory.
+%! indexed_entry(?Path:atom) is nondet.
+% Path is an entry (file or directory) in an indexed directory. This
+% duplicates the information in indexed_dir/3, but allows lookup using
+% first-argument indexing.
+:- dynamic
+    indexed_dir/3,
+    indexed_entry/1.
+
+%! module_index_file(+Path:atom) is semidet.
+% Succeeds if Path exists (as a file or directory).
+% Path must be absolute and canonical (see canonical_path/2).
+% Unlike canonical_path/2, it doesn't check whether Path is readable.
+module_index_file(Path) :-
+    directory_file_path(Dir, _, Path),
+    ensure_indexed_dir(Dir),
+    indexed_entry(Path).
+
+%! module_index_dir(+Dir:atom) is semidet.
+% Succeeds if Dir exists as a directory.
+% Dir must be absolute and canonical, without a trailing '/'.
+module_index_dir(Dir) :-
+    ensure_indexed_dir(Dir),
+    indexed_dir(Dir, MTime, _),
+    MTime \== none.
+
+%! ensure_indexed_dir(+Dir:atom) is det.
+ensure_indexed_dir(Dir) :-
+    (   indexed_dir(Dir, _, _)
+    ->  true
+    ;   index_dir(Dir, MTime, Names),
+        assert_indexed_dir(Dir, MTime, Names)
+    ).
+
+%! index_dir(+Dir:atom, -MTime, -Names:list(atom)) is det.
+% Read the entries of Dir.
+index_dir(Dir, MTime, Names) :-
+    (   exists_directory(Dir),
+        catch(directory_files(Dir, Names0), _, fail)
+    ->  time_file(Dir, MTime),
+        exclude([Name]>>memberchk(Name, ['.', '..']), Names0, Names)
+    ;   MTime = none,
+        Names = []
+    ).
+
+assert_indexed_dir(Dir, MTime, Names) :-
+    assertz(indexed_dir(Dir, MTime, Names)),
+    maplist(assert_indexed_entry(Dir), Names).
+
+assert_indexed_entry(Dir, Name) :-
+    directory_file_path(Dir, Name, Path),
+    assertz(indexed_entry(Path)).
+
+%! module_index_load(+IndexPath:atom) is det.
+% Load the index from a file written by module_index_save/1, ignoring
+% any directories that have been modified since it was written.
+% Does nothing if IndexPath is '' or the file doesn't exist (or is for
+% a different version of this file's format).
+module_index_load(IndexPath) :-
+    (   IndexPath \== '',
+        maybe_open_read(IndexPath, IndexStream)
+    ->  call_cleanup(read_term(IndexStream, IndexTerm, []),
+                     close(IndexStream)),
+        (   IndexTerm = module_index(1, Dirs)
+        ->  maplist(load_index_dir, Dirs)
+        ;   log_if(true, 'WARNING: ignoring module index ~q', [IndexPath])
+        )
+    ;   true
+    ).
+
+load_index_dir(dir(Dir, MTime, Names)) :-
+    (   \+ indexed_dir(Dir, _, _),
+        exists_directory(Dir),
+        time_file(Dir, MTime)   % unchanged since written
+    ->  assert_indexed_dir(Dir, MTime, Names)
+    ;   true
+    ).
+
+%! module_index_save(+IndexPath:atom) is det.
+% Write the index, for use by module_index_load/1. Does nothing if
+% IndexPath is ''. The directories that other processes have saved
+% since the index was loaded are kept (if they're unchanged).
+module_index_save(IndexPath) :-
+    (   IndexPath == ''
+    ->  true
+    ;   must_once(with_file_lock(IndexPath,
+                                 ( module_index_load(IndexPath),
+                                   write_atomic_stream(write_index_dirs, IndexPath) )))
+    ).
+
+write_index_dirs(IndexStream) :-
+    findall(dir(Dir, MTime, Names),
+            ( indexed_dir(Dir, MTime, Names), MTime \== none ),
+            Dirs),
+    format(IndexStream, '~k.~n', [module_index(1, Dirs)]).
+
+end_of_file.
@@ -43,6 +43,7 @@
 :- use_module(library(pcre), [re_matchsub/4, re_replace/4]).
 :- style_check(+var_branches).
 :- use_module(library(rdet), [rdet/1]).
+:- use_module(module_index, [module_index_dir/1, module_index_file/1]).
 :- use_module(must_once, [must_once/1, must_once_msg/2, must_once_msg/3, fail/1]).
 :- use_module(pykythe_utils).
 
@@ -191,10 +192,24 @@ canonical_path(Path, CanonicalPath) :-
     ),
     atom_string(CanonicalPath, AbsPath).
 
+%! full_path_prefixed_cache(?DeprefixedPath, ?Pythonpaths:list, ?ModuleAndMaybeToken) is nondet.
+% Results of full_path_prefixed/3: the same modules are imported many
+% times, and the file system isn't expected to change during a run.
+:- dynamic full_path_prefixed_cache/3.
+
 %! full_path_prefixed(+DeprefixedPath, +Pythonpaths:list, -ModuleAndMaybeToken) is det.
 % ModuleAndMaybeToken is either module_alone or module_and_token functor.
-%  TODO: use directory_file_path/3 instead of concat, to allow removing trailing '/'.
 full_path_prefixed(DeprefixedPath, Pythonpaths, ModuleAndMaybeToken) :-
+    (   full_path_prefixed_cache(DeprefixedPath, Pythonpaths0, ModuleAndMaybeToken0),
+        Pythonpaths0 == Pythonpaths
+    ->  true
+    ;   full_path_prefixed_(DeprefixedPath, Pythonpaths, ModuleAndMaybeToken0),
+        assertz(full_path_prefixed_cache(DeprefixedPath, Pythonpaths, ModuleAndMaybeToken0))
+    ),
+    ModuleAndMaybeToken = ModuleAndMaybeToken0.
+
+%  TODO: use directory_file_path/3 instead of concat, to allow removing trailing '/'.
+full_path_prefixed_(DeprefixedPath, Pythonpaths, ModuleAndMaybeToken) :-
     (   member(Prefix, Pythonpaths),
         atom_concat(Prefix, DeprefixedPath, Path0),
         path_expand(Path0, ModuleFqn, ModuleAndMaybeToken)
@@ -228,7 +243,7 @@ path_expand(Path0, ModuleFqn, ModuleAndMaybeToken) :-
         ModuleAndMaybeToken = module_and_token(ModuleFqn, Expanded, Token)
     ),
     (   py_ext(Path1, Path),
-        canonical_path(Path, Expanded)
+        indexed_canonical_path(Path, Expanded)
     ->  true % 'foo.bar' can produce
              %    module_alone('foo.bar', 'foo/bar.py' and
              %    module_and_token('foo.bar', 'foo/__init__.py', 'bar')
@@ -237,10 +252,43 @@ path_expand(Path0, ModuleFqn, ModuleAndMaybeToken) :-
              % there's nothing for checking whether a token exists
               % within a file).
     ;   Path1 = Path0          % module_alone and not module_and_token
-    ->  absolute_dir(Path1, Expanded)
+    ->  indexed_absolute_dir(Path1, Expanded)
     ;   fail
     ).
 
+%! indexed_canonical_path(+Path, -CanonicalPath) is semidet.
+% canonical_path/2, using module_index_file/1 if Path is already in
+% canonical form (which is the case for paths from --pythonpath).
+indexed_canonical_path(Path, CanonicalPath) :-
+    (   is_canonical_path(Path)
+    ->  module_index_file(Path),
+        CanonicalPath = Path
+    ;   canonical_path(Path, CanonicalPath)
+    ).
+
+%! indexed_absolute_dir(+Path, -AbsPath) is semidet.
+% absolute_dir/2, using module_index_dir/1 if Path is already in
+% canonical form.
+indexed_absolute_dir(Path, AbsPath) :-
+    (   is_canonical_path(Path)
+    ->  module_index_dir(Path),
+        atom_concat(Path, '/', AbsPath)
+    ;   absolute_dir(Path, AbsPath)
+    ).
+
+%! is_canonical_path(+Path:atom) is semidet.
+% Succeeds if Path is absolute and absolute_file_name/3 wouldn't
+% change it (no '.' or '..' components, no '//' and no trailing '/').
+is_canonical_path(Path) :-
+    sub_atom(Path, 0, _, _, '/'),
+    Path \== '/',
+    \+ sub_atom(Path, _, _, 0, '/'),
+    \+ sub_atom(Path, _, _, _, '//'),
+    \+ sub_atom(Path, _, _, _, '/./'),
+    \+ sub_atom(Path, _, _, _, '/../'),
+    \+ sub_atom(Path, _, _, 0, '/.'),
+    \+ sub_atom(Path, _, _, 0, '/..').
+
 %! remove_last_component(+Path, -AllButLast, -Last) is semidet.
 % e.g.: Path='foo/bar/zot', AllButLast='foo/bar', Last=zot
 % Fails if no '/' in Path.
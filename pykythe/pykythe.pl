@@ -203,13 +203,23 @@
 :- use_module(library(lists), [append/2, append/3, list_to_set/2, last/2, member/2, nth0/3, reverse/2, select/3]).
 :- use_module(library(optparse), [opt_arguments/3]).
 :- use_module(library(ordsets), [list_to_ord_set/2, ord_empty/1, ord_union/2, ord_union/3, ord_add_element/3]).
+:- use_module(library(nb_set), [empty_nb_set/1, add_nb_set/3]).
 :- use_module(library(pairs), [pairs_keys/2, pairs_values/2, pairs_keys_values/3]).
 :- style_check(-var_branches).
-:- use_module(library(pcre), [re_replace/4]).
+:- use_module(library(pcre), [re_match/2, re_replace/4]).
+:- style_check(+var_branches).
+:- style_check(-var_branches).
+:- use_module(library(http/json), [json_write/3, json_write_dict/3]).
 :- style_check(+var_branches).
 :- use_module(library(prolog_stack)).  % For catch_with_backtrace
+:- use_module(library(rbtrees), [rb_empty/1, rb_insert_new/4, rb_lookup/3, rb_update/4, rb_visit/2]).
 :- use_module(library(utf8), [utf8_codes/3]).
 
+:- use_module(file_budget, [skip_list_add/3, skip_list_load/1, skip_listed/2, with_file_budget/3]).
+:- use_module(import_graph, [import_graph_affected/4, import_graph_load/1, import_graph_remove/1,
+                              import_graph_save/1, import_graph_set_imports/2]).
+:- use_module(kythe_entries, [write_kythe_entry/2]).
+:- use_module(module_index, [module_index_load/1, module_index_save/1]).
 :- use_module(module_path).
 :- use_module(must_once, [must_once/1, must_once_msg/2, must_once_msg/3, fail/1,
                           must_once/3 as must_once_symrej]).
@@ -288,9 +298,10 @@
                   assign_exprs_count_impl/6,
                   assign_normalized/7,
                   % builtins_symtab_extend/3, % TODO: failed to analyse
+                  builtins_symtab_load_path/2,
                   clean_class/3,
-                  clean_kind/2,
-                  clean_kythe_facts/2,
+                  color_table/2,
+                  color_table_columns/9,
                   combine_types/2,
                   diagnostic_source/3,
                   ensure_class_mro_object/3,
@@ -334,7 +345,7 @@
                   kyedge_fqn/6,
                   kyfact/6,
                   kyfact_attr/6,
-                  kyfact_color/4,
+                  kyfact_color_table/4,
                   kyfact_signature_node/6,
                   kyfacts/5,
                   kyfacts_signature_node/5,
@@ -344,9 +355,12 @@
                   kynode/7,
                   kynode_add_items/6,
                   kynode_if_stmt/7,
-                  kythe_kinds/4,
+                  kythe_outputs/5,
+                  load_builtins_symtab/1,
                   log_kyfact_msg/8,
                   log_kythe_fact_msgs/2,
+                  metrics_phase/4,
+                  metrics_start/2,
                   log_possible_classes_from_attr/8,
                   % maplist_eval_assign_expr/6, % Need TRO
                   % maplist_kyfact/5, % Need TRO
@@ -374,14 +388,20 @@
                   % process_module_cached_or_from_src/6,  % wrapped in must_once
                   % process_module_from_src/5,  % DO NOT SUBMIT - is this det? (I think it is)
                   % process_module_from_src_impl/5,  % DO NOT SUBMIT - ditto
+                  process_module_file_only/7,
+                  process_module_from_nodes/9,
                   process_src/2,
                   possible_classes_from_attr/5,
+                  read_changed_files/2,
+                  reindex_changed_files/1,
+                  reindex_module/2,
                   process_nodes/5,
                   process_nodes_impl/7,
                   % pykythe_main/0,
                   pykythe_main2/0,
                   pykythe_opts/2,
-                  read_nodes/4,
+                  read_nodes/5,
+                  record_overrun/6,
                   remove_class_cycles/3,
                   remove_class_cycles_one/4,
                   resolve_mro_dot/9,
@@ -397,15 +417,18 @@
                   symrej_accum/3,
                   symrej_accum_found/7,
                   symtab_pykythe_types/4,
+                  transform_kythe_entry/2,
                   transform_kythe_fact/2,
                   transform_kythe_vname/2,
                   transform_kythe_path/2,
+                  validate_cache_version/1,
                   wrap_import_ref/4,
+                  write_file_metrics/5,
                   % symtab_lookup/4,
                   symtab_scope_pairs/4
                   % write_symtab/3, % Is det, but expansion confuses write_atomic_stream/2.
                   % write_to_protobuf/4,  % Is det, but expansion confuses write_atomic_file/2.
-                  % write_kythe_facts/3  % TODO: failed to analyse
+                  % write_kythe_facts/3  % Is det, but expansion confuses write_atomic_streams/2.
                  ]).
 :- endif.
 
@@ -466,12 +489,12 @@ pred_info_(kyedge, 3,                              [kyfact,file_meta]).
 pred_info_(kyedge_fqn, 3,                          [kyfact,file_meta]).
 pred_info_(kyfact, 3,                              [kyfact,file_meta]).
 pred_info_(kyfact_attr, 3,                         [kyfact,file_meta]).
-pred_info_(kyfact_color, 1,                        [kyfact,file_meta]).
+pred_info_(kyfact_color_table, 1,                  [kyfact,file_meta]).
 pred_info_(kyfact_signature_node, 3,               [kyfact,file_meta]).
 pred_info_(kyfacts, 2,                             [kyfact,file_meta]).
 pred_info_(kyfacts_signature_node, 2,              [kyfact,file_meta]).
 pred_info_(kyfile, 1,                              [kyfact,file_meta]).
-pred_info_(add_kyfact_types, 2,                    [kyfact,file_meta]).
+pred_info_(add_kyfact_types, 1,                    [kyfact,file_meta]).
 pred_info_(symtab_pykythe_types, 1,                [kyfact,file_meta]).
 
 pred_info_(maplist_kyfact_expr, 2,                 [kyfact,expr,file_meta]).
@@ -625,15 +648,45 @@ pred_info_(exprs, 1,                               [expr]).
 %          json_read_dict/2               34%
 %      $garbage_collect/1             29%      (mostly from put_dict/4)
 
-% Predicates that are loaded below by load_files(opts.builtins_symtab):
+% Predicates that are loaded below by load_builtins_symtab/1:
 :- dynamic
     builtins_module/1,
     builtins_pairs/1,
+    builtins_pythonpath/1,
     builtins_symtab/1,
     builtins_symtab_modules/1,
     builtins_symtab_primitive/2,
     builtins_version/1.
 
+%! kythe_facts_version(-Version:integer) is det.
+% Version of the Kythe facts (and inferred types) that are generated
+% from the parser's output. Bump this when a change could alter the
+% output for some source file; it's part of the cache version (see
+% scripts/cache_versions.py and validate_cache_version/1), so bumping
+% it invalidates all cache entries.
+kythe_facts_version(1).
+
+%! validate_cache_version(+Version:atom) is det.
+% If Version (from --version) is a layered cache version
+% ("parserP-symtabS-kytheK", from scripts/cache_versions.py), check
+% that its symtab and kythe layers are the same as this program's;
+% this catches a --version that wasn't recomputed after a version was
+% bumped. (The parser layer is checked by pykythe/__main__.py.)
+% Other forms of Version (e.g., '') aren't checked.
+validate_cache_version(Version) :-
+    (   atomic_list_concat([ParserLayer, SymtabLayer, KytheLayer], '-', Version),
+        atom_concat(parser, _, ParserLayer),
+        atom_concat(symtab, SymtabVersion, SymtabLayer),
+        atom_concat(kythe, KytheVersion, KytheLayer)
+    ->  symtab_format_version(ExpectedSymtabVersion),
+        kythe_facts_version(ExpectedKytheVersion),
+        must_once_msg(( atom_number(SymtabVersion, ExpectedSymtabVersion),
+                        atom_number(KytheVersion, ExpectedKytheVersion) ),
+                      '--version=~q should have symtab~d-kythe~d (see scripts/cache_versions.py)',
+                      [Version, ExpectedSymtabVersion, ExpectedKytheVersion])
+    ;   true
+    ).
+
 %! object_fqn(-ObjectFqn) is det.
 % Unify with the FQN for object '${TYPESHED_FQN}.stdlib.2and3.builtins.object'.
 % Only works after builtins symtab has been loaded (see pykythe_main2/0).
@@ -643,11 +696,6 @@ object_fqn(ObjectFqn) :-
     single_type_fqn(ObjectType, ObjectFqn).
 
 pykythe_main :-
-    % TODO: change ast_raw._EXPR_NODES to reduce the number of expr nodes
-    % The stack limit depends on some cuts that are marked '% "cut" for memory usage'
-    %     (especially the ones marked '*** THIS ONE IS IMPORTANT ***').
-    set_prolog_flag(stack_limit, 1_610_612_736), % TODO: 1.5GB - default of 1GB might suffice
-
     % TODO: catch_with_backtrace/3 wrap might not be needed when the
     %       initialization/2 directive is enabled.
     catch_with_backtrace(pykythe_main2,
@@ -672,21 +720,68 @@ pykythe_main2 :-
     set_prolog_flag(color_term, false), % TODO: delete (move to ~/.swiplrc)
 
     pykythe_opts(SrcPaths, Opts),
+    % TODO: change ast_raw._EXPR_NODES to reduce the number of expr nodes
+    % The stack limit depends on some cuts that are marked '% "cut" for memory usage'
+    %     (especially the ones marked '*** THIS ONE IS IMPORTANT ***').
+    set_prolog_flag(stack_limit, Opts.stack_limit),
+    validate_cache_version(Opts.version),
     log_if(true, 'Start ~w', [SrcPaths]), % TODO: delete
-    % BuiltinsSymtabFile is created by gen_builtins_symtab.pl
+    load_builtins_symtab(Opts),
+    module_index_load(Opts.module_index),
+    import_graph_load(Opts.import_graph),
+    skip_list_load(Opts.skip_list),
+    statistics(process_cputime, StartupTime),
+    log_if(true, 'Startup time: ~3f sec', [StartupTime]),
+    % debug, % TODO: remove - this "debug" gives a better traceback, at
+             %       the cost of significant slow-down and memory usage.
+    reindex_changed_files(Opts),
+    maplist(process_src(Opts), SrcPaths),
+    module_index_save(Opts.module_index),
+    import_graph_save(Opts.import_graph),
+    log_if(true, 'End ~w', [SrcPaths]).        % TODO: delete
+
+%! load_builtins_symtab(+Opts:dict) is det.
+% Load the builtins symtab file (Opts.builtins_symtab, created by
+% gen_builtins_symtab.pl) or its precompiled form (see
+% builtins_symtab_load_path/2).
+load_builtins_symtab(Opts) :-
+    get_time(T0),
+    builtins_symtab_load_path(Opts.builtins_symtab, LoadPath),
     unload_file(Opts.builtins_symtab),
-    load_files([Opts.builtins_symtab], % TODO: should be a module that lists its exported predicates
+    load_files([LoadPath], % TODO: should be a module that lists its exported predicates
                [silent(true),
                 imports([builtins_module/1,
                          builtins_pairs/1,
+                         builtins_pythonpath/1,
                          builtins_symtab/1,
                          builtins_symtab_modules/1,
                          builtins_symtab_primitive/2,
                          builtins_version/1])]),
-    % debug, % TODO: remove - this "debug" gives a better traceback, at
-             %       the cost of significant slow-down and memory usage.
-    maplist(process_src(Opts), SrcPaths),
-    log_if(true, 'End ~w', [SrcPaths]).        % TODO: delete
+    get_time(T1),
+    LoadTime is T1 - T0,
+    log_if(true, 'Loaded builtins symtab from ~q (~3f sec)', [LoadPath, LoadTime]),
+    (   builtins_pythonpath(BuiltinsPythonpath),
+        BuiltinsPythonpath \== Opts.pythonpath
+    ->  log_if(true, 'WARNING: builtins symtab was generated with --pythonpath=~q', [BuiltinsPythonpath])
+    ;   true
+    ).
+
+%! builtins_symtab_load_path(+SymtabPath:atom, -LoadPath:atom) is det.
+% If there's a .qlf file for SymtabPath (created by qcompile/1; see
+% the Makefile) that is at least as new as SymtabPath, use it instead
+% of SymtabPath, which takes much longer to load. (The .qlf file was
+% compiled from SymtabPath, so it has the same builtins_version/1,
+% which is checked in parse_and_get_meta/6.)
+builtins_symtab_load_path(SymtabPath, LoadPath) :-
+    file_name_extension(Base, _, SymtabPath),
+    file_name_extension(Base, qlf, QlfPath),
+    (   exists_file(QlfPath),
+        time_file(QlfPath, QlfTime),
+        time_file(SymtabPath, SymtabTime),
+        QlfTime >= SymtabTime
+    ->  LoadPath = QlfPath
+    ;   LoadPath = SymtabPath
+    ).
 
 %! process_src(+Opts:list, +SrcPath:atom) is det.
 % Process a single source file
@@ -697,6 +792,53 @@ process_src(Opts, SrcPath) :-
     must_once(
         process_module_cached_or_from_src(Opts, 'from src ok', SrcPath, SrcFqn, Symtab0, _Symtab)).
 
+%! reindex_changed_files(+Opts:dict) is det.
+% If Opts.changed_files isn't '', reprocess from source the files that
+% it lists and all the modules that (transitively) import them,
+% according to the import graph (see import_graph.pl); the other
+% modules' outputs are left as-is. Modules are processed after the
+% modules that they import, so that each one uses the updated cache
+% entries of its imports. Changed files that aren't in the import graph
+% (e.g., new files or non-Python files) are ignored; new files can be
+% given as positional arguments.
+reindex_changed_files(Opts) :-
+    (   Opts.changed_files == ''
+    ->  true
+    ;   read_changed_files(Opts.changed_files, ChangedPaths),
+        import_graph_affected(ChangedPaths, Affected, Unknown, Skipped),
+        length(ChangedPaths, ChangedLen),
+        length(Unknown, UnknownLen),
+        length(Affected, AffectedLen),
+        length(Skipped, SkippedLen),
+        log_if(true, 'Changed files: ~d (~d not in import graph); reindexing ~d; skipped ~d',
+               [ChangedLen, UnknownLen, AffectedLen, SkippedLen]),
+        maplist(reindex_module(Opts), Affected)
+    ).
+
+%! read_changed_files(+ChangedFilesPath:atom, -ChangedPaths:list(atom)) is det.
+% Read a list of paths, one per line (e.g., the output of "git diff
+% --name-only"). Relative paths are relative to the current directory.
+read_changed_files(ChangedFilesPath, ChangedPaths) :-
+    read_file_to_string(ChangedFilesPath, Contents, [encoding(utf8)]),
+    split_string(Contents, "\n", " \t\r", Lines),
+    exclude(==(""), Lines, NonEmptyLines),
+    maplist(absolute_file_name_rel, NonEmptyLines, ChangedPaths0),
+    sort(ChangedPaths0, ChangedPaths).
+
+%! reindex_module(+Opts:dict, +SrcPath:atom) is det.
+% Process SrcPath from source (ignoring any cache entry) or, if it no
+% longer exists, remove it from the import graph.
+reindex_module(Opts, SrcPath) :-
+    (   exists_file(SrcPath)
+    ->  log_if(true, 'Reindex ~w', [SrcPath]),
+        path_to_module_fqn_or_unknown(SrcPath, SrcFqn),
+        builtins_symtab(Symtab0),
+        must_once(
+            process_module_from_src_impl(Opts, SrcPath, SrcFqn, Symtab0, _Symtab))
+    ;   log_if(true, 'Reindex: ~w no longer exists', [SrcPath]),
+        import_graph_remove(SrcPath)
+    ).
+
 %! path_with_suffix(+Opts:dict, +SrcPath:atom, +Suffix:atom, -Path:atom) is det.
 % Create Path from SrcPath's base and Opts.Suffix.
 path_with_suffix(Opts, SrcPath, Suffix, Path) :-
@@ -719,23 +861,55 @@ pykythe_opts(SrcPaths, Opts) :-
          help('File containing a builtins_symtab/1 fact')],
         [opt(builtins_path), type(atom), default(''), longflags(['builtins_path']),
          help('Module for builtins (corresponding file should also be in --pythonpath)')],
-        [opt(entriescmd), type(atom), default('entriescmd-must-be-specified'), longflags([entriescmd]),
-         help('Command for running conversion of .kythe.json to .kythe.entries')],
+        [opt(changed_files), type(atom), default(''), longflags(['changed_files']),
+         help(['File listing changed files, one per line (e.g., from "git diff --name-only").',
+               'The files and the modules that import them (using --import_graph) are reprocessed.',
+               'If omitted or "", only the positional args are processed.'])],
+        [opt(entriescmd), type(atom), default(''), longflags([entriescmd]),
+         help(['Command for running conversion of .kythe.json to .kythe.entries.',
+               'If omitted or "", .kythe.entries is written directly (see kythe_entries.pl).'])],
+        [opt(import_graph), type(atom), default(''), longflags(['import_graph']),
+         help(['File for saving the imports of processed modules (see import_graph.pl).',
+               'If omitted or "", the graph isn\'t saved between runs.'])],
         [opt(kythe_corpus), type(atom), default(''), longflags(['kythe_corpus']),
          help('Value of "corpus" in Kythe facts')],
         [opt(kythe_root), type(atom), default(''), longflags(['kythe_root']),
          help('Value of "root" in Kythe facts')],
         [opt(kytheout), type(atom), default(''), longflags(['kytheout']),
          help('Directory for output of imported files (including "main" file)')],
+        [opt(metrics_out), type(atom), default(''), longflags(['metrics_out']),
+         help(['File to which a JSON line of metrics is appended for each file processed from source.',
+               'If omitted or "", metrics aren\'t output (see scripts/metrics_report.py).'])],
+        [opt(module_index), type(atom), default(''), longflags(['module_index']),
+         help(['File for caching directory contents used to resolve imports (see module_index.pl).',
+               'If omitted or "", the cache isn\'t saved between runs.'])],
+        [opt(parse_cpu_limit), type(float), default(0.0), longflags(['parse_cpu_limit']),
+         help(['CPU seconds allowed for parsing a file (--parsecmd\'s --max_cpu_seconds).',
+               'If exceeded, the file gets only file-level output (see --skip_list). 0 for no limit.'])],
+        [opt(parse_memory_limit), type(integer), default(0), longflags(['parse_memory_limit']),
+         help(['MB of memory allowed for parsing a file (--parsecmd\'s --max_memory_mb).',
+               'If exceeded, the file gets only file-level output (see --skip_list). 0 for no limit.'])],
         [opt(parsecmd), type(atom), default('parsecmd-must-be-specified'), longflags([parsecmd]),
          help('Command for running parser than generates fqn.kythe.json file')],
+        [opt(process_time_limit), type(float), default(0.0), longflags(['process_time_limit']),
+         help(['Seconds (wall clock) allowed for pass 1 and the fixpoint of a file.',
+               'If exceeded, the file gets only file-level output (see --skip_list). 0 for no limit.'])],
         [opt(python_version), type(integer), default(3), longflags(python_version),
          help('Python major version')],
         [opt(pythonpath), type(atom), default(''), longflags(['pythonpath']),
                                 % TODO: python_version should be a triple: see ast_raw.FAKE_SYS
          help('Similar to $PYTHONPATH for resolving imports (":"-separated paths)')],
+        [opt(skip_list), type(atom), default(''), longflags(['skip_list']),
+         help(['File to which a JSON line is appended for each file that exceeds a budget (see file_budget.pl).',
+               'Files in it (with the same contents) get only file-level output.',
+               'If omitted or "", the skip list isn\'t saved between runs.'])],
+        [opt(stack_limit), type(integer), default(1_610_612_736), longflags(['stack_limit']),
+         % TODO: 1.5GB - default of 1GB might suffice
+         help(['Prolog stack limit (bytes). A file whose processing overflows the stacks',
+               'gets only file-level output (see --skip_list).'])],
         [opt(version), type(atom), default(''), longflags(['version']),
-         help('Pykythe version, used to validate cache entries')],
+         help(['Pykythe version, used to validate cache entries.',
+               'Normally the output of scripts/cache_versions.py.'])],
 
         [opt(pykythebatch_suffix), type(atom), default(''), longflags(['pykythebatch_suffix']),
          help(['Suffix (extension) for creating cache batch files (see README).',
@@ -743,7 +917,8 @@ pykythe_opts(SrcPaths, Opts) :-
         [opt(kytheentries_suffix), type(atom), default('.kythe.entries'), longflags(['kytheentries_suffix']),
          help('Suffix (extension for Kythe protouf output files - should have leading "."')],
         [opt(kythejson_suffix), type(atom), default('.kythe.json'), longflags(['kythout_suffix']),
-         help('Suffix (extension) for output files - should have leading ".".')],
+         help(['Suffix (extension) for output files - should have leading ".".',
+               'If "", .kythe.json isn\'t written (requires --entriescmd="").'])],
         [opt(pykythesymtab_suffix), type(atom), default('.pykythe.symtab'), longflags(['pykythesymtab_suffix']),
          help('Suffix (extension) for cache symtab files - should have leading ".".')]
        ],
@@ -754,7 +929,10 @@ pykythe_opts(SrcPaths, Opts) :-
     path_to_module_fqn_or_unknown(Opts0.builtins_path, BuiltinsModule),
     put_dict([pythonpath-PythonpathList,
               builtins_module-BuiltinsModule], Opts0, Opts),
-    must_once_msg(PositionalArgs = [_|_], 'Missing positional arg (file to process)'),
+    must_once_msg((Opts.kythejson_suffix \= '' ; Opts.entriescmd == ''),
+                  '--entriescmd requires .kythe.json output (--kythout_suffix)'),
+    must_once_msg((PositionalArgs = [_|_] ; Opts.changed_files \== ''),
+                  'Missing positional arg (file to process)'),
     maplist(absolute_file_name_rel, PositionalArgs, SrcPaths).
 
 %! process_module_cached_or_from_src(+Opts:list, +FromSrcOk:{'from src ok','cached only'}, +SrcPath:atom, +SrcFqn:atom, +Symtab0, -Symtab) is semidet.
@@ -818,6 +996,11 @@ modules_in_exprs(Exprs, Modules) :-
     convlist(is_assign_import, Exprs, Modules0),
     list_to_union_type(Modules0, Modules).
 
+%! module_type_path(+SingleType, -Path:atom) is semidet.
+% Used with modules_in_exprs/2, for the import graph.
+module_type_path(module_type(Module), Path) :-
+    path_part(Module, Path).
+
 %! is_assign_import(+Expr, -SingleType) is semidet.
 % Used by modules_in_exprs/2.
 is_assign_import(Term, module_type(Module)) :-
@@ -909,61 +1092,167 @@ process_module_from_src(Opts, 'from src ok', SrcFqn, Symtab0, Symtab) :-
     ).
 
 %! process_module_from_src_impl(+Opts:list, +SrcPath:atom, +SrcFqn:atom, +Symtab0, -Symtab) is det.
+% If the file is in the skip list or exceeds its budget (see
+% file_budget.pl), only the file-level facts are output
+% (process_module_file_only/7).
 process_module_from_src_impl(Opts, SrcPath, SrcFqn, Symtab0, Symtab) :-
     stats(Stats0),
+    metrics_start(SrcPath, MetricsStart),
     path_with_suffix(Opts, SrcPath, Opts.kythejson_suffix, KytheJsonPath),
     log_if(true,
            'Processing from source ~q (output: ~q) for ~q ~w', [SrcPath, KytheJsonPath, SrcFqn, Stats0]),
-    parse_and_get_meta(Opts, SrcPath, SrcFqn, Meta, Nodes, ColorTexts),
-    process_nodes(Nodes, src{src_fqn: Meta.src_fqn,
-                             src_path: Meta.path,
-                             color_text:ColorTexts},
-                  KytheFactsFromNodes0, Exprs, Meta),
-    log_kythe_fact_msgs(KytheFactsFromNodes0, KytheFactsFromNodes),
-    modules_in_exprs(Exprs, ModulesInExprs),
-    log_if(trace_file(SrcPath),
-           'MODULES_IN_EXPRS: ~q', [[ModulesInExprs, src=SrcPath, SrcFqn]]),
+    parse_and_get_meta(Opts, SrcPath, SrcFqn, Meta, Nodes, ColorTexts0),
+    file_color_text(Nodes, Meta, ColorTexts0, ColorTexts),
+    SrcInfo = src{src_fqn: Meta.src_fqn,
+                  src_path: Meta.path,
+                  color_text:ColorTexts},
     extend_symtab_with_builtins(Symtab0, Meta, Symtab1),
-    do_if(trace_file(Meta.path), dump_term('PASS1-EXPR_MODULES', ModulesInExprs)),
-    do_if(trace_file(Meta.path), dump_term('PASS1-EXPR', Exprs)),
-    % Note that the following allows any imported module to be from_src
-    % (FromSrcOk to process_module_cached_or_from_src is 'from src ok').
-    % TODO: for ModulesInExprs that are module_star, need
-    %       to update symtab with top-level items (starts
-    %       with module. and doesn't have '.' inside).
-    stats(Stats1),
-    log_if(true, 'Pass 1: process nodes for ~q ~w', [Meta.path, Stats1]),
-    foldl_process_module_cached_or_from_src(Opts, 'from src ok', ModulesInExprs, Symtab1, Symtab1WithImports),
-    stats(Stats2),
-    log_if(true, 'Pass 2: process exprs for ~q ~w', [Meta.path, Stats2]),
-    assign_exprs(Opts, Exprs, Meta, Symtab1WithImports, Symtab, KytheFactsFromExprs0),
-    !,                          % "cut" for memory usage
-    log_kythe_fact_msgs(KytheFactsFromExprs0, KytheFactsFromExprs1),
-    include(nonredundant_pytype_fact(Symtab), KytheFactsFromExprs1, KytheFactsFromExprs),
-    !,                          % "cut" for memory usage  *** THIS ONE IS IMPORTANT ***
-    stats(Stats3a),
-    log_if(true, 'Pass 3a: output for ~q ~w', [Meta.path, Stats3a]),
-    output_kythe(Opts, Meta, SrcPath, SrcFqn, Symtab, KytheFactsFromExprs, KytheFactsFromNodes),
-    stats(Stats3b),
-    log_if(true, 'Pass 3b: output for ~q ~w', [Meta.path, Stats3b]),
+    (   skip_listed(SrcPath, Meta.sha1)
+    ->  log_if(true, 'Skip list: file-level output only for ~q', [SrcPath]),
+        process_module_file_only(Opts, SrcPath, SrcFqn, Meta, SrcInfo, Symtab1, Symtab),
+        write_file_metrics(Opts, SrcPath, SrcFqn, Symtab, MetricsStart)
+    ;   parser_budget_exceeded(Nodes, ParseReason)
+    ->  record_overrun(Opts, SrcPath, Meta, parse, ParseReason, MetricsStart),
+        process_module_file_only(Opts, SrcPath, SrcFqn, Meta, SrcInfo, Symtab1, Symtab),
+        write_file_metrics(Opts, SrcPath, SrcFqn, Symtab, MetricsStart)
+    ;   process_module_from_nodes(Opts, SrcPath, SrcFqn, Meta, Nodes, SrcInfo, Symtab1, Symtab, MetricsStart)
+    ),
     !.
 process_module_from_src_impl(Opts, SrcPath, SrcFqn, _Symtab0, _Symtab) :-
     % TODO: delete this catch-all clause
     goal_failed(process_module_from_src_impl(Opts, SrcPath, SrcFqn)).
 
+%! process_module_from_nodes(+Opts:list, +SrcPath:atom, +SrcFqn:atom, +Meta:dict, +Nodes, +SrcInfo:dict, +Symtab1, -Symtab, +MetricsStart) is det.
+% The usual processing of a file: pass 1 (process_nodes/5), imports,
+% pass 2 (assign_exprs/6) and output. Pass 1 and pass 2 are run with
+% the --process_time_limit budget.
+process_module_from_nodes(Opts, SrcPath, SrcFqn, Meta, Nodes, SrcInfo, Symtab1, Symtab, MetricsStart) :-
+    get_time(T1),
+    with_file_budget(Opts.process_time_limit,
+                     process_nodes(Nodes, SrcInfo, KytheFactsFromNodes0, Exprs, Meta),
+                     Pass1Result),
+    (   Pass1Result = overrun(Pass1Reason)
+    ->  import_graph_set_imports(SrcPath, []),
+        record_overrun(Opts, SrcPath, Meta, pass1, Pass1Reason, MetricsStart),
+        process_module_file_only(Opts, SrcPath, SrcFqn, Meta, SrcInfo, Symtab1, Symtab),
+        write_file_metrics(Opts, SrcPath, SrcFqn, Symtab, MetricsStart)
+    ;   log_kythe_fact_msgs(KytheFactsFromNodes0, KytheFactsFromNodes),
+        modules_in_exprs(Exprs, ModulesInExprs),
+        convlist(module_type_path, ModulesInExprs, ImportedPaths),
+        import_graph_set_imports(SrcPath, ImportedPaths),
+        log_if(trace_file(SrcPath),
+               'MODULES_IN_EXPRS: ~q', [[ModulesInExprs, src=SrcPath, SrcFqn]]),
+        do_if(trace_file(Meta.path), dump_term('PASS1-EXPR_MODULES', ModulesInExprs)),
+        do_if(trace_file(Meta.path), dump_term('PASS1-EXPR', Exprs)),
+        % Note that the following allows any imported module to be from_src
+        % (FromSrcOk to process_module_cached_or_from_src is 'from src ok').
+        % TODO: for ModulesInExprs that are module_star, need
+        %       to update symtab with top-level items (starts
+        %       with module. and doesn't have '.' inside).
+        stats(Stats1),
+        log_if(true, 'Pass 1: process nodes for ~q ~w', [Meta.path, Stats1]),
+        metrics_phase(SrcPath, pass1, T1, T2),
+        foldl_process_module_cached_or_from_src(Opts, 'from src ok', ModulesInExprs, Symtab1, Symtab1WithImports),
+        stats(Stats2),
+        log_if(true, 'Pass 2: process exprs for ~q ~w', [Meta.path, Stats2]),
+        metrics_phase(SrcPath, imports, T2, T3),
+        % The time for the imports isn't counted against this file's budget.
+        (   Opts.process_time_limit > 0
+        ->  FixpointTimeLimit is max(0.001, Opts.process_time_limit - (T2 - T1))
+        ;   FixpointTimeLimit = 0
+        ),
+        with_file_budget(FixpointTimeLimit,
+                         assign_exprs(Opts, Exprs, Meta, Symtab1WithImports, SymtabFixpoint, KytheFactsFromExprs0),
+                         FixpointResult),
+        !,                          % "cut" for memory usage
+        (   FixpointResult = overrun(FixpointReason)
+        ->  record_overrun(Opts, SrcPath, Meta, fixpoint, FixpointReason, MetricsStart),
+            process_module_file_only(Opts, SrcPath, SrcFqn, Meta, SrcInfo, Symtab1WithImports, Symtab),
+            write_file_metrics(Opts, SrcPath, SrcFqn, Symtab, MetricsStart)
+        ;   Symtab = SymtabFixpoint,
+            log_kythe_fact_msgs(KytheFactsFromExprs0, KytheFactsFromExprs1),
+            include(nonredundant_pytype_fact(Symtab), KytheFactsFromExprs1, KytheFactsFromExprs),
+            !,                          % "cut" for memory usage  *** THIS ONE IS IMPORTANT ***
+            stats(Stats3a),
+            log_if(true, 'Pass 3a: output for ~q ~w', [Meta.path, Stats3a]),
+            metrics_phase(SrcPath, fixpoint, T3, _T4),
+            output_kythe(Opts, Meta, SrcPath, SrcFqn, Symtab, KytheFactsFromExprs, KytheFactsFromNodes),
+            stats(Stats3b),
+            log_if(true, 'Pass 3b: output for ~q ~w', [Meta.path, Stats3b]),
+            write_file_metrics(Opts, SrcPath, SrcFqn, Symtab, MetricsStart)
+        )
+    ).
+
+%! process_module_file_only(+Opts:list, +SrcPath:atom, +SrcFqn:atom, +Meta:dict, +SrcInfo:dict, +Symtab0, -Symtab) is det.
+% Output only the file-level facts (kyfile//1: the file node, its text
+% and its colors), for a file that's in the skip list or that exceeded
+% its budget.
+process_module_file_only(Opts, SrcPath, SrcFqn, Meta, SrcInfo, Symtab, Symtab) :-
+    kyfile(SrcInfo, KytheFacts, [], Meta), % phrase(kyfile(SrcInfo), KytheFacts, Meta)
+    output_kythe(Opts, Meta, SrcPath, SrcFqn, Symtab, [], KytheFacts).
+
+%! file_color_text(+Nodes, +Meta:dict, +ColorTexts0:list, -ColorTexts:list) is det.
+% The color items for kyfile//1 (which outputs the only color table
+% for a file): ColorTexts0 from the parser or, if there are none
+% because Nodes is an error node (parse error, decode error or
+% crash), a single item for the whole file.
+file_color_text(Nodes, Meta, [], [color{lineno:1, column:0, start:0, end:End,
+                                        token_color:'<PUNCTUATION_REF>', % TODO: special value for this?
+                                        value:Meta.contents_bytes}]) :-
+    is_dict(Nodes, Tag),
+    memberchk(Tag, ['ParseError', 'DecodeError', 'Crash']),
+    !,
+    string_length(Meta.contents_bytes, End).
+file_color_text(_Nodes, _Meta, ColorTexts, ColorTexts).
+
+%! parser_budget_exceeded(+Nodes, -Reason) is semidet.
+% Succeeds if the parser (--parsecmd) exceeded its budget, in which
+% case it outputs a 'Crash' node whose str starts with the same text
+% as BUDGET_EXCEEDED in pykythe/__main__.py.
+parser_budget_exceeded(Nodes, Reason) :-
+    is_dict(Nodes, 'Crash'),
+    Reason = Nodes.str,
+    sub_string(Reason, 0, _, _, "Budget exceeded").
+
+%! record_overrun(+Opts:dict, +SrcPath:atom, +Meta:dict, +Phase:atom, +Reason, +MetricsStart) is det.
+% Log that SrcPath exceeded its budget in Phase and add it to the
+% skip list, with its metrics so far.
+record_overrun(Opts, SrcPath, Meta, Phase, Reason, metrics_start(Time0, _Inferences0, _GcMsec0)) :-
+    get_time(Time),
+    Seconds is Time - Time0,
+    format(atom(ReasonAtom), '~w', [Reason]),
+    log_if(true, 'WARNING: ~q exceeded its budget in ~w (~w) after ~3f sec: file-level output only',
+           [SrcPath, Phase, ReasonAtom, Seconds]),
+    (   file_metric(SrcPath, parser, ParserMetrics)
+    ->  true
+    ;   ParserMetrics = json{}
+    ),
+    findall(MetricPhase-PhaseSeconds, file_metric(SrcPath, phase(MetricPhase), PhaseSeconds), PhasePairs),
+    dict_pairs(Phases, json, PhasePairs),
+    skip_list_add(Opts.skip_list, SrcPath,
+                  json{path: SrcPath,
+                       sha1: Meta.sha1,
+                       version: Opts.version,
+                       phase: Phase,
+                       reason: ReasonAtom,
+                       seconds: Seconds,
+                       parser: ParserMetrics,
+                       phases: Phases}).
+
 %! output_kythe(+Opts:list, +Meta:dict, +SrcPath:atom, +SrcFqn:atom, +Symtab, +KytheFactsFromExprs:list, +KytheFactsFromNodes:list) :-
 output_kythe(Opts, Meta, SrcPath, SrcFqn, Symtab, KytheFactsFromExprs, KytheFactsFromNodes) :-
+    get_time(T0),
     validate_symtab(Symtab),
     % Output /pykythe/type facts, for debugging.
     symtab_pykythe_types(Symtab, SymtabPykytheTypes, [], Meta), % phrase(symtab_pykythe_types(Symtab), SymtabPYkytheTypes, Meta)
-    append([KytheFactsFromNodes, KytheFactsFromExprs, SymtabPykytheTypes], KytheFactsUncleaned),
-    clean_kythe_facts(KytheFactsUncleaned, KytheFactsCleaned),
     !,                          % "cut" for memory usage
-    % TODO: don't preserve order (for debugging) - use sort/2 to dedup:
-    list_to_set(KytheFactsCleaned, KytheFacts),
     log_if(true, 'Writing Kythe facts for ~q', [Meta.path]),
     path_with_suffix(Opts, SrcPath, Opts.kythejson_suffix, KytheJsonPath),
-    write_atomic_stream(write_kythe_facts(KytheFacts), KytheJsonPath),
+    path_with_suffix(Opts, SrcPath, Opts.kytheentries_suffix, KytheEntriesPath),
+    kythe_outputs(Opts, KytheJsonPath, KytheEntriesPath, OutputFormats, OutputPaths),
+    write_atomic_streams(
+        write_kythe_facts([KytheFactsFromNodes, KytheFactsFromExprs, SymtabPykytheTypes], OutputFormats),
+        OutputPaths),
     path_with_suffix(Opts, SrcPath, Opts.pykythesymtab_suffix, PykytheSymtabPath),
     path_with_suffix(Opts, SrcPath, Opts.pykythebatch_suffix, PykytheBatchPath),
     write_atomic_stream(write_symtab(Symtab, Opts.version, Meta.sha1), PykytheSymtabPath),
@@ -974,9 +1263,13 @@ output_kythe(Opts, Meta, SrcPath, SrcFqn, Symtab, KytheFactsFromExprs, KytheFact
         % other process would have generated the same file contents.
         safe_hard_link_file_dup_ok(PykytheSymtabPath, PykytheBatchPath)
     ),
-    log_if(true, 'Converting to Kythe protobuf'),
-    path_with_suffix(Opts, SrcPath, Opts.kytheentries_suffix, KytheEntriesPath),
-    write_atomic_file(write_to_protobuf(Opts.entriescmd, SrcPath, KytheJsonPath), KytheEntriesPath),
+    metrics_phase(SrcPath, output, T0, T1),
+    (   Opts.entriescmd == ''
+    ->  true                    % Already written by write_kythe_facts/3
+    ;   log_if(true, 'Converting to Kythe protobuf'),
+        write_atomic_file(write_to_protobuf(Opts.entriescmd, SrcPath, KytheJsonPath), KytheEntriesPath),
+        metrics_phase(SrcPath, entries, T1, _T2)
+    ),
     log_if(true, 'Finished output ~q (~q) to ~q (~q)', [SrcPath, SrcFqn, KytheEntriesPath, KytheJsonPath]),
     !.                          % "cut" for memory usage
 
@@ -1034,11 +1327,12 @@ parse_and_get_meta(Opts, SrcPath, SrcFqn, Meta, Nodes, ColorTexts) :-
                   'builtins_version(~q) should be ~q', [BuiltinsVersion, Opts.version]),
     get_time(T0),
     run_parse_cmd(Opts, SrcPath, SrcFqn, ParsedPath),
-    get_time(T1),
+    metrics_phase(SrcPath, parse_cmd, T0, T1),
     ParseTime is T1 - T0,
-    % TODO: put parser run time into Meta returned from Opts.parsecmd
     log_if(true, 'Python parser: finished parsing/fqn (~2f sec) into ~q', [ParseTime, ParsedPath]),
-    read_nodes(ParsedPath, Nodes, Meta, ColorTexts),
+    read_nodes(ParsedPath, Nodes, Meta, ColorTexts, ParserMetrics),
+    assertz(file_metric(SrcPath, parser, ParserMetrics)),
+    metrics_phase(SrcPath, read_nodes, T1, _T2),
     log_if(true, 'Processed AST nodes from Python parser'),
     % Fill in dict items that were left uninstantiated in simplify_meta/2 (read_nodes/3):
     Meta.pythonpath = Opts.pythonpath,
@@ -1124,55 +1418,106 @@ validate_symtab_pair(Fqn-Type) :-
     must_be(atom, Fqn),
     must_be(list, Type).
 
-%! clean_kythe_facts(-KytheFacts0:list, +KytheFacts:list) is det.
-% Clean the Kythe facts so that they're acceptable to Kythe verifier
-% and other downstream processing (e.g., remove inconsistent "kind"
-% info).
-% TODO: See https://github.com/kythe/kythe/issues/2381
-clean_kythe_facts(KytheFacts0, KytheFacts) :-
-    kythe_kinds(KytheFacts0, kinds{}, KytheFacts2, Kinds),
-    dict_pairs(Kinds, kinds, KindsPairs),
-    maplist(clean_kind, KindsPairs, Kinds2),
-    % Kinds2 must come *after* KytheFacts - maybe_read_symtab_from_cache/5.
-    append(KytheFacts2, Kinds2, KytheFacts).
-
-%! kythe_kinds(+Facts:list, +KindsIn:dict, -FactsOut, -KindsOut:dict) is det.
-% Selects '/kythe/node/kind' facts and puts them into KindsOut (except
-% for some "special" facts: anchor, package, file).  The `Kindsout`
-% dict is keyed by the `Source` values of the 'kind' facts and
-% contains a set of all the fact_values.
-kythe_kinds([], Kinds, [], Kinds).
-kythe_kinds([json{fact_name:'/kythe/node/kind', fact_value:KindValue, source:Source}|Facts],
-            KindsIn, FactsOut, KindsOut) :-
-    KindValue \= 'anchor',  % should never have another kind
-    KindValue \= 'package', % should never have another kind
-    KindValue \= 'file',    % This is special (see maybe_read_symtab_from_cache/5)
-    !,
-    term_to_canonical_atom(Source, SourceAtom),
-    get_dict_default(SourceAtom, KindsIn, [], KindSeen),
-    type_add_element(KindSeen, KindValue, KindSeen2),
-    put_dict(SourceAtom, KindsIn, KindSeen2, Kinds2),
-    kythe_kinds(Facts, Kinds2, FactsOut, KindsOut).
-kythe_kinds([Fact|Facts], Kinds, [Fact|FactsOut], KindsOut) :-
-    kythe_kinds(Facts, Kinds, FactsOut, KindsOut).
-
-%! clean_kind(+SourceAtom-Kinds:pair, -Fact:dict) is det.
-% Clean a single item, creating its JSON representation.
-clean_kind(SourceAtom-Kinds,
-           json{source:Source, fact_name:'/kythe/node/kind', fact_value:Kind}) :-
-    % See kyfact//3.
-    term_to_atom(Source, SourceAtom),
-    (   Kinds = [Kind]
-    ->  true
-    ;   must_once(maplist(precedence_and_kind, Kinds, PKs)),
-        keysort(PKs, [_-Kind|_]),
-        log_if(true, 'INFO: Cleaned kind: ~q->~q for ~q', [Kinds, Kind, Source])
+%! kythe_outputs(+Opts:dict, +KytheJsonPath:atom, +KytheEntriesPath:atom, -Formats:list, -Paths:list) is det.
+% The output formats (json, entries) and their corresponding paths
+% for write_kythe_facts/3. If Opts.entriescmd isn't '', the
+% entries file is created afterwards from the JSON file (see
+% write_to_protobuf/4).
+kythe_outputs(Opts, KytheJsonPath, KytheEntriesPath, Formats, Paths) :-
+    (   Opts.kythejson_suffix == ''
+    ->  JsonFormats = [], JsonPaths = []
+    ;   JsonFormats = [json], JsonPaths = [KytheJsonPath]
+    ),
+    (   Opts.entriescmd == ''
+    ->  EntriesFormats = [entries], EntriesPaths = [KytheEntriesPath]
+    ;   EntriesFormats = [], EntriesPaths = []
+    ),
+    append(JsonFormats, EntriesFormats, Formats),
+    append(JsonPaths, EntriesPaths, Paths).
+
+%! write_kythe_facts(+KytheFactsLists:list(list), +Formats:list, +Streams:list) is det.
+% Write the Kythe facts to each of the Streams, in the corresponding
+% format (json or entries). Duplicate facts are removed, using a hash
+% table of the facts seen so far, and each fact is written as soon as
+% it's known to not be a duplicate; this avoids creating
+% intermediate lists of all the facts (e.g., with append/2 and
+% list_to_set/2).
+%
+% The facts are also "cleaned" so that they're acceptable to Kythe
+% verifier and other downstream processing: a node may get multiple
+% '/kythe/node/kind' facts (e.g., from multiple assignments), so only
+% the one with the lowest kind_precedence/2 is kept. (See
+% https://github.com/kythe/kythe/issues/2381) These are output after
+% all the other facts.
+write_kythe_facts(KytheFactsLists, Formats, Streams) :-
+    pairs_keys_values(Outputs, Formats, Streams),
+    maplist(prepare_kythe_output, Outputs),
+    clear_kythe_json_cache,
+    empty_nb_set(Seen),
+    rb_empty(Kinds0),
+    foldl(write_kythe_facts_dedup(Outputs, Seen), KytheFactsLists, Kinds0, Kinds),
+    rb_visit(Kinds, KindsPairs),
+    maplist(write_kind_fact(Outputs), KindsPairs).
+
+%! prepare_kythe_output(+FormatStream:pair) is det.
+% Both outputs are written in large chunks (the default buffer is
+% 4K).
+prepare_kythe_output(json-Stream) :-
+    set_stream(Stream, buffer_size(65536)).
+prepare_kythe_output(entries-Stream) :-
+    set_stream(Stream, type(binary)),
+    set_stream(Stream, buffer_size(65536)).
+
+%! write_kythe_facts_dedup(+Outputs:list(pair), +Seen, +KytheFacts:list, +Kinds0, -Kinds) is det.
+write_kythe_facts_dedup(Outputs, Seen, KytheFacts, Kinds0, Kinds) :-
+    foldl(write_kythe_fact_dedup(Outputs, Seen), KytheFacts, Kinds0, Kinds).
+
+%! write_kythe_fact_dedup(+Outputs:list(pair), +Seen, +KytheFact, +Kinds0, -Kinds) is det.
+% Kinds is an rbtree that maps a kind fact's source to its kind
+% (which is output by write_kind_fact/2).
+write_kythe_fact_dedup(Outputs, Seen, KytheFact, Kinds0, Kinds) :-
+    (   kythe_kind_fact(KytheFact, Source, Kind)
+    ->  add_kind(Source, Kind, Kinds0, Kinds)
+    ;   Kinds = Kinds0,
+        add_nb_set(KytheFact, Seen, New),
+        (   New == true
+        ->  maplist(write_kythe_fact(KytheFact), Outputs)
+        ;   true
+        )
+    ).
+
+%! kythe_kind_fact(+Fact, -Source, -Kind) is semidet.
+% Selects '/kythe/node/kind' facts that need cleaning (that is,
+% excluding some "special" facts: anchor, package, file).
+kythe_kind_fact(json{fact_name:'/kythe/node/kind', fact_value:Kind, source:Source}, Source, Kind) :-
+    Kind \= 'anchor',  % should never have another kind
+    Kind \= 'package', % should never have another kind
+    Kind \= 'file'.    % This is special (see maybe_read_symtab_from_cache/5)
+
+%! add_kind(+Source, +Kind, +Kinds0, -Kinds) is det.
+% Add Kind for Source to the Kinds rbtree, keeping the kind with the
+% lowest precedence if there's already a kind for Source.
+add_kind(Source, Kind, Kinds0, Kinds) :-
+    (   rb_lookup(Source, KindSeen, Kinds0)
+    ->  (   KindSeen == Kind
+        ->  Kinds = Kinds0
+        ;   must_once(kind_precedence(KindSeen, PrecedenceSeen)),
+            must_once(kind_precedence(Kind, Precedence)),
+            (   Precedence < PrecedenceSeen
+            ->  KindClean = Kind
+            ;   KindClean = KindSeen
+            ),
+            log_if(true, 'INFO: Cleaned kind: ~q->~q for ~q', [[KindSeen, Kind], KindClean, Source]),
+            rb_update(Kinds0, Source, KindClean, Kinds)
+        )
+    ;   rb_insert_new(Kinds0, Source, Kind, Kinds)
     ).
 
-%! precedence_and_kind(+Kind, -PrecedenceKind:pair) is det.
-% Map each kind to a pair with it precedence (for keysort)
-precedence_and_kind(Kind, Precedence-Kind) :-
-    must_once(kind_precedence(Kind, Precedence)).
+%! write_kind_fact(+Outputs:list(pair), +SourceKind:pair) is det.
+write_kind_fact(Outputs, Source-Kind) :-
+    % See kyfact//3.
+    maplist(write_kythe_fact(json{source:Source, fact_name:'/kythe/node/kind', fact_value:Kind}),
+            Outputs).
 
 %! kind_prededence(+Kind, -Precedence) is det.
 % The precedence for each 'kind' that we output.  This is used for
@@ -1186,15 +1531,149 @@ kind_precedence(variable, -80).
 kind_precedence(record, -50).
 kind_precedence(function, -49).
 
-%! write_kythe_facts(+KytheFacts, +KytheOutStream) is det.
-write_kythe_facts(KytheFacts, KytheOutStream) :-
-    % write(KytheOutStream, "%% === Kythe ==="), nl(KytheOutStream),
-    maplist(transform_and_write_kythe_fact(KytheOutStream), KytheFacts).
+%! write_kythe_fact(+KytheFact, +FormatStream:pair) is det.
+write_kythe_fact(KytheFact, json-KytheOutStream) :-
+    write_kythe_fact_json(KytheOutStream, KytheFact).
+write_kythe_fact(KytheFact, entries-KytheEntriesStream) :-
+    transform_and_write_kythe_entry(KytheEntriesStream, KytheFact).
 
+%! transform_and_write_kythe_fact(+KytheOutStream, +KytheFact) is det.
+% The "reference" JSON writer, using transform_kythe_fact/2 and
+% json_write_dict/3; write_kythe_fact_json/2 is the (faster)
+% equivalent that is used for output.
 transform_and_write_kythe_fact(KytheOutStream, KytheFact) :-
     transform_kythe_fact(KytheFact, KytheFact2),
     pykythe_json_write_dict_nl(KytheOutStream, KytheFact2).
 
+%! write_kythe_fact_json(+KytheOutStream, +KytheFact) is det.
+% Same result as transform_and_write_kythe_fact/2 (modulo the order
+% of keys), but without creating an intermediate dict and calling
+% json_write_dict/3 for each fact. Instead, the JSON is written with
+% a single format/3 call, using cached fragments:
+%  - the vname without its signature (corpus, root, path, language),
+%    which is the same for most facts in a file;
+%  - fact and edge names;
+%  - base64 of fact values that recur (e.g., kinds); other fact values
+%    are mostly unique (e.g., /pykythe/type), so they aren't cached.
+% The caches are cleared by clear_kythe_json_cache/0 for each file.
+write_kythe_fact_json(KytheOutStream, json{source:Source, fact_name:FactName, fact_value:FactValue}) :- !,
+    vname_json(Source, SourceOpen, SourceSignature, SourceTail),
+    kythe_json_atom(FactName, FactNameJson),
+    fact_value_base64(FactName, FactValue, FactValueBase64),
+    format(KytheOutStream, '{"source":~w~w~w,"fact_name":~w,"fact_value":"~w"}~n',
+           [SourceOpen, SourceSignature, SourceTail, FactNameJson, FactValueBase64]).
+write_kythe_fact_json(KytheOutStream, json{source:Source, fact_name:'/', edge_kind:EdgeKind, target:Target}) :- !,
+    vname_json(Source, SourceOpen, SourceSignature, SourceTail),
+    kythe_json_atom(EdgeKind, EdgeKindJson),
+    vname_json(Target, TargetOpen, TargetSignature, TargetTail),
+    format(KytheOutStream, '{"source":~w~w~w,"edge_kind":~w,"target":~w~w~w,"fact_name":"/"}~n',
+           [SourceOpen, SourceSignature, SourceTail, EdgeKindJson, TargetOpen, TargetSignature, TargetTail]).
+write_kythe_fact_json(_KytheOutStream, KytheFact) :-
+    domain_error(json, KytheFact).
+
+:- thread_local
+    kythe_json_vname_cache/3,
+    kythe_json_atom_cache/2,
+    kythe_json_base64_cache/2.
+
+%! clear_kythe_json_cache is det.
+clear_kythe_json_cache :-
+    retractall(kythe_json_vname_cache(_, _, _)),
+    retractall(kythe_json_atom_cache(_, _)),
+    retractall(kythe_json_base64_cache(_, _)).
+
+%! vname_json(+VName:dict, -Open:atom, -Signature:atom, -Tail:atom) is det.
+% The JSON for a vname (transformed by transform_kythe_vname/2) is
+% the concatenation of Open, Signature, Tail, where Signature is
+% either '' or the JSON string for the signature followed by ','
+% and Tail contains the remaining items (cached) and the closing '}'.
+vname_json(VName, Open, Signature, Tail) :-
+    transform_kythe_vname(VName, VName1),
+    (   del_dict(signature, VName1, SignatureAtom, VNameNoSignature)
+    ->  Open = '{"signature":',
+        kythe_json_atom_uncached(SignatureAtom, ',', Signature)
+    ;   Open = '{',
+        Signature = '',
+        VNameNoSignature = VName1
+    ),
+    get_dict_default(path, VNameNoSignature, '', Path),
+    (   kythe_json_vname_cache(Path, VNameNoSignature, Tail)
+    ->  true
+    ;   with_output_to(string(VNameJson),
+                       json_write_dict(current_output, VNameNoSignature, [width(0)])),
+        sub_atom(VNameJson, 1, _, 0, Tail), % remove leading '{'
+        assertz(kythe_json_vname_cache(Path, VNameNoSignature, Tail))
+    ).
+
+%! kythe_json_atom(+Atom, -Json:atom) is det.
+% Cached version of kythe_json_atom_uncached/3, for fact and edge names.
+kythe_json_atom(Atom, Json) :-
+    (   kythe_json_atom_cache(Atom, Json)
+    ->  true
+    ;   kythe_json_atom_uncached(Atom, '', Json),
+        assertz(kythe_json_atom_cache(Atom, Json))
+    ).
+
+%! kythe_json_atom_uncached(+Atom, +Suffix:atom, -Json:atom) is det.
+% The JSON string (with quotes) for an atom, followed by Suffix. Most
+% atoms (e.g., anchor signatures, FQNs) don't need escaping, so
+% json_write/3 is only used if necessary.
+kythe_json_atom_uncached(Atom, Suffix, Json) :-
+    (   re_match("^[^\"\\\\\\x00-\\x1f]*$", Atom)
+    ->  atomic_list_concat(['"', Atom, '"', Suffix], Json)
+    ;   with_output_to(atom(Json),
+                       ( json_write(current_output, Atom, [width(0)]),
+                         write(Suffix) ))
+    ).
+
+%! fact_value_base64(+FactName, +FactValue, -FactValueBase64) is det.
+% See transform_kythe_fact/2.
+fact_value_base64(FactName, FactValue, FactValueBase64) :-
+    (   FactName == '/kythe/text'
+    ->  FactValueBase64 = FactValue  % already in base64
+    ;   recurring_fact_value(FactName)
+    ->  (   kythe_json_base64_cache(FactValue, FactValueBase64)
+        ->  true
+        ;   base64_utf8(FactValue, FactValueBase64),
+            assertz(kythe_json_base64_cache(FactValue, FactValueBase64))
+        )
+    ;   base64_utf8(FactValue, FactValueBase64)
+    ).
+
+%! recurring_fact_value(+FactName) is semidet.
+% Fact names whose values come from a small set (so it's worth
+% caching their base64 encodings).
+recurring_fact_value('/kythe/node/kind').
+recurring_fact_value('/kythe/subkind').
+recurring_fact_value('/kythe/language').
+recurring_fact_value('/kythe/text/encoding').
+recurring_fact_value('/pykythe/version').
+
+transform_and_write_kythe_entry(KytheEntriesStream, KytheFact) :-
+    transform_kythe_entry(KytheFact, Entry),
+    write_kythe_entry(KytheEntriesStream, Entry).
+
+%! transform_kythe_entry(+Fact, -Entry) is det.
+% Like transform_kythe_fact/2, but creates an entry(...) term for
+% kythe_entries:write_kythe_entry/2, with the fact_value as bytes
+% instead of base64.
+transform_kythe_entry(json{source:Source0, fact_name:FactName, fact_value:FactValue},
+                      entry(Source1, '', none, FactName, FactValueBytes)) :- !,
+    % text is alread in base64 (from Meta.contents_base64)
+    (   FactName == '/kythe/text'
+    ->  base64_ascii(FactValueBytesAtom, FactValue),
+        atom_codes(FactValueBytesAtom, FactValueBytes)
+    ;   atom_codes(FactValue, FactValueCodes),
+        phrase(utf8_codes(FactValueCodes), FactValueBytes)
+    ),
+    transform_kythe_vname(Source0, Source1).
+transform_kythe_entry(json{source:Source0, fact_name:'/', edge_kind:EdgeKind, target:Target0},
+                      entry(Source1, EdgeKind, Target1, '/', [])) :- !,
+    transform_kythe_vname(Source0, Source1),
+    transform_kythe_vname(Target0, Target1).
+transform_kythe_entry(Fact, _Entry) :-
+    domain_error(json, Fact).
+
 %! write_to_protobuf(+EntriesCmd, +SrcPath, +KytheJsonPath, +KytheEntriesPath) is det.
 write_to_protobuf(EntriesCmd, SrcPath, KytheJsonPath, KytheEntriesPath) :-
     atomic_list_concat( % TODO: use process_create/3 instead of shell/2
@@ -1230,6 +1709,9 @@ run_parse_cmd(Opts, SrcPath, SrcFqn, OutPath) :-
          " --python_version='", Opts.python_version, "'",
          " --srcpath='", SrcPath, "'",
          " --module='", SrcFqn, "'",
+         " --max_cpu_seconds='", Opts.parse_cpu_limit, "'",
+         " --max_memory_mb='", Opts.parse_memory_limit, "'",
+         " --cache_version='", Opts.version, "'",
          " --out_fqn_ast='", OutPath, "'"],
         Cmd),
     do_if(trace_file(SrcPath), dump_term('CMD-parse', Cmd)),
@@ -1273,33 +1755,36 @@ version_as_kyfact(Version, Meta,
 symtab_pykythe_types(Symtab) -->>
     Meta/file_meta,
     { append_fqn_dot(Meta.src_fqn, SrcFqnDot) },
-    { symtab_pairs(Symtab, SymtabPairs) },
-    maplist_kyfact(add_kyfact_types(SrcFqnDot), SymtabPairs).
-
-%! add_kyfact_types(+Prefix, +Fqn-Type:pair)//[kyfact,file_meta] is det.
-% Generate kyfact if its FQN (in symtab) starts with Prefix
-add_kyfact_types(Prefix, Fqn-Type) -->>
-    (   { has_prefix(Fqn, Prefix) }
-        % If we don't want the builtins, do this test:
-        %   builtins_pairs(BuiltinsPairs), % inefficient - should use a dict
-        %   \+ memberchk(Fqn2-_, BuiltinsPairs),
-    ->  { term_to_canonical_atom(Type, TypeAsAtom) },
-        signature_node(Fqn, FqnSource),
-        kyfact(FqnSource, '/pykythe/type', TypeAsAtom)
-    ;   [ ]
-    ).
-
-%! read_nodes(+FqnExprPath:atom, -Nodes, -Meta:dict, -ColorTexts:list(dict)) is det.
+    { symtab_prefix_pairs(SrcFqnDot, Symtab, SymtabPairs) },
+    maplist_kyfact(add_kyfact_types, SymtabPairs).
+
+%! add_kyfact_types(+Fqn-Type:pair)//[kyfact,file_meta] is det.
+% Generate kyfact for an FQN (in symtab).
+add_kyfact_types(Fqn-Type) -->>
+    % If we don't want the builtins, check that Fqn isn't in
+    % builtins_pairs/1 (inefficient - should use a dict).
+    { term_to_canonical_atom(Type, TypeAsAtom) },
+    signature_node(Fqn, FqnSource),
+    kyfact(FqnSource, '/pykythe/type', TypeAsAtom).
+
+%! read_nodes(+FqnExprPath:atom, -Nodes, -Meta:dict, -ColorTexts:list(dict), -ParserMetrics:dict) is det.
 % Read the JSON node tree (with FQNs) into Nodes and file meta-data into Meta.
-read_nodes(FqnExprPath, Nodes, Meta, ColorTexts) :-
+% ParserMetrics are the timings from the parser (see __main__.Metrics),
+% or an empty dict if they're not there.
+read_nodes(FqnExprPath, Nodes, Meta, ColorTexts, ParserMetrics) :-
     setup_call_cleanup(
         open(FqnExprPath, read, FqnExprStream, [type(binary)]),
         (   read_term(FqnExprStream, MetaJson, []),
             read_term(FqnExprStream, NodesJson, []),
-            read_term(FqnExprStream, ColorTextsJson, [])
+            read_term(FqnExprStream, ColorTextsJson, []),
+            read_term(FqnExprStream, ParserMetrics0, [])
         ),
         close(FqnExprStream)
     ),
+    (   is_dict(ParserMetrics0)
+    ->  ParserMetrics = ParserMetrics0
+    ;   ParserMetrics = parser_metrics{}
+    ),
     % sanity check that capitalized strings were quoted:
     must_once(ground(MetaJson)),
     must_once(ground(NodesJson)),
@@ -1424,49 +1909,69 @@ kyfile(SrcInfo) -->>
     kyfact(Source, '/kythe/text/encoding', Meta.encoding),
     kyfact(Source, '/kythe/language', python),
     kyfact(Source, '/kythe/text', Meta.contents_base64),  % Special case - see transform_kythe_fact/2
-    maplist_kyfact(kyfact_color, SrcInfo.color_text),
+    kyfact_color_table(SrcInfo.color_text),
     kyedge_fqn(Source, '/kythe/edge/childof', SrcInfo.src_fqn),
     % Kythe's "package" is the equivalent of Python's "module".
     % (There is no equivalent of Python's "package" ... we just use
     % /kythe/edge/ref/imports on the import statements.)
     kyfact_signature_node(SrcInfo.src_fqn, '/kythe/node/kind', 'package').
 
-%! kyfact_color(+ColorItem)//[kyfact,file_meta] is det.
-% Output flattened color facts for one token
-kyfact_color(color{lineno:Lineno,
-                   column:Column,
-                   start:StartAtom,
-                   end:EndAtom,
-                   token_color:TokenColor,
-                   value:Value
-                  }) -->>
+%! kyfact_color_table(+ColorItems:list)//[kyfact,file_meta] is det.
+% Output the color items for a file as a single fact (nothing if there
+% are no color items, e.g. for a parse error).
+% Outputting one fact per token (a color{...} dict) doubled the size
+% of the output (13MB to 26MB) and increased processing time by
+% ~50%; outputting details per token was even worse (62MB), so
+% instead the color items are output as a "columnar" table, with the
+% values delta-encoded (mostly small numbers). The token values
+% aren't output because they can be recovered from the file's
+% contents (/kythe/text) by the start and end offsets.
+% See color_table/2 for the details and
+% browser/src_browser.pl assert_color_table/5 for the decoding.
+kyfact_color_table([]) -->> !.
+kyfact_color_table(ColorItems) -->>
+    { color_table(ColorItems, ColorTable) },
+    { format(atom(ColorTableText), '~q', [ColorTable]) },
+    signature_source('#color_table', Source),
+    kyfact(Source, '/pykythe/color_table', ColorTableText).
+
+%! color_table(+ColorItems:list, -ColorTable) is det.
+% Create the color table term
+%   color_table(Colors, StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes)
+% where Colors is the sorted list of token_color values (so ColorCode
+% is a 0-origin index into Colors), StartDeltas is the difference
+% between each item's start and the previous item's end (typically
+% 0, because the color items cover the entire file), Lengths is
+% end - start and LinenoDeltas is the difference from the previous
+% item's lineno.
+color_table(ColorItems, color_table(Colors, StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes)) :-
+    maplist(color_item_token_color, ColorItems, TokenColors),
+    sort(TokenColors, Colors),
+    color_table_columns(ColorItems, 0, 1, Colors, StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes).
+
+color_item_token_color(Color, Color.token_color).
+
+%! color_table_columns(+ColorItems:list, +PrevEnd:int, +PrevLineno:int, +Colors:list, -StartDeltas:list, -Lengths:list, -LinenoDeltas:list, -Columns:list, -ColorCodes:list) is det.
+color_table_columns([], _PrevEnd, _PrevLineno, _Colors, [], [], [], [], []).
+color_table_columns([color{lineno:LinenoAtom,
+                           column:ColumnAtom,
+                           start:StartAtom,
+                           end:EndAtom,
+                           token_color:TokenColor,
+                           value:_Value}|ColorItems],
+                    PrevEnd, PrevLineno, Colors,
+                    [StartDelta|StartDeltas], [Length|Lengths], [LinenoDelta|LinenoDeltas],
+                    [Column|Columns], [ColorCode|ColorCodes]) :-
     % See anchor_signature_str/4:
-    { term_to_atom(Start, StartAtom) },
-    { term_to_atom(End, EndAtom) },
-    { format(atom(ColorSignature), '#~d', [Start]) },
-    signature_source(ColorSignature, Source),
-    % TODO: The following /pykythe/color/... facts are too verbose, but
-    %      they fit with Kythe style - outputting the color info also
-    %      increases processing time by ~50% vs no color info.
-    %         Not outputting any color info:              13MB
-    %         Outputting all color info as single string: 19MB
-    %         Outputting one fact per token:              26MB
-    %         Outputting details per token:               62MB
-    %           kyfact(Source, '/pykythe/color/lineno', Lineno),
-    %           kyfact(Source, '/pykythe/color/column', Column),
-    %           kyfact(Source, '/pykythe/color/start', Start),
-    %           kyfact(Source, '/pykythe/color/end', End),
-    %           kyfact(Source, '/pykythe/color/color', TokenColor),
-    %           kyfact(Source, '/pykythe/color/value', Value),
-    % TODO: flatten this to a simple CSV?
-    { format(atom(ColorFactText), '~q',
-             [color{lineno:Lineno,
-                    column:Column,
-                    start:Start,
-                    end:End,
-                    token_color:TokenColor,
-                    value:Value}]) },
-    kyfact(Source, '/pykythe/color', ColorFactText).
+    term_to_atom(Lineno, LinenoAtom),
+    term_to_atom(Column, ColumnAtom),
+    term_to_atom(Start, StartAtom),
+    term_to_atom(End, EndAtom),
+    StartDelta is Start - PrevEnd,
+    Length is End - Start,
+    LinenoDelta is Lineno - PrevLineno,
+    must_once(nth0(ColorCode, Colors, TokenColor)),
+    color_table_columns(ColorItems, End, Lineno, Colors, StartDeltas, Lengths, LinenoDeltas, Columns, ColorCodes).
 
 %! kynode(+Node:json_dict, -Type)//[kyfact,expr,file_meta] is det.
 % Extract anchors (with FQNs) from the the AST nodes.  The anchors go
@@ -2267,8 +2772,12 @@ assign_exprs(Opts, Exprs, Meta, Symtab0, Symtab, KytheFacts) :-
 % TODO: Improved output when too many passes are needed.
 % TODO: Parameterize max number of passes.
 assign_exprs_count(Count, Opts, Exprs, Meta, Symtab0, Symtab, KytheFacts) :-
+    get_time(T0),
     assign_exprs_count_impl(Exprs, Meta, Symtab0, Symtab1, Rej, KytheFacts1), % phrase(assign_exprs_count(...))
+    get_time(T1),
     length(Rej, RejLen),
+    PassTime is T1 - T0,
+    assertz(file_metric(Meta.path, fixpoint_pass, json{pass:Count, seconds:PassTime, rej:RejLen})),
     log_if(true, % RejLen > 0, % TODO: Output Pass# with RejLen = 0 for performance profiling.
            'Process exprs: Pass ~q (rej=~q) for ~q', [Count, RejLen, Meta.path]),
     CountIncr is Count + 1,
@@ -2708,9 +3217,8 @@ eval_single_type_error_msg(FmtMessage, ArgsMessage, FmtDetails, ArgsDetails) -->
     { string_length(Meta.contents_bytes, AstnEnd) },
     { Astn = astn(0, AstnEnd, '-msg-') },
     kyanchor(0, AstnEnd, '-msg-', _AnchorSource),
-    kyfact_color(color{lineno:1, column:0, start:0, end:AstnEnd,
-                       token_color:'<PUNCTUATION_REF>', % TODO: special value for this?
-                       value:Meta.contents_bytes}),
+    % The whole-file color item (if the file has no colors) is output
+    % by kyfile//1; see file_color_text/4.
     log_kyfact_msg(Astn, FmtMessage, ArgsMessage, FmtDetails, ArgsDetails).
 
 eval_single_type_import(NameAstn, _ResolvedFqn, Edge, import_ref_type(_Name, ImportFqn, _Type)) -->> !,
@@ -3349,4 +3857,78 @@ stats(Stats) :-
 statistic_kv(Key, Key:Value) :-
     statistics(Key, Value).
 
+%! file_metric(?SrcPath:atom, ?Key, ?Value) is nondet.
+% Metrics for a file that's being processed from source, for
+% --metrics_out (see write_file_metrics/5). Imported files are
+% processed recursively, so these are keyed by SrcPath.
+% Key is one of: phase(Phase), fixpoint_pass, parser, stack.
+:- dynamic file_metric/3.
+
+%! metrics_start(+SrcPath:atom, -MetricsStart) is det.
+% Start collecting metrics for SrcPath.
+metrics_start(SrcPath, metrics_start(Time, Inferences, GcMsec)) :-
+    retractall(file_metric(SrcPath, _, _)),
+    get_time(Time),
+    statistics(inferences, Inferences),
+    statistics(garbage_collection, [_GcCount, _GcBytes, GcMsec|_]).
+
+%! metrics_phase(+SrcPath:atom, +Phase:atom, +T0:float, -T1:float) is det.
+% Record the time since T0 as Phase, with T1 being the current time.
+% Also records the stack usage, which is used to get the peak usage
+% (sampled at the end of each phase).
+metrics_phase(SrcPath, Phase, T0, T1) :-
+    get_time(T1),
+    Seconds is T1 - T0,
+    assertz(file_metric(SrcPath, phase(Phase), Seconds)),
+    statistics(stack, Stack),
+    assertz(file_metric(SrcPath, stack, Stack)).
+
+%! write_file_metrics(+Opts:dict, +SrcPath:atom, +SrcFqn:atom, +Symtab, +MetricsStart) is det.
+% If Opts.metrics_out isn't '', append a JSON line with the metrics
+% for SrcPath. The totals (seconds, inferences, gc_seconds) include
+% any imported files that were processed from source; their phases
+% are also in "imports".
+write_file_metrics(Opts, SrcPath, SrcFqn, Symtab, metrics_start(Time0, Inferences0, GcMsec0)) :-
+    (   Opts.metrics_out == ''
+    ->  true
+    ;   get_time(Time),
+        statistics(inferences, Inferences),
+        statistics(garbage_collection, [_GcCount, _GcBytes, GcMsec|_]),
+        Seconds is Time - Time0,
+        InferencesDelta is Inferences - Inferences0,
+        GcSeconds is (GcMsec - GcMsec0) / 1000.0,
+        findall(Phase-PhaseSeconds, file_metric(SrcPath, phase(Phase), PhaseSeconds), PhasePairs),
+        dict_pairs(Phases, json, PhasePairs),
+        findall(Pass, file_metric(SrcPath, fixpoint_pass, Pass), Passes),
+        (   file_metric(SrcPath, parser, ParserMetrics)
+        ->  true
+        ;   ParserMetrics = json{}
+        ),
+        aggregate_all(max(Stack), file_metric(SrcPath, stack, Stack), PeakStack),
+        symtab_size(Symtab, SymtabSize),
+        with_output_to(
+            string(MetricsJson),
+            json_write_dict(current_output,
+                            json{path: SrcPath,
+                                 fqn: SrcFqn,
+                                 version: Opts.version,
+                                 seconds: Seconds,
+                                 inferences: InferencesDelta,
+                                 gc_seconds: GcSeconds,
+                                 peak_stack: PeakStack,
+                                 symtab_size: SymtabSize,
+                                 parser: ParserMetrics,
+                                 phases: Phases,
+                                 fixpoint_passes: Passes},
+                            [width(0)])),
+        % A single write of the whole line, so that lines from
+        % concurrent processes aren't interleaved.
+        string_concat(MetricsJson, "\n", MetricsLine),
+        setup_call_cleanup(
+            open(Opts.metrics_out, append, MetricsStream, [encoding(utf8), buffer(full)]),
+            write(MetricsStream, MetricsLine),
+            close(MetricsStream))
+    ),
+    retractall(file_metric(SrcPath, _, _)).
+
 end_of_file.
@@ -20,7 +20,9 @@ pykythe_run_tests :-
 
 :- begin_tests(pykythe_dev).
 
-:- use_module(library(lists), [subtract/3]).
+:- use_module(library(lists), [append/3, member/2, numlist/3, subtract/3]).
+:- use_module(library(filesex), [delete_directory_and_contents/1, directory_file_path/3, make_directory_path/1]).
+:- use_module(library(http/json), [atom_json_dict/3]).
 
 test_meta(meta{kythe_corpus: 'CORPUS',
                kythe_root: 'ROOT',
@@ -91,6 +93,231 @@ test(base64_utf8) :-
              '├',
              '網目錦蛇 = 1  # アミメニシキヘビ 《網目錦蛇》 【あみめにしきへび】 (n) (uk) reticulated python (Python reticulatus)']).
 
+test(kythe_entry_bytes) :-
+    %% Expected bytes are per the protobuf wire format for kythe.proto.storage.Entry
+    kythe_entries:kythe_entry_bytes(
+        entry(json{signature:x, corpus:'C', root:'', path:p}, '', none,
+              '/kythe/node/kind', `variable`),
+        Bytes),
+    atom_codes('/kythe/node/kind', FactNameCodes),
+    append([[10, 9, 10, 1, 0'x, 18, 1, 0'C, 34, 1, 0'p],
+            [34, 16], FactNameCodes,
+            [42, 8], `variable`], Expected),
+    assertion(Bytes == Expected),
+    phrase(kythe_entries:varint(300), Varint300),
+    assertion(Varint300 == [0xac, 0x02]).
+
+test(read_kythe_entry) :-
+    %% Entries written by write_kythe_entry/2 can be read back.
+    Node = entry(json{signature:x, corpus:'C', root:'', path:p, language:''}, '', none,
+                 '/kythe/text', [0xe2, 0x94, 0x9c, 0'a]),
+    Edge = entry(json{signature:x, corpus:'C', root:'', path:p, language:python},
+                 '/kythe/edge/ref',
+                 json{signature:'a.├', corpus:'C', root:'', path:'', language:python},
+                 '/', []),
+    tmp_file_stream(octet, EntriesPath, OutStream),
+    call_cleanup(( kythe_entries:write_kythe_entry(OutStream, Node),
+                   kythe_entries:write_kythe_entry(OutStream, Edge) ),
+                 close(OutStream)),
+    setup_call_cleanup(open(EntriesPath, read, InStream, [type(binary)]),
+                       ( kythe_entries:read_kythe_entry(InStream, Entry1),
+                         kythe_entries:read_kythe_entry(InStream, Entry2),
+                         kythe_entries:read_kythe_entry(InStream, Entry3) ),
+                       close(InStream)),
+    delete_file(EntriesPath),
+    assertion(Entry1 == Node),
+    assertion(Entry2 == Edge),
+    assertion(Entry3 == end_of_file).
+
+test(write_kythe_fact_json) :-
+    %% The fast JSON writer should give the same result as the reference writer.
+    pykythe:clear_kythe_json_cache,
+    Source = json{corpus:'C', root:'', path:'/a/b.py', language:python, signature:'@1:2'},
+    Target = json{corpus:'C', root:'', path:'/a/b.py', language:python, signature:'a.b.x"y\\z'},
+    File = json{corpus:'C', root:'', path:'/a/b.py'},
+    maplist(json_fast_and_reference,
+            [json{source:Source, fact_name:'/kythe/node/kind', fact_value:anchor},
+             json{source:Source, fact_name:'/kythe/node/kind', fact_value:anchor}, % cached
+             json{source:File, fact_name:'/kythe/node/kind', fact_value:file},
+             json{source:File, fact_name:'/kythe/text', fact_value:'YWJj'},
+             json{source:Target, fact_name:'/pykythe/type', fact_value:'[class_type(\'├\',[])]'},
+             json{source:Source, fact_name:'/', edge_kind:'/kythe/edge/defines/binding', target:Target}]).
+
+json_fast_and_reference(Fact) :-
+    with_output_to(string(Fast), pykythe:write_kythe_fact_json(current_output, Fact)),
+    with_output_to(string(Reference), pykythe:transform_and_write_kythe_fact(current_output, Fact)),
+    atom_json_dict(Fast, FastDict, []),
+    atom_json_dict(Reference, ReferenceDict, []),
+    assertion(FastDict == ReferenceDict).
+
+test(color_table) :-
+    pykythe:color_table([color{lineno:1, column:0, start:0, end:3, token_color:'<VAR_BINDING>', value:abc},
+                         color{lineno:1, column:3, start:3, end:4, token_color:'<WHITESPACE>', value:' '},
+                         color{lineno:1, column:4, start:4, end:5, token_color:'<NEWLINE>', value:'\n'},
+                         color{lineno:2, column:0, start:5, end:8, token_color:'<VAR_REF>', value:abc}],
+                        ColorTable),
+    assertion(ColorTable == color_table(['<NEWLINE>', '<VAR_BINDING>', '<VAR_REF>', '<WHITESPACE>'],
+                                        [0, 0, 0, 0],    % start deltas
+                                        [3, 1, 1, 3],    % lengths
+                                        [0, 0, 0, 1],    % lineno deltas
+                                        [0, 3, 4, 0],    % columns
+                                        [1, 3, 0, 2])).  % color codes
+
+test(crash_color_table) :-
+    test_meta(Meta),
+    Meta.contents_bytes = "abc\n",
+    Crash = 'Crash'{repr: "R", str: "S", srcpath: Meta.path},
+    Colors = [color{lineno:1, column:0, start:0, end:3, token_color:'<VAR_REF>', value:abc}],
+    pykythe:file_color_text(Crash, Meta, Colors, ColorTexts1),
+    assertion(ColorTexts1 == Colors),
+    pykythe:file_color_text(Crash, Meta, [], ColorTexts2),
+    assertion(ColorTexts2 = [color{lineno:1, column:0, start:0, end:4, token_color:_, value:_}]),
+    %% Only kyfile//1 outputs a color table, not the crash's message:
+    pykythe:eval_single_type_error_msg('Crash', [], 'Crash: ~w', ["S"], KytheFacts, [], Meta),
+    assertion(\+ ( member(Fact, KytheFacts),
+                   is_dict(Fact),
+                   get_dict(fact_name, Fact, '/pykythe/color_table') )).
+
+test(symtab_prefix_pairs) :-
+    numlist(1, 50, Ns),
+    findall(K-N, (member(N, Ns), format(atom(K), 'b.m~d', [N])), Pairs0),
+    append(Pairs0, ['a.m.x'-1, 'a.m'-2, 'a.m.y'-3, 'a.mm'-4, 'a.m-'-5, 'c'-6], Pairs1),
+    pykythe_symtab:list_to_symtab(Pairs1, Symtab),
+    pykythe_symtab:symtab_pairs(Symtab, AllPairs),
+    forall(member(Prefix, ['a.m.', 'a.m', 'b.m1', 'b.', 'c', 'd', '']),
+           (   pykythe_symtab:symtab_prefix_pairs(Prefix, Symtab, PrefixPairs),
+               include([K-_]>>pykythe_utils:has_prefix(K, Prefix), AllPairs, Expected),
+               assertion(PrefixPairs == Expected)
+           )),
+    pykythe_symtab:symtab_prefix_pairs('a.m.', Symtab, AmPairs),
+    assertion(AmPairs == ['a.m.x'-1, 'a.m.y'-3]),
+    pykythe_symtab:symtab_scope_pairs('a.m', Symtab, ScopePairs),
+    assertion(ScopePairs == ['a.m'-2, 'a.m.x'-1, 'a.m.y'-3]).
+
+test(module_index) :-
+    tmp_file(module_index, TmpDir),
+    directory_file_path(TmpDir, pkg, PkgDir),
+    make_directory_path(PkgDir),
+    directory_file_path(PkgDir, '__init__.py', InitPath),
+    directory_file_path(TmpDir, 'mod.pyi', ModPath),
+    forall(member(Path, [InitPath, ModPath]),
+           setup_call_cleanup(open(Path, write, S), true, close(S))),
+    assertion(module_index:module_index_file(InitPath)),
+    assertion(module_index:module_index_file(ModPath)),
+    directory_file_path(TmpDir, 'mod.py', ModPyPath),
+    assertion(\+ module_index:module_index_file(ModPyPath)),
+    assertion(module_index:module_index_dir(PkgDir)),
+    assertion(\+ module_index:module_index_dir(ModPyPath)),
+    assertion(module_path:is_canonical_path(InitPath)),
+    assertion(\+ module_path:is_canonical_path('/a/../b')),
+    assertion(\+ module_path:is_canonical_path('a/b')),
+    atom_concat(TmpDir, '.index', IndexPath),
+    module_index:module_index_save(IndexPath),
+    retractall(module_index:indexed_dir(_, _, _)),
+    retractall(module_index:indexed_entry(_)),
+    module_index:module_index_load(IndexPath),
+    assertion(module_index:indexed_dir(PkgDir, _, ['__init__.py'])),
+    assertion(module_index:module_index_file(InitPath)),
+    %% Another process's save keeps the directories that were saved
+    %% after it started:
+    tmp_file(module_index_other, OtherDir),
+    make_directory_path(OtherDir),
+    retractall(module_index:indexed_dir(_, _, _)),
+    retractall(module_index:indexed_entry(_)),
+    assertion(module_index:module_index_dir(OtherDir)),
+    module_index:module_index_save(IndexPath),
+    retractall(module_index:indexed_dir(_, _, _)),
+    retractall(module_index:indexed_entry(_)),
+    module_index:module_index_load(IndexPath),
+    assertion(module_index:indexed_dir(OtherDir, _, [])),
+    assertion(module_index:indexed_dir(PkgDir, _, ['__init__.py'])),
+    delete_file(IndexPath),
+    atom_concat(IndexPath, '.lock', LockPath),
+    delete_file(LockPath),
+    delete_directory_and_contents(OtherDir),
+    delete_directory_and_contents(TmpDir).
+
+test(import_graph) :-
+    import_graph:import_graph_set_imports('/g/a.py', ['/g/c.py', '/g/b.py', '/g/c.py']),
+    import_graph:import_graph_set_imports('/g/b.py', ['/g/c.py']),
+    import_graph:import_graph_set_imports('/g/c.py', []),
+    import_graph:import_graph_set_imports('/g/d.py', ['/g/e.py']),
+    import_graph:import_graph_affected(['/g/c.py', '/g/x.py'], Affected, Unknown, Skipped),
+    assertion(Affected == ['/g/c.py', '/g/b.py', '/g/a.py']),
+    assertion(Unknown == ['/g/x.py']),
+    assertion(Skipped == ['/g/d.py']),
+    tmp_file(import_graph, GraphPath),
+    import_graph:import_graph_save(GraphPath),
+    clear_import_graph,
+    import_graph:import_graph_load(GraphPath),
+    import_graph:import_graph_affected(['/g/e.py'], AffectedE, UnknownE, SkippedE),
+    assertion(AffectedE == ['/g/e.py', '/g/d.py']),
+    assertion(UnknownE == []),
+    assertion(SkippedE == ['/g/a.py', '/g/b.py', '/g/c.py']),
+    import_graph:import_graph_remove('/g/a.py'),
+    import_graph:import_graph_affected(['/g/b.py'], AffectedB, _, _),
+    assertion(AffectedB == ['/g/b.py']),
+    delete_file(GraphPath),
+    atom_concat(GraphPath, '.lock', LockPath),
+    delete_file(LockPath),
+    clear_import_graph.
+
+test(import_graph_merge) :-
+    %% Two processes (simulated by clear_import_graph) that both load
+    %% the graph before either saves it:
+    tmp_file(import_graph, GraphPath),
+    import_graph:import_graph_set_imports('/g/a.py', ['/g/b.py']),
+    import_graph:import_graph_set_imports('/g/c.py', []),
+    import_graph:import_graph_save(GraphPath),
+    clear_import_graph,
+    import_graph:import_graph_set_imports('/g/d.py', ['/g/b.py']),
+    import_graph:import_graph_remove('/g/c.py'),
+    import_graph:import_graph_save(GraphPath),
+    clear_import_graph,
+    import_graph:import_graph_load(GraphPath),
+    import_graph:import_graph_affected(['/g/b.py', '/g/c.py'], Affected, Unknown, Skipped),
+    assertion(Affected == ['/g/b.py', '/g/a.py', '/g/d.py']),
+    assertion(Unknown == ['/g/c.py']),
+    assertion(Skipped == []),
+    %% A later process's imports for a module replace the file's:
+    clear_import_graph,
+    import_graph:import_graph_set_imports('/g/a.py', []),
+    import_graph:import_graph_save(GraphPath),
+    clear_import_graph,
+    import_graph:import_graph_load(GraphPath),
+    import_graph:import_graph_affected(['/g/b.py'], AffectedB, _, _),
+    assertion(AffectedB == ['/g/b.py', '/g/d.py']),
+    delete_file(GraphPath),
+    atom_concat(GraphPath, '.lock', LockPath),
+    delete_file(LockPath),
+    clear_import_graph.
+
+clear_import_graph :-
+    retractall(import_graph:graph_module(_)),
+    retractall(import_graph:graph_import(_, _)),
+    retractall(import_graph:graph_changed(_)).
+
+test(file_budget) :-
+    file_budget:with_file_budget(0, X1 = a, Result1),
+    assertion(Result1-X1 == ok-a),
+    file_budget:with_file_budget(5.0, X2 = b, Result2),
+    assertion(Result2-X2 == ok-b),
+    file_budget:with_file_budget(0.1, sleep(5), Result3),
+    assertion(Result3 == overrun(time)),
+    % An inner budget doesn't catch an outer one's time limit:
+    file_budget:with_file_budget(0.1, file_budget:with_file_budget(10.0, sleep(5), _), Result4),
+    assertion(Result4 == overrun(time)),
+    catch(file_budget:with_file_budget(1.0, throw(other_error), _), Error, true),
+    assertion(Error == other_error),
+    tmp_file(skip_list, SkipListPath),
+    file_budget:skip_list_add(SkipListPath, '/s/a.py', json{path: '/s/a.py', sha1: abc, reason: time}),
+    file_budget:skip_list_load(SkipListPath),
+    assertion(file_budget:skip_listed('/s/a.py', abc)),
+    assertion(\+ file_budget:skip_listed('/s/a.py', def)),
+    delete_file(SkipListPath),
+    file_budget:skip_list_load(SkipListPath),
+    assertion(\+ file_budget:skip_listed(_, _)).
+
 test(kyImportDottedAsNamesFqn_top) :-
     %% This test is not exhaustive -- it's mainly for developing the code.
     %% Additional tests are done using the Kythe verifier.
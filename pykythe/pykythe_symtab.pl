@@ -16,10 +16,13 @@
                            maybe_read_symtab_from_cache/7,
                            read_symtab_from_cache_no_check/2,
                            symtab_empty/1,
+                           symtab_format_version/1,
                            symtab_insert/4,
                            symtab_lookup/3,
                            symtab_pairs/2,
+                           symtab_prefix_pairs/3,
                            symtab_scope_pairs/3,
+                           symtab_size/2,
                            symtab_values/2,
                            write_symtab/4
                           ]).
@@ -38,10 +41,18 @@
 
 :- use_module(library(apply), [convlist/3]).
 :- use_module(library(pairs), [pairs_values/2]).
-:- use_module(library(rbtrees), [is_rbtree/1, list_to_rbtree/2, ord_list_to_rbtree/2, rb_insert/4, rb_lookup/3, rb_visit/2]).
+:- use_module(library(rbtrees), [is_rbtree/1, list_to_rbtree/2, ord_list_to_rbtree/2, rb_insert/4, rb_lookup/3, rb_size/2, rb_visit/2]).
 :- use_module(must_once).
 :- use_module(pykythe_utils).
 
+%! symtab_format_version(-Version:integer) is det.
+% Version of the format of the cached symtab (write_symtab/4) and of
+% the types in it. Bump this when a change to either would make an
+% existing .pykythe.symtab (or builtins symtab) file invalid; it's part
+% of the cache version (see scripts/cache_versions.py and
+% validate_cache_version/1 in pykythe.pl).
+symtab_format_version(1).
+
 symtab_empty(Symtab) :-
     rb_empty(Symtab).
 
@@ -66,6 +77,10 @@ symtab_lookup(Key, Symtab, Value) :-
 symtab_pairs(Symtab, Pairs) :-
     rb_visit(Symtab, Pairs).
 
+%! symtab_size(+Symtab, -Size:integer) is det.
+symtab_size(Symtab, Size) :-
+    rb_size(Symtab, Size).
+
 %! symtab_values(+Symtab, -Values) is det.
 %  True when Values is an ordered set of the values appearing in Symtab.
 symtab_values(Symtab, Values) :-
@@ -158,17 +173,42 @@ write_symtab(Symtab, Version, Sha1, PykytheBatchOutStream) :-
 % Need to add a portray -- see pykythe:pykythe_portray(Symtab)
 
 %! symtab_scope_pairs(+FqnScope:atom, +Symtab, -SymtabPairsScope) is det.
-% For debugging: extract only entries that start with FqnScope + '.'
+% For debugging: extract only entries that are FqnScope or start with
+% FqnScope + '.'
 % This isn't very useful because all the builgins are added to the
 % local scope, so it matches a lot of entries.
 symtab_scope_pairs(FqnScope, Symtab, SymtabPairsScope) :-
-    symtab_pairs(Symtab, SymtabPairs),
-    include(symtab_entry_starts_with(FqnScope), SymtabPairs, SymtabPairsScope).
+    atom_concat(FqnScope, '.', FqnScopeDot),
+    symtab_prefix_pairs(FqnScopeDot, Symtab, SymtabPairsDot),
+    (   rb_lookup(FqnScope, Type, Symtab)
+    ->  SymtabPairsScope = [FqnScope-Type|SymtabPairsDot]
+    ;   SymtabPairsScope = SymtabPairsDot
+    ).
 
-symtab_entry_starts_with(FqnScope, Key-_Type) :-
-    (  FqnScope = Key
-    ;  atom_concat(FqnScope, '.', FqnScopeDot),
-       atom_concat(FqnScopeDot, _, Key)
+%! symtab_prefix_pairs(+Prefix:atom, +Symtab, -Pairs:list(pair)) is det.
+% Pairs is the ordered list of entries whose key starts with Prefix.
+% The keys with a given prefix are a contiguous range in the standard
+% order of atoms, so this only visits the part of the tree that's in
+% the range (plus the path to it), instead of all the entries (which
+% include all the builtins and everything that's been imported).
+symtab_prefix_pairs(Prefix, t(_,T), Pairs) :-
+    rb_prefix_pairs_(T, Prefix, Pairs, []).
+
+rb_prefix_pairs_(black('',_,_,_), _Prefix, Pairs, Pairs) :- !.
+rb_prefix_pairs_(red(L,K,V,R), Prefix, Pairs0, Pairs) :-
+    rb_prefix_pairs_node_(L, K, V, R, Prefix, Pairs0, Pairs).
+rb_prefix_pairs_(black(L,K,V,R), Prefix, Pairs0, Pairs) :-
+    rb_prefix_pairs_node_(L, K, V, R, Prefix, Pairs0, Pairs).
+
+rb_prefix_pairs_node_(L, K, V, R, Prefix, Pairs0, Pairs) :-
+    (   K @< Prefix
+    ->  % Everything in L is also before the range.
+        rb_prefix_pairs_(R, Prefix, Pairs0, Pairs)
+    ;   has_prefix(K, Prefix)
+    ->  rb_prefix_pairs_(L, Prefix, Pairs0, [K-V|Pairs1]),
+        rb_prefix_pairs_(R, Prefix, Pairs1, Pairs)
+    ;   % K is after the range, and so is everything in R.
+        rb_prefix_pairs_(L, Prefix, Pairs0, Pairs)
     ).
 
 end_of_file.
@@ -39,8 +39,10 @@
                           term_to_canonical_atom/2,
                           % update_dict/3,
                           validate_prolog_version/0,
+                          with_file_lock/2,
                           write_atomic_file/2,
-                          write_atomic_stream/2
+                          write_atomic_stream/2,
+                          write_atomic_streams/2
                          ]).
 :- encoding(utf8).
 % :- set_prolog_flag(autoload, false).  % TODO: seems to break plunit, qsave
@@ -49,7 +51,9 @@
        do_if(0, 0),
        log_if(0, +),
        log_if(0, +, +),
+       with_file_lock(+, 0),
        write_atomic_stream(1, +),
+       write_atomic_streams(1, +),
        write_atomic_file(1, +).
 
 :- style_check(+singleton).
@@ -58,7 +62,7 @@
 :- style_check(+discontiguous).
 
 :- use_module(library(rdet), [rdet/1]).
-:- use_module(library(apply), [maplist/2, maplist/3]).
+:- use_module(library(apply), [maplist/2, maplist/3, maplist/4]).
 :- use_module(library(error)).
 :- use_module(library(base64), [base64/2 as base64_ascii]).
 :- use_module(library(utf8), [utf8_codes//1]).
@@ -390,6 +394,42 @@ write_atomic_stream(WritePred, Path) :-
         fail
     ).
 
+%! with_file_lock(+Path:atom, :Goal) is semidet.
+% Call Goal (once) while holding an exclusive lock on Path + '.lock'
+% (which is created if needed), so that processes that read, update
+% and rewrite Path (e.g., pykythe processes run by "parallel") take
+% turns. The lock is advisory (see open/4's lock option) and is
+% released when the lock file is closed, even if the process dies.
+with_file_lock(Path, Goal) :-
+    atom_concat(Path, '.lock', LockPath),
+    setup_call_cleanup(
+        open(LockPath, append, LockStream, [lock(write)]),
+        once(Goal),
+        close(LockStream)).
+
+%! write_atomic_streams(:WritePred, +Paths:list(atom)) is semidet.
+% Similar to write_atomic_stream, except for multiple files: WritePred
+% is called with a list of streams (one for each of Paths) and the
+% files are created only if WritePred succeeds.
+% WritePred must take the list of streams as its last argument.
+write_atomic_streams(WritePred, Paths) :-
+    maplist(atomic_tmp_file_stream, Paths, TmpPaths, Streams),
+    (   call(WritePred, Streams)
+    ->  maplist(rename_file, TmpPaths, Paths),
+        maplist(close, Streams)
+    ;   maplist(close, Streams),
+        maplist(pykythe_utils:safe_delete_file, TmpPaths),
+        fail
+    ).
+
+%! atomic_tmp_file_stream(+Path:atom, -TmpPath:atom, -Stream) is det.
+% Helper for write_atomic_streams/2: create a temporary file in the
+% same directory as Path.
+atomic_tmp_file_stream(Path, TmpPath, Stream) :-
+    directory_file_path(PathDir, _, Path),
+    pykythe_tmp_file_stream(PathDir, TmpPath, Stream, [encoding(utf8)]), % implies open [type(binary)]
+    at_halt(pykythe_utils:safe_delete_file(TmpPath)). % in case WritePred crashes or fails
+
 %! write_atomic_file(+WritePred, +Path) is semidet.
 % Similar to write_atomic_stream, except it passes a path to Pred
 % instead of a stream.
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3.7
+"""Compute the cache version from the per-layer versions, or report on them.
+
+Cache entries (.pykythe.symtab, batch files and the builtins symtab)
+are validated with pykythe's --version. Instead of a hash of all the
+sources (which any edit, even to a comment, changes), the version is
+made from three deliberately bumped layer versions:
+
+    parser   PARSER_OUTPUT_VERSION in pykythe/__main__.py
+             (the parser's output: cooked AST with FQNs, colors)
+    symtab   symtab_format_version/1 in pykythe/pykythe_symtab.pl
+             (the cached symtab's format and types)
+    kythe    kythe_facts_version/1 in pykythe/pykythe.pl
+             (the Kythe facts and types derived from the parser output)
+
+giving a version such as "parser1-symtab1-kythe1" (pykythe.pl and
+pykythe/__main__.py check that --version agrees with their layers).
+
+With --report, the layer versions are compared with those at a git
+revision (--since), together with the files that changed in each
+layer, e.g. to check that a change bumped the layers that it needed to
+(a layer whose files changed but whose version didn't is flagged for
+review -- the change might only be to comments or logging).
+
+Usage:
+    scripts/cache_versions.py                 # print the cache version
+    scripts/cache_versions.py --report [--since=origin/master]
+"""
+
+import argparse
+import dataclasses
+from dataclasses import dataclass
+import fnmatch
+import os
+import re
+import subprocess
+import sys
+from typing import Callable, List, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass(frozen=True)
+class Layer:
+    """A cache layer: where its version is declared and which files it covers."""
+
+    name: str
+    version_path: str
+    version_re: str
+    file_patterns: List[str]
+    exclude_patterns: List[str] = dataclasses.field(default_factory=list)
+    invalidates: str = ''
+
+    def covers(self, path: str) -> bool:
+        return (any(fnmatch.fnmatch(path, pattern) for pattern in self.file_patterns) and
+                not any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude_patterns))
+
+
+LAYERS = [
+        Layer(name='parser',
+              version_path='pykythe/__main__.py',
+              version_re=r'^PARSER_OUTPUT_VERSION = (\d+)$',
+              file_patterns=['pykythe/*.py'],
+              invalidates='all cache entries, outputs and the builtins symtab'),
+        Layer(name='symtab',
+              version_path='pykythe/pykythe_symtab.pl',
+              version_re=r'^symtab_format_version\((\d+)\)\.$',
+              file_patterns=['pykythe/pykythe_symtab.pl', 'pykythe/gen_builtins_symtab.pl'],
+              invalidates='.pykythe.symtab and batch cache entries and the builtins symtab'),
+        Layer(name='kythe',
+              version_path='pykythe/pykythe.pl',
+              version_re=r'^kythe_facts_version\((\d+)\)\.$',
+              file_patterns=['pykythe/*.pl'],
+              exclude_patterns=['pykythe/pykythe_symtab.pl', 'pykythe/gen_builtins_symtab.pl'],
+              invalidates='all cache entries and outputs (.kythe.json, .kythe.entries)'),
+]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Cache version from the per-layer versions')
+    parser.add_argument('--report',
+                        action='store_true',
+                        help='Report which layers changed since --since')
+    parser.add_argument('--since', default='HEAD', help='git revision for --report')
+    args = parser.parse_args()
+    versions = [_layer_version(layer, _read_file) for layer in LAYERS]
+    if not args.report:
+        print(_cache_version(versions))
+        return 0
+    old_versions = [
+            _layer_version(layer, lambda path: _git_show(args.since, path)) for layer in LAYERS
+    ]
+    changed_files = _git_changed_files(args.since)
+    print(f'Cache version: {_cache_version(old_versions)} ({args.since}) -> '
+          f'{_cache_version(versions)} (working tree)')
+    status = 0
+    for layer, old_version, version in zip(LAYERS, old_versions, versions):
+        layer_files = [path for path in changed_files if layer.covers(path)]
+        if old_version != version:
+            print(f'  {layer.name}: {_version_str(old_version)} -> {_version_str(version)}: '
+                  f'invalidates {layer.invalidates}')
+        elif layer_files:
+            print(f'  {layer.name}: {version} (not bumped) -- REVIEW: changed files: '
+                  f'{" ".join(layer_files)}')
+            status = 1
+        else:
+            print(f'  {layer.name}: {version} (unchanged)')
+    return status
+
+
+def _cache_version(versions: List[Optional[int]]) -> str:
+    return '-'.join(
+            f'{layer.name}{_version_str(version)}' for layer, version in zip(LAYERS, versions))
+
+
+def _version_str(version: Optional[int]) -> str:
+    return '?' if version is None else str(version)
+
+
+def _layer_version(layer: Layer, read_file: Callable[[str], Optional[str]]) -> Optional[int]:
+    """The declared version, or None if it doesn't exist (e.g., an old revision)."""
+    contents = read_file(layer.version_path)
+    match = re.search(layer.version_re, contents or '', re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+
+def _read_file(path: str) -> Optional[str]:
+    with open(os.path.join(ROOT_DIR, path), encoding='utf-8') as src_file:
+        return src_file.read()
+
+
+def _git_show(revision: str, path: str) -> Optional[str]:
+    result = subprocess.run(['git', 'show', f'{revision}:{path}'],
+                            cwd=ROOT_DIR,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True,
+                            check=False)
+    return result.stdout if result.returncode == 0 else None
+
+
+def _git_changed_files(revision: str) -> List[str]:
+    """Files changed in the working tree (including uncommitted changes) since revision."""
+    result = subprocess.run(['git', 'diff', '--name-only', revision, '--'],
+                            cwd=ROOT_DIR,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True,
+                            check=True)
+    return sorted(result.stdout.split())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
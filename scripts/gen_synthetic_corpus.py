@@ -0,0 +1,177 @@
+#!/usr/bin/env python3.7
+"""Generate a synthetic Python package, for scaling tests.
+
+The package (default name "synth") has modules mod0 ... modN-1 and its
+shape is controlled by:
+
+    --files          number of modules
+    --lines          approximate number of lines per module
+    --depth          depth of the class hierarchy in each module (the
+                     root class inherits from the deepest class in an
+                     imported module, if there is one)
+    --attr_density   attribute accesses per statement in functions
+    --fanout         number of modules imported by each module
+    --cycles         number of import cycles (each of 2 or 3 modules)
+
+The output is reproducible for a given --seed. It is meant for static
+analysis: modules in import cycles can't necessarily be imported. See
+scripts/scaling_test.py for running pykythe over a range of these
+parameters.
+
+Usage:
+    scripts/gen_synthetic_corpus.py --outdir=/tmp/synth --files=100 --fanout=5
+"""
+
+import argparse
+import dataclasses
+from dataclasses import dataclass
+import os
+import random
+import sys
+from typing import Dict, List, Set
+
+
+@dataclass(frozen=True)
+class CorpusParams:
+    """Parameters for generate()."""
+
+    files: int = 10
+    lines: int = 200
+    depth: int = 3
+    attr_density: int = 2
+    fanout: int = 3
+    cycles: int = 0
+    seed: int = 0
+    package: str = 'synth'
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Generate a synthetic Python package')
+    parser.add_argument('--outdir',
+                        required=True,
+                        help='Directory in which to create the package directory')
+    for field in dataclasses.fields(CorpusParams):
+        parser.add_argument('--' + field.name, type=field.type, default=field.default)
+    args = parser.parse_args()
+    params = CorpusParams(
+            **{field.name: getattr(args, field.name)
+               for field in dataclasses.fields(CorpusParams)})
+    paths = generate(args.outdir, params)
+    print(f'Generated {len(paths)} files in {os.path.join(args.outdir, params.package)}')
+    return 0
+
+
+def generate(outdir: str, params: CorpusParams) -> List[str]:
+    """Write the package into outdir and return the paths of its files."""
+    rng = random.Random(params.seed)
+    imports = _import_graph(rng, params)
+    package_dir = os.path.join(outdir, params.package)
+    os.makedirs(package_dir, exist_ok=True)
+    paths = [os.path.join(package_dir, '__init__.py')]
+    with open(paths[0], 'w') as init_file:
+        init_file.write(
+                '"""Synthetic package (generated by scripts/gen_synthetic_corpus.py)."""\n')
+    for i in range(params.files):
+        path = os.path.join(package_dir, f'mod{i}.py')
+        with open(path, 'w') as mod_file:
+            mod_file.write(_module_src(rng, params, i, sorted(imports[i])))
+        paths.append(path)
+    return paths
+
+
+def _import_graph(rng: random.Random, params: CorpusParams) -> Dict[int, Set[int]]:
+    """Module number -> module numbers that it imports.
+
+    The "fan-out" imports are only of lower-numbered modules, so they
+    don't create cycles; the cycles are added separately.
+    """
+    imports: Dict[int, Set[int]] = {i: set() for i in range(params.files)}
+    for i in range(1, params.files):
+        imports[i].update(rng.sample(range(i), min(i, params.fanout)))
+    for _ in range(params.cycles):
+        if params.files < 2:
+            break
+        cycle = rng.sample(range(params.files), min(params.files, rng.choice([2, 3])))
+        for from_mod, to_mod in zip(cycle, cycle[1:] + cycle[:1]):
+            imports[from_mod].add(to_mod)
+    return imports
+
+
+def _module_src(rng: random.Random, params: CorpusParams, mod_num: int,
+                imported: List[int]) -> str:
+    lines = [
+            f'"""Synthetic module {mod_num} (generated by scripts/gen_synthetic_corpus.py)."""',
+            '',
+    ]
+    lines.extend(f'import {params.package}.mod{imp}' for imp in imported)
+    lines.append('')
+    classes = _class_hierarchy(params, mod_num, imported, lines)
+    # Classes that are visible in this module, as expressions.
+    visible = classes + [f'{params.package}.mod{imp}.{_class_name(imp, params.depth - 1)}'
+                         for imp in imported if params.depth > 0]
+    func_num = 0
+    while len(lines) < params.lines:
+        lines.extend(_function_src(rng, params, mod_num, func_num, visible))
+        func_num += 1
+    return '\n'.join(lines) + '\n'
+
+
+def _class_name(mod_num: int, level: int) -> str:
+    return f'C{mod_num}_{level}'
+
+
+def _class_hierarchy(params: CorpusParams, mod_num: int, imported: List[int],
+                     lines: List[str]) -> List[str]:
+    """Append a chain of params.depth classes to lines and return their names."""
+    # Only inherit from lower-numbered modules, so that import cycles
+    # don't result in inheritance cycles.
+    lower = [imp for imp in imported if imp < mod_num]
+    classes = []
+    for level in range(params.depth):
+        if level > 0:
+            base = _class_name(mod_num, level - 1)
+        elif lower:
+            base = f'{params.package}.mod{lower[-1]}.{_class_name(lower[-1], params.depth - 1)}'
+        else:
+            base = 'object'
+        name = _class_name(mod_num, level)
+        lines.extend([
+                '',
+                f'class {name}({base}):',
+                '',
+                '    def __init__(self) -> None:',
+                f'        self.attr{level} = {level}',
+                f'        self.name{level} = "{name}"',
+                '',
+                f'    def method{level}(self, x: int) -> int:',
+                f'        return self.attr{level} + x',
+                '',
+        ])
+        classes.append(name)
+    return classes
+
+
+def _function_src(rng: random.Random, params: CorpusParams, mod_num: int, func_num: int,
+                  visible: List[str]) -> List[str]:
+    lines = ['', f'def func{mod_num}_{func_num}(n: int) -> int:']
+    if not visible:
+        return lines + ['    return n + 1', '']
+    lines.append(f'    obj = {rng.choice(visible)}()')
+    lines.append('    total = n')
+    for _ in range(5):
+        level = rng.randrange(params.depth) if params.depth else 0
+        accesses = [f'obj.attr{level}'] + [
+                f'obj.attr{rng.randrange(params.depth or 1)}'
+                for _ in range(max(0, params.attr_density - 1))
+        ]
+        if params.attr_density:
+            lines.append(f'    total += {" + ".join(accesses)}')
+        else:
+            lines.append('    total += 1')
+    lines.append(f'    return total + obj.method{rng.randrange(params.depth or 1)}(n)')
+    lines.append('')
+    return lines
+
+
+if __name__ == '__main__':
+    sys.exit(main())
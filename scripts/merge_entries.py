@@ -0,0 +1,262 @@
+#!/usr/bin/env python3.7
+"""Merge per-file .kythe.entries into one sorted, deduplicated stream.
+
+Each source file's .kythe.entries has many of the same facts as other
+files' (e.g., /kythe/node/kind for shared FQNs, package nodes for
+imported modules, /pykythe/type for imported symbols), so feeding all
+of them to write_entries/write_tables does a lot of redundant work.
+This tool combines them, removing duplicates.
+
+The input and output are in the "delimited" format written by
+pykythe (see pykythe/kythe_entries.pl): each kythe.proto.storage.Entry
+is preceded by its length as a varint. Entries are ordered by source
+vname, edge kind, fact name, target vname and fact value (vnames are
+compared by signature, corpus, root, path, language).
+
+Memory use is bounded by an external sort: entries are read into
+buffers (one per shard) of at most --max_memory bytes in total; a full
+buffer is sorted, deduplicated and written to a temporary "run" file,
+and each shard's runs are then k-way merged (and deduplicated again).
+With --shards=N, entries are partitioned by a hash of their source
+vname and shard I is written to OUTPUT-0000I-of-0000N; the shards are
+merged in parallel (--jobs). All the entries for a particular source
+vname are in the same shard.
+
+Usage:
+    scripts/merge_entries.py --output=/tmp/merged.kythe.entries \\
+        [--shards=N] [--jobs=J] [--from_dir=DIR]... [FILE.kythe.entries...]
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import os
+import sys
+import tempfile
+import zlib
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+# A vname is (signature, corpus, root, path, language), as bytes (the
+# UTF-8 encoding compares the same way as the strings).
+VName = Tuple[bytes, bytes, bytes, bytes, bytes]
+EMPTY_VNAME: VName = (b'', b'', b'', b'', b'')
+# (source, edge_kind, fact_name, target, fact_value)
+EntryKey = Tuple[VName, bytes, bytes, VName, bytes]
+# An entry's sort key and its encoding (without the length prefix).
+KeyedEntry = Tuple[EntryKey, bytes]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Merge and deduplicate .kythe.entries files')
+    parser.add_argument('--output', required=True, help='Output file (or prefix, for --shards)')
+    parser.add_argument('--from_dir',
+                        action='append',
+                        default=[],
+                        help='Also read all *.kythe.entries files under this directory')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='Number of output files (partitioned by source vname)')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Number of shards to merge in parallel')
+    parser.add_argument('--max_memory',
+                        type=int,
+                        default=256 * 1024 * 1024,
+                        help='Approximate maximum bytes of entries to hold in memory')
+    parser.add_argument('--tmpdir', default=None, help='Directory for temporary run files')
+    parser.add_argument('inputs', nargs='*', help='.kythe.entries files')
+    args = parser.parse_args()
+
+    inputs = list(args.inputs)
+    for from_dir in args.from_dir:
+        inputs.extend(_find_entries_files(from_dir))
+    if not inputs:
+        parser.error('No input files')
+    with tempfile.TemporaryDirectory(dir=args.tmpdir, prefix='merge_entries.') as tmpdir:
+        input_count, shard_runs = _partition_into_runs(inputs, args.shards, args.max_memory,
+                                                       tmpdir)
+        merge_args = [(runs, _shard_path(args.output, shard, args.shards))
+                      for shard, runs in enumerate(shard_runs)]
+        if args.jobs > 1 and args.shards > 1:
+            with multiprocessing.Pool(min(args.jobs, args.shards)) as pool:
+                output_counts = pool.starmap(_merge_runs, merge_args)
+        else:
+            output_counts = [_merge_runs(*merge_arg) for merge_arg in merge_args]
+    output_count = sum(output_counts)
+    dup_ratio = 1.0 - output_count / input_count if input_count else 0.0
+    print(f'{len(inputs)} files: {input_count} entries in, {output_count} out '
+          f'({100.0 * dup_ratio:.1f}% duplicates removed)', file=sys.stderr)
+    if args.shards > 1:
+        print('entries per shard: ' + ' '.join(str(count) for count in output_counts),
+              file=sys.stderr)
+    return 0
+
+
+def _find_entries_files(top_dir: str) -> List[str]:
+    paths = []
+    for dirpath, _, filenames in os.walk(top_dir):
+        paths.extend(
+                os.path.join(dirpath, filename) for filename in filenames
+                if filename.endswith('.kythe.entries'))
+    return sorted(paths)
+
+
+def _shard_path(output: str, shard: int, shards: int) -> str:
+    return output if shards == 1 else f'{output}-{shard:05d}-of-{shards:05d}'
+
+
+def _partition_into_runs(inputs: Iterable[str], shards: int, max_memory: int,
+                         tmpdir: str) -> Tuple[int, List[List[str]]]:
+    """Read the inputs, writing sorted runs for each shard.
+
+    Returns the number of entries read and, for each shard, its run files.
+    """
+    buffers: List[List[KeyedEntry]] = [[] for _ in range(shards)]
+    buffer_sizes = [0] * shards
+    shard_runs: List[List[str]] = [[] for _ in range(shards)]
+    input_count = 0
+    for path in inputs:
+        with open(path, 'rb') as input_file:
+            for entry in _read_delimited(input_file):
+                input_count += 1
+                source_bytes = _source_bytes(entry)
+                shard = zlib.crc32(source_bytes) % shards if shards > 1 else 0
+                buffers[shard].append((_entry_key(entry), entry))
+                buffer_sizes[shard] += len(entry) + 200  # +200 for key and tuple overhead
+                if buffer_sizes[shard] * shards >= max_memory:
+                    shard_runs[shard].append(_write_run(buffers[shard], tmpdir))
+                    buffers[shard] = []
+                    buffer_sizes[shard] = 0
+    for shard, buffer in enumerate(buffers):
+        if buffer or not shard_runs[shard]:
+            shard_runs[shard].append(_write_run(buffer, tmpdir))
+    return input_count, shard_runs
+
+
+def _write_run(buffer: List[KeyedEntry], tmpdir: str) -> str:
+    buffer.sort()
+    fd, path = tempfile.mkstemp(dir=tmpdir, suffix='.run')
+    with os.fdopen(fd, 'wb') as run_file:
+        _write_delimited(run_file, _dedup(buffer))
+    return path
+
+
+def _merge_runs(runs: List[str], output: str) -> int:
+    """k-way merge the (sorted) runs into output, returning the number of entries."""
+    run_files = [open(run, 'rb') for run in runs]
+    try:
+        merged = heapq.merge(*[((_entry_key(entry), entry) for entry in _read_delimited(run_file))
+                               for run_file in run_files])
+        with open(output, 'wb') as output_file:
+            return _write_delimited(output_file, _dedup(merged))
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def _dedup(keyed_entries: Iterable[KeyedEntry]) -> Iterator[bytes]:
+    prev: Optional[bytes] = None
+    for _, entry in keyed_entries:
+        if entry != prev:
+            yield entry
+            prev = entry
+
+
+def _read_delimited(input_file: BinaryIO) -> Iterator[bytes]:
+    """Read entries one at a time (the file could be larger than memory)."""
+    while True:
+        length = 0
+        shift = 0
+        while True:
+            byte = input_file.read(1)
+            if not byte:
+                if shift:
+                    raise ValueError(f'Truncated entry length in {input_file.name}')
+                return
+            length |= (byte[0] & 0x7f) << shift
+            if byte[0] < 0x80:
+                break
+            shift += 7
+        entry = input_file.read(length)
+        if len(entry) != length:
+            raise ValueError(f'Truncated entry in {input_file.name}')
+        yield entry
+
+
+def _write_delimited(output_file: BinaryIO, entries: Iterable[bytes]) -> int:
+    count = 0
+    for entry in entries:
+        output_file.write(_varint(len(entry)))
+        output_file.write(entry)
+        count += 1
+    return count
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _varint(value: int) -> bytes:
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _fields(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    """Field numbers and values of a message whose fields are all length-delimited."""
+    pos = 0
+    while pos < len(data):
+        tag, pos = _read_varint(data, pos)
+        if tag & 0x07 != 2:
+            raise ValueError(f'Unexpected wire type in Kythe entry: {tag}')
+        length, pos = _read_varint(data, pos)
+        yield tag >> 3, data[pos:pos + length]
+        pos += length
+
+
+def _source_bytes(entry: bytes) -> bytes:
+    for field_number, value in _fields(entry):
+        if field_number == 1:
+            return value
+    return b''
+
+
+def _vname(data: bytes) -> VName:
+    vname = [b''] * 5
+    for field_number, value in _fields(data):
+        vname[field_number - 1] = value
+    return (vname[0], vname[1], vname[2], vname[3], vname[4])
+
+
+def _entry_key(entry: bytes) -> EntryKey:
+    source = target = EMPTY_VNAME
+    edge_kind = fact_name = fact_value = b''
+    for field_number, value in _fields(entry):
+        if field_number == 1:
+            source = _vname(value)
+        elif field_number == 2:
+            edge_kind = value
+        elif field_number == 3:
+            target = _vname(value)
+        elif field_number == 4:
+            fact_name = value
+        elif field_number == 5:
+            fact_value = value
+    return source, edge_kind, fact_name, target, fact_value
+
+
+if __name__ == '__main__':
+    sys.exit(main())
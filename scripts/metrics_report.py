@@ -0,0 +1,112 @@
+#!/usr/bin/env python3.7
+"""Summarize the per-file metrics output by pykythe --metrics_out.
+
+Each line of input is a JSON record for one file (see
+write_file_metrics/5 in pykythe.pl); the report gives, for each phase,
+the total time, its share of the total, the mean and 95th percentile
+per file, and the throughput in files/s and source bytes/s.
+
+The parser phases (prefixed by "parser.") are part of "parse_cmd" and
+"imports" includes the phases of imported files that were processed
+from source, so neither is counted in the total.
+
+Usage:
+    scripts/metrics_report.py [--top=N] METRICS_FILE...
+"""
+
+import argparse
+import collections
+import json
+import sys
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Summarize pykythe --metrics_out records')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='Number of slowest files to list')
+    parser.add_argument('metrics_files', nargs='*', help='Files to read (default: stdin)')
+    args = parser.parse_args()
+    if args.metrics_files:
+        records = []
+        for path in args.metrics_files:
+            with open(path, encoding='utf-8') as metrics_file:
+                records.extend(_read_records(metrics_file))
+    else:
+        records = list(_read_records(sys.stdin))
+    if not records:
+        print('No records', file=sys.stderr)
+        return 1
+    _print_report(records, args.top)
+    return 0
+
+
+def _read_records(lines: Iterable[str]) -> Iterable[Dict]:
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _phase_times(record: Dict) -> Iterable[Tuple[str, float]]:
+    """The phases of a record, with parser phases prefixed by "parser."."""
+    for phase, seconds in record.get('parser', {}).items():
+        if phase not in ('src_bytes', 'output_bytes'):
+            yield 'parser.' + phase, seconds
+    yield from record.get('phases', {}).items()
+
+
+def _is_counted(phase: str) -> bool:
+    """Whether phase's time isn't already included in another phase."""
+    return not phase.startswith('parser.') and phase != 'imports'
+
+
+def _percentile(values: Sequence[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _print_report(records: List[Dict], top: int) -> None:
+    # Each file's "seconds" includes imported files that were processed
+    # from source, so the total time is the sum of the phases of all
+    # the files rather than the sum of "seconds".
+    by_phase: Dict[str, List[float]] = collections.defaultdict(list)
+    for record in records:
+        for phase, seconds in _phase_times(record):
+            by_phase[phase].append(seconds)
+    total_seconds = sum(sum(times) for phase, times in by_phase.items() if _is_counted(phase))
+    src_bytes = sum(record.get('parser', {}).get('src_bytes', 0) for record in records)
+    output_bytes = sum(record.get('parser', {}).get('output_bytes', 0) for record in records)
+    print(f'files: {len(records)}  source bytes: {src_bytes}  '
+          f'parser output bytes: {output_bytes}  phase seconds: {total_seconds:.3f}')
+    print()
+    print(f'{"phase":<24} {"seconds":>10} {"share":>7} {"mean":>9} {"p95":>9} '
+          f'{"files/s":>10} {"bytes/s":>12}')
+    for phase, times in sorted(by_phase.items(), key=lambda item: -sum(item[1])):
+        seconds = sum(times)
+        files_per_sec = len(times) / seconds if seconds else float('inf')
+        bytes_per_sec = src_bytes / seconds if seconds else float('inf')
+        print(f'{phase:<24} {seconds:10.3f} {100.0 * seconds / total_seconds:6.1f}% '
+              f'{seconds / len(times):9.4f} {_percentile(times, 0.95):9.4f} '
+              f'{files_per_sec:10.1f} {bytes_per_sec:12.0f}')
+    print()
+    passes = collections.Counter(len(record.get('fixpoint_passes', [])) for record in records)
+    print('fixpoint passes per file: ' +
+          ', '.join(f'{count}: {files} files' for count, files in sorted(passes.items())))
+    print('inferences: {}  gc seconds: {:.3f}  max peak stack: {}  max symtab size: {}'.format(
+            sum(record.get('inferences', 0) for record in records),
+            sum(record.get('gc_seconds', 0.0) for record in records),
+            max(record.get('peak_stack', 0) for record in records),
+            max(record.get('symtab_size', 0) for record in records)))
+    print()
+    print(f'slowest {top} files (excluding imports):')
+    for seconds, path in sorted((sum(seconds for phase, seconds in _phase_times(record)
+                                     if _is_counted(phase)), record['path'])
+                                for record in records)[-top:][::-1]:
+        print(f'  {seconds:9.3f} {path}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
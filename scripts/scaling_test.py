@@ -0,0 +1,193 @@
+#!/usr/bin/env python3.7
+"""Run pykythe over synthetic corpora, varying one parameter at a time.
+
+For each --sweep parameter and each of its values, a corpus is generated by
+scripts/gen_synthetic_corpus.py (the other parameters keep their
+default or command-line values), and the full pipeline is run on all
+its files, with a fresh --kytheout directory (so that nothing is
+cached). The wall time, CPU time and maximum resident memory of the
+pykythe process are recorded, together with the maximum number of
+fixpoint passes (from --metrics_out).
+
+The results are written as CSV and, if matplotlib is installed,
+plotted (log-log, one graph per parameter). Each result is also
+compared with the previous value of the same parameter: if the time or
+memory grew faster than (size ratio) ** --superlinear, it's flagged.
+
+Usage (see the "scaling-test" target in the Makefile):
+    scripts/scaling_test.py --outdir=/tmp/pykythe_scaling \\
+        --pykythe="build/pykythe.qlf --builtins_symtab=... ..." \\
+        --pythonpath=typeshed/stdlib/3 --sweep=files=10,100,1000 --sweep=fanout=1,5,20
+"""
+
+import argparse
+import csv
+import dataclasses
+import json
+import math
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gen_synthetic_corpus  # pylint: disable=wrong-import-position
+
+CSV_FIELDS = [
+        'param', 'value', 'files', 'src_bytes', 'wall_seconds', 'cpu_seconds', 'max_rss_kb',
+        'max_fixpoint_passes', 'exit_status'
+]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Scaling tests of pykythe on synthetic corpora')
+    parser.add_argument('--outdir', required=True, help='Directory for corpora and outputs')
+    parser.add_argument('--pykythe',
+                        required=True,
+                        help='pykythe command and options, except for --kytheout, '
+                        '--pythonpath, --metrics_out and the source files')
+    parser.add_argument('--pythonpath',
+                        default='',
+                        help='Added to --pythonpath after the corpus (e.g., for builtins)')
+    parser.add_argument('--sweep',
+                        action='append',
+                        required=True,
+                        help='PARAM=V1,V2,... (can be repeated), where PARAM is a parameter '
+                        'of gen_synthetic_corpus.py, e.g. --sweep=files=10,100,1000')
+    parser.add_argument('--superlinear',
+                        type=float,
+                        default=1.2,
+                        help='Exponent above which growth is flagged as super-linear')
+    parser.add_argument('--csv', default='', help='Output CSV file (default: OUTDIR/scaling.csv)')
+    for field in dataclasses.fields(gen_synthetic_corpus.CorpusParams):
+        parser.add_argument('--' + field.name, type=field.type, default=field.default)
+    args = parser.parse_args()
+
+    base_params = gen_synthetic_corpus.CorpusParams(
+            **{field.name: getattr(args, field.name)
+               for field in dataclasses.fields(gen_synthetic_corpus.CorpusParams)})
+    results: List[Dict] = []
+    for param, values in (_parse_sweep(sweep) for sweep in args.sweep):
+        prev: Optional[Dict] = None
+        for value in values:
+            result = _run_one(args, dataclasses.replace(base_params, **{param: value}), param,
+                              value)
+            print(', '.join(f'{field}={result[field]}' for field in CSV_FIELDS), flush=True)
+            if prev:
+                _flag_superlinear(prev, result, args.superlinear)
+            results.append(result)
+            prev = result
+    csv_path = args.csv or os.path.join(args.outdir, 'scaling.csv')
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    print(f'Wrote {csv_path}')
+    _plot(results, os.path.splitext(csv_path)[0] + '.png')
+    return 1 if any(result['exit_status'] for result in results) else 0
+
+
+def _parse_sweep(sweep: str) -> Tuple[str, List[int]]:
+    param, _, values = sweep.partition('=')
+    if param not in {
+            field.name
+            for field in dataclasses.fields(gen_synthetic_corpus.CorpusParams) if field.type is int
+    }:
+        raise ValueError(f'Unknown parameter in --sweep={sweep}')
+    return param, [int(value) for value in values.split(',')]
+
+
+def _run_one(args: argparse.Namespace, params: gen_synthetic_corpus.CorpusParams, param: str,
+             value: int) -> Dict:
+    run_dir = os.path.join(args.outdir, f'{param}-{value}')
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    corpus_dir = os.path.join(run_dir, 'src')
+    paths = gen_synthetic_corpus.generate(corpus_dir, params)
+    metrics_path = os.path.join(run_dir, 'metrics.jsonl')
+    pythonpath = ':'.join(path for path in [corpus_dir, args.pythonpath] if path)
+    cmd = shlex.split(args.pykythe) + [
+            '--kytheout=' + os.path.join(run_dir, 'kythe'),
+            '--pythonpath=' + pythonpath,
+            '--metrics_out=' + metrics_path,
+    ] + paths
+    with open(os.path.join(run_dir, 'pykythe.log'), 'w') as log_file:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+        # os.wait4 gives the resource usage of just this process (unlike
+        # resource.getrusage(RUSAGE_CHILDREN), which accumulates).
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_seconds = time.perf_counter() - start
+        exit_status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return {
+            'param': param,
+            'value': value,
+            'files': len(paths),
+            'src_bytes': sum(os.path.getsize(path) for path in paths),
+            'wall_seconds': round(wall_seconds, 3),
+            'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+            'max_rss_kb': rusage.ru_maxrss,  # Linux: kilobytes
+            'max_fixpoint_passes': _max_fixpoint_passes(metrics_path),
+            'exit_status': exit_status,
+    }
+
+
+def _max_fixpoint_passes(metrics_path: str) -> int:
+    if not os.path.exists(metrics_path):
+        return 0
+    max_passes = 0
+    with open(metrics_path, encoding='utf-8') as metrics_file:
+        for line in metrics_file:
+            if line.strip():
+                max_passes = max(max_passes, len(json.loads(line).get('fixpoint_passes', [])))
+    return max_passes
+
+
+def _flag_superlinear(prev: Dict, result: Dict, exponent: float) -> None:
+    """Print a warning if result grew faster than prev by more than exponent."""
+    size_ratio = result['src_bytes'] / prev['src_bytes']
+    if size_ratio <= 1.0:
+        # e.g., fanout or cycles, which don't change the size much: compare
+        # with the parameter value instead.
+        if not prev['value'] or result['value'] <= prev['value']:
+            return
+        size_ratio = result['value'] / prev['value']
+    for field in ['wall_seconds', 'max_rss_kb']:
+        if prev[field] and result[field]:
+            growth = math.log(result[field] / prev[field]) / math.log(size_ratio)
+            if growth > exponent:
+                print(f'SUPER-LINEAR: {result["param"]} {prev["value"]}->{result["value"]}: '
+                      f'{field} grew as size**{growth:.2f}')
+
+
+def _plot(results: List[Dict], png_path: str) -> None:
+    try:
+        import matplotlib  # pylint: disable=import-outside-toplevel
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print('matplotlib not installed: no plot')
+        return
+    params = sorted({result['param'] for result in results})
+    fig, axes = plt.subplots(len(params), 2, squeeze=False, figsize=(10, 4 * len(params)))
+    for row, param in enumerate(params):
+        points = [result for result in results if result['param'] == param]
+        for col, (field, label) in enumerate([('wall_seconds', 'seconds'),
+                                              ('max_rss_kb', 'max RSS (KB)')]):
+            axis = axes[row][col]
+            axis.loglog([point['value'] or 1 for point in points],
+                        [point[field] for point in points], marker='o')
+            axis.set_xlabel(param)
+            axis.set_ylabel(label)
+            axis.grid(True, which='both')
+    fig.tight_layout()
+    fig.savefig(png_path)
+    print(f'Wrote {png_path}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3.7
+"""Watch source directories and keep the browser's Kythe facts up to date.
+
+When Python files change, this:
+  0. if --subst_dir is given, refreshes the copies of the changed files
+     under it (with --subst_cmd) and uses the copies' paths instead,
+     so that the paths match those of the browser's facts (e.g., the
+     Makefile's make-json processes the copies in $(SUBSTDIR));
+  1. runs pykythe with --changed_files (which reprocesses the changed
+     files and the modules that import them, using the import graph
+     saved by previous runs with --import_graph); changed files are
+     also passed as positional args, so that new files get processed;
+  2. converts the .kythe.json files that were rewritten to Prolog facts
+     (browser/kythe_json_to_prolog.pl), in a separate directory;
+  3. POSTs the resulting facts file to a running src_browser.pl's
+     /reload handler, which replaces the facts for those files (the
+     browser must be on the same host and have been started with
+     --reload_dir containing --workdir).
+
+Changes are collected until there have been none for --debounce
+seconds, so that a burst of saves (e.g., a "git checkout") results in a
+single reindex. Changes are detected with inotifywait (from
+inotify-tools) if it's installed, otherwise by polling the files'
+modification times every --poll seconds.
+
+The indexes must have been built first (e.g., "make test make-json").
+See the "watch" target in the Makefile.
+
+Usage:
+    scripts/watch_and_reindex.py --src_dir=SRC_DIR... \\
+        --kytheout=/tmp/pykythe_test/KYTHE --workdir=/tmp/pykythe_test/watch \\
+        --browser_url=http://localhost:9999 -- PYKYTHE_COMMAND_AND_OPTIONS...
+where PYKYTHE_COMMAND_AND_OPTIONS includes --kytheout and --import_graph
+(but not --changed_files or any source files).
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from typing import Dict, Iterable, List, Optional, Set
+
+PY_EXTS = ('.py', '.pyi')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Watch source files and reindex them')
+    parser.add_argument('--src_dir',
+                        action='append',
+                        required=True,
+                        help='Directory to watch (can be repeated)')
+    parser.add_argument('--kytheout', required=True, help='Same as pykythe --kytheout')
+    parser.add_argument('--kythe_json_to_prolog',
+                        default='swipl -g main -t halt browser/kythe_json_to_prolog.pl --',
+                        help='Command for converting .kythe.json files to Prolog facts')
+    parser.add_argument('--workdir',
+                        required=True,
+                        help='Directory for the changed-files list and the facts to reload')
+    parser.add_argument('--browser_url',
+                        default='http://localhost:9999',
+                        help='src_browser.pl server (or "" to not update it)')
+    parser.add_argument('--subst_dir',
+                        default='',
+                        help='Process the copies of the changed files under this directory')
+    parser.add_argument('--subst_cmd',
+                        default='make --no-print-directory',
+                        help='Command for refreshing the --subst_dir copies (given their paths)')
+    parser.add_argument('--debounce',
+                        type=float,
+                        default=0.5,
+                        help='Seconds without changes before reindexing')
+    parser.add_argument('--poll',
+                        type=float,
+                        default=1.0,
+                        help='Seconds between polls, if inotifywait is not available')
+    parser.add_argument('pykythe',
+                        nargs=argparse.REMAINDER,
+                        help='pykythe command and options (after "--")')
+    args = parser.parse_args()
+    if args.pykythe[:1] == ['--']:
+        args.pykythe = args.pykythe[1:]
+    if not args.pykythe:
+        parser.error('Missing pykythe command')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    os.makedirs(args.workdir, exist_ok=True)
+
+    changes: 'queue.Queue[str]' = queue.Queue()
+    if shutil.which('inotifywait'):
+        watcher = threading.Thread(target=_watch_inotify, args=(args.src_dir, changes))
+    else:
+        logging.info('inotifywait not found: polling every %.1f sec', args.poll)
+        watcher = threading.Thread(target=_watch_poll, args=(args.src_dir, args.poll, changes))
+    watcher.daemon = True
+    watcher.start()
+    logging.info('Watching %s', ' '.join(args.src_dir))
+    try:
+        while True:
+            changed = _debounced(changes, args.debounce)
+            if changed:
+                _reindex(args, sorted(changed))
+    except KeyboardInterrupt:
+        return 0
+
+
+def _debounced(changes: 'queue.Queue[str]', debounce: float) -> Set[str]:
+    """Wait for a change, then collect changes until none for debounce seconds."""
+    changed = {changes.get()}
+    while True:
+        try:
+            changed.add(changes.get(timeout=debounce))
+        except queue.Empty:
+            return {path for path in changed if path.endswith(PY_EXTS)}
+
+
+def _watch_inotify(src_dirs: List[str], changes: 'queue.Queue[str]') -> None:
+    cmd = [
+            'inotifywait', '--monitor', '--recursive', '--quiet', '--format', '%w%f', '--event',
+            'close_write,moved_to,moved_from,delete'
+    ] + src_dirs
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True) as proc:
+        assert proc.stdout
+        for line in proc.stdout:
+            changes.put(os.path.abspath(line.rstrip('\n')))
+
+
+def _watch_poll(src_dirs: List[str], poll: float, changes: 'queue.Queue[str]') -> None:
+    mtimes = _mtimes(src_dirs)
+    while True:
+        time.sleep(poll)
+        new_mtimes = _mtimes(src_dirs)
+        for path in set(mtimes) | set(new_mtimes):
+            if mtimes.get(path) != new_mtimes.get(path):
+                changes.put(path)
+        mtimes = new_mtimes
+
+
+def _mtimes(src_dirs: Iterable[str]) -> Dict[str, float]:
+    mtimes = {}
+    for src_dir in src_dirs:
+        for dirpath, _, filenames in os.walk(src_dir):
+            for filename in filenames:
+                if filename.endswith(PY_EXTS):
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except FileNotFoundError:
+                        pass  # deleted since os.walk() listed it
+    return mtimes
+
+
+def _reindex(args: argparse.Namespace, changed: List[str]) -> None:
+    start = time.time()
+    logging.info('Reindexing for %d changed files: %s', len(changed), ' '.join(changed))
+    if args.subst_dir:
+        subst_changed = _refresh_subst(args, changed)
+        if subst_changed is None:
+            return
+        changed = subst_changed
+    changed_files_path = os.path.join(args.workdir, 'changed_files')
+    with open(changed_files_path, 'w') as changed_files:
+        changed_files.write(''.join(path + '\n' for path in changed))
+    existing = [path for path in changed if os.path.exists(path)]
+    pykythe_cmd = args.pykythe + ['--changed_files=' + changed_files_path] + existing
+    if subprocess.run(pykythe_cmd, check=False).returncode != 0:
+        logging.error('pykythe failed: %s', ' '.join(pykythe_cmd))
+        return
+    kythe_json_paths = _modified_since(args.kytheout, '.kythe.json', start)
+    logging.info('Reindexed %d files (%.1f sec)', len(kythe_json_paths), time.time() - start)
+    if not kythe_json_paths or not args.browser_url:
+        return
+    facts_dir = os.path.join(args.workdir, 'facts')
+    convert = subprocess.run(shlex.split(args.kythe_json_to_prolog) + ['--filesdir=' + facts_dir],
+                             input=''.join(path + '\n' for path in kythe_json_paths),
+                             universal_newlines=True,
+                             check=False)
+    if convert.returncode != 0:
+        logging.error('kythe_json_to_prolog failed')
+        return
+    _post_reload(args.browser_url, os.path.join(facts_dir, 'kythe_facts.pl'))
+    logging.info('Browser updated (%.1f sec total)', time.time() - start)
+
+
+def _refresh_subst(args: argparse.Namespace, changed: List[str]) -> Optional[List[str]]:
+    """The --subst_dir copies of the changed files, after refreshing them (or None on error)."""
+    subst_paths = [args.subst_dir.rstrip('/') + os.path.abspath(path) for path in changed]
+    existing = []
+    for path, subst_path in zip(changed, subst_paths):
+        if os.path.exists(path):
+            existing.append(subst_path)
+        elif os.path.exists(subst_path):
+            os.remove(subst_path)
+    if existing:
+        subst_cmd = shlex.split(args.subst_cmd) + existing
+        if subprocess.run(subst_cmd, check=False).returncode != 0:
+            logging.error('Refreshing the copies failed: %s', ' '.join(subst_cmd))
+            return None
+    return subst_paths
+
+
+def _modified_since(top_dir: str, suffix: str, start: float) -> List[str]:
+    paths = []
+    for dirpath, _, filenames in os.walk(top_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith(suffix) and os.stat(path).st_mtime >= start:
+                paths.append(path)
+    return sorted(paths)
+
+
+def _post_reload(browser_url: str, facts_path: str) -> None:
+    request = urllib.request.Request(browser_url.rstrip('/') + '/reload',
+                                     data=json.dumps({
+                                             'facts_file': os.path.abspath(facts_path)
+                                     }).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'},
+                                     method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)
+        logging.info('Browser reloaded %d files (%.3f sec)', len(result['paths']),
+                     result['seconds'])
+    except OSError as exc:
+        logging.error('Could not update browser at %s: %s', browser_url, exc)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
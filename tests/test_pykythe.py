@@ -4,12 +4,15 @@ Most of the tests are done using the Kythe verifier. These are mainly
 low-level tests that were used early in development.
 """
 
+import argparse
 import collections
 import dataclasses
 from dataclasses import dataclass
 import logging
 import os
 import pickle
+import resource
+import signal
 import sys
 from typing import Any
 import unittest
@@ -20,6 +23,7 @@ from lib2to3.pgen2 import token
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from pykythe import (ast, ast_cooked, ast_raw, fakesys, typing_debug, pod, ast_color)  # pylint: disable=wrong-import-position
+from pykythe import __main__ as pykythe_main  # pylint: disable=wrong-import-position
 
 
 @dataclass(frozen=True)
@@ -452,5 +456,29 @@ class TestColor(unittest.TestCase):
                                     token_type='<NEWLINE>'), ])
 
 
+class TestBudget(unittest.TestCase):
+
+    def test_restores_limits(self) -> None:
+        orig_rlimit = resource.getrlimit(resource.RLIMIT_AS)
+        hard = orig_rlimit[1]
+        soft = 8 * 1024 * 1024 * 1024 if hard == resource.RLIM_INFINITY else hard // 2
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+        try:
+            budget = pykythe_main._set_budget(
+                    argparse.Namespace(max_cpu_seconds=0, max_memory_mb=soft // (4 * 1024 * 1024)))
+            self.assertEqual(soft // 4, resource.getrlimit(resource.RLIMIT_AS)[0])
+            pykythe_main._clear_budget(budget)
+            self.assertEqual((soft, hard), resource.getrlimit(resource.RLIMIT_AS))
+            # Without a budget, nothing is changed.
+            handler = signal.getsignal(signal.SIGPROF)
+            budget = pykythe_main._set_budget(
+                    argparse.Namespace(max_cpu_seconds=0, max_memory_mb=0))
+            self.assertIs(handler, signal.getsignal(signal.SIGPROF))
+            pykythe_main._clear_budget(budget)
+            self.assertEqual((soft, hard), resource.getrlimit(resource.RLIMIT_AS))
+        finally:
+            resource.setrlimit(resource.RLIMIT_AS, orig_rlimit)
+
+
 if __name__ == '__main__':
     unittest.main()